@@ -16,6 +16,19 @@ S M Crawford (SAAO)    0.1          09 Jun 2013
 
 Updates
 ------------------------------------------------
+20261018  -Combine the bias and flat frames out of core with a memory-mapped stack
+          -Find the calibration frames from a catalog of HRS_Cals
+          -Solve the orders of the arcs in parallel
+          -Extract the orders of the science frames in parallel from an index
+           of the pixels in each order
+          -Save the geometry of each order frame in a file next to it
+          -Clean the cosmic rays in overlapping tiles in parallel
+          -Write the order and arc measurements with bound parameters in a 
+           single transaction
+          -Read the headers of the raw frames from the header cache of the
+           night
+          -Read the summary of the raw frames once for each run and process
+           only the modes that have frames
 
 Todo
 ------------------------------------------------
@@ -26,6 +39,9 @@ from __future__ import with_statement
 
 import sys,glob, os, shutil, time
 import pickle
+import tempfile
+import ctypes
+import multiprocessing
 import numpy as np
 
 import logging
@@ -42,7 +58,6 @@ from pyhrs import normalize_image, create_orderframe, clean_flatimage
 
 import ccdproc
 from ccdproc import CCDData
-from ccdproc import ImageFileCollection
 
 from pyhrs.hrsprocess import *
 from pyhrs import mode_setup_information, HRSOrder, collapse_array
@@ -54,9 +69,25 @@ from specreduce import match_probability, ws_match_lines
 
 from astroscrappy import detect_cosmics
 
+from saltdq import DQAccumulator
+from hrscatalog import get_catalog, parse_product, date_ordinal
+from saltheadercache import HeaderCollection
+
 
 debug=True
 
+#wavelength solutions for each sol_dir
+_solution_cache = {}
+
+#arrays shared with the processes of a pool
+_shared = {}
+
+#keywords in the summary of the raw frames
+summary_keywords = ['OBSTYPE', 'DETNAM', 'OBSMODE', 'PROPID']
+
+#observing modes of HRS
+hrs_modes = ['HIGH STABILITY', 'LOW RESOLUTION', 'MEDIUM RESOLUTION', 'HIGH RESOLUTION']
+
 #biasheader_list=['INSTRUME', 'DETMODE', 'CCDSUM', 'GAINSET', 'ROSPEED', 'NWINDOW']
 #flatheader_list=['INSTRUME', 'DETMODE', 'CCDSUM', 'GAINSET', 'ROSPEED', 'FILTER', 'GRATING', 'GR-ANGLE', 'AR-ANGLE', 'NWINDOW']
 
@@ -69,13 +100,8 @@ def find_bias(obsdate, prefix, bias_dir='/salt/HRS_Cals/CAL_BIAS/', nlim=180):
     """Search starting with the obsdate and moving backword in time, 
        for a bias frame
     """
-    date = dt.datetime.strptime('{} 12:00:00'.format(obsdate), '%Y%m%d %H:%M:%S')
-    for i in range(nlim):
-        obsdate = date.strftime('%Y%m%d')
-        bias_file = '{0}{1}/{2}/product/{3}BIAS_{4}.fits'.format(bias_dir, obsdate[0:4], obsdate[4:8], prefix, obsdate)
-        if os.path.isfile(bias_file): return bias_file
-        date = date - dt.timedelta(seconds=24*3600.0)
-    return None
+    catalog = get_catalog(os.path.dirname(bias_dir.rstrip('/')))
+    return catalog.nearest(obsdate, 'BIAS', prefix, nlim=nlim, past_only=True)
 
 
 def get_hrs_calibration_frame(obsdate, prefix, cal_type='BIAS', mode=None, cal_dir='/salt/HRS_Cals/', nlim=180):
@@ -109,40 +135,133 @@ def get_hrs_calibration_frame(obsdate, prefix, cal_type='BIAS', mode=None, cal_d
        Name and path to appropriate calibration file
 
     """
-    start_date = dt.datetime.strptime('{} 12:00:00'.format(obsdate), '%Y%m%d %H:%M:%S')
     if mode is not None:
-         mode = '_'+ mode
+         mode_ext = '_'+ mode
     else:
-         mode = ''
+         mode_ext = ''
 
     cfile = 'hrs/product/{prefix}{cal_type}_{year}{mmdd}{mode}.fits'.format(
-               cal_type=cal_type, year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix, mode=mode.replace(' ', '_'))
+               cal_type=cal_type, year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix, mode=mode_ext.replace(' ', '_'))
     if os.path.isfile(cfile): return cfile
 
-    def get_name(start_date, i, cal_dir, cal_type, prefix, mode):
-        date = start_date + dt.timedelta(seconds=i*24*3600.0)
-        obsdate = date.strftime('%Y%m%d')
-        if cal_type == 'ORDER': 
-            cals = 'FLAT'
-        else: 
-            cals = cal_type
-        cfile = '{cal_dir}CAL_{cals}/{year}/{mmdd}/product/{prefix}{cal_type}_{year}{mmdd}{mode}.fits'.format(
-           cal_dir=cal_dir, cal_type=cal_type, year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix, mode=mode, cals = cals)
-        if os.path.isfile(cfile): return cfile
-        return None 
-
-    for i in range(nlim):
-        #look into the future
-        cfile = get_name(start_date, i,  cal_dir, cal_type, prefix, mode)
-        if cfile: return cfile
-        #look into the past
-        cfile = get_name(start_date, -i,  cal_dir, cal_type, prefix, mode)
-        if cfile: return cfile
-  
-    return None 
+    #the closest in date, with the later date first if two are equally close
+    catalog = get_catalog(cal_dir)
+    return catalog.nearest(obsdate, cal_type, prefix, mode=mode, nlim=nlim)
+
+
+class FrameStack:
+    """Median combine a set of frames without holding all of them in memory.
+       Each frame is written to a memory-mapped stack on disk as it is added
+       and the median is calculated in blocks of rows that fit within the
+       memory limit.
+
+    Parameters
+    ----------
+    nframes: int
+       Maximum number of frames in the stack
 
+    workdir: str or None
+       Directory for the stack file
 
-def dq_ccd_insert(filename, sdb):
+    mem_limit: float
+       Maximum memory in bytes to use when combining the frames
+
+    """
+
+    def __init__(self, nframes, workdir=None, mem_limit=1e9):
+        self.nframes = nframes
+        self.workdir = workdir
+        self.mem_limit = mem_limit
+        self.n = 0
+        self.data = None
+        self.mask = None
+        self.header = None
+        self.unit = None
+        self.stackfile = None
+
+    def __len__(self):
+        return self.n
+
+    def allocate(self, shape):
+        """Create the memory-mapped files for the stack"""
+        fd, self.stackfile = tempfile.mkstemp(suffix='.stack', dir=self.workdir)
+        os.close(fd)
+        self.data = np.memmap(self.stackfile, dtype=np.float32, mode='w+',
+                              shape=(self.nframes,) + shape)
+        self.mask = np.memmap(self.stackfile + '.mask', dtype=np.bool_, mode='w+',
+                              shape=(self.nframes,) + shape)
+
+    def add(self, ccd):
+        """Add a processed frame to the stack"""
+        if self.n >= self.nframes:
+            raise ValueError('FrameStack is full')
+        if self.data is None:
+            self.allocate(ccd.data.shape)
+            self.header = ccd.header.copy()
+            self.unit = ccd.unit
+        elif ccd.data.shape != self.data.shape[1:]:
+            raise ValueError('Frames in a FrameStack must have the same shape')
+        self.data[self.n] = ccd.data
+        if ccd.mask is not None:
+            self.mask[self.n] = ccd.mask
+        else:
+            self.mask[self.n] = False
+        self.n += 1
+
+    def rows_per_block(self):
+        """Number of rows of the stack that can be combined at once"""
+        ny, nx = self.data.shape[1:]
+        #the block, its mask and the temporary arrays of the median
+        row_size = 4.0 * self.n * nx * (self.data.itemsize + self.mask.itemsize)
+        return int(max(1, min(ny, self.mem_limit // row_size)))
+
+    def combine(self, output_file=None):
+        """Median combine the frames in the stack.  As in ccdproc.combine, the
+           uncertainty is the median absolute deviation of the frames scaled
+           to a standard deviation and divided by the square root of the number
+           of frames, and pixels that are masked in all frames are masked.
+
+        Returns
+        -------
+        ccd: ccdproc.CCDData
+           Combined frame
+
+        """
+        if self.n == 0:
+            raise ValueError('No frames have been added to the FrameStack')
+
+        ny, nx = self.data.shape[1:]
+        combined = np.zeros((ny, nx), dtype=np.float32)
+        error = np.zeros((ny, nx), dtype=np.float32)
+        mask = np.zeros((ny, nx), dtype=np.bool_)
+        step = self.rows_per_block()
+        for y1 in range(0, ny, step):
+            y2 = min(ny, y1 + step)
+            block = np.ma.masked_array(self.data[:self.n, y1:y2], mask=self.mask[:self.n, y1:y2])
+            combined[y1:y2] = np.ma.median(block, axis=0).filled(0)
+            ngood = (~block.mask).sum(axis=0)
+            mad = stats.median_absolute_deviation(block, axis=0) * 1.482602218505602
+            error[y1:y2] = (mad / np.sqrt(np.maximum(ngood, 1))).filled(0)
+            mask[y1:y2] = (ngood == 0)
+
+        self.header['NCOMBINE'] = self.n
+        ccd = CCDData(combined, unit=self.unit, meta=self.header, mask=mask,
+                      uncertainty=ccdproc.StdDevUncertainty(error))
+        if output_file is not None:
+            ccd.write(output_file)
+        return ccd
+
+    def close(self):
+        """Remove the stack files"""
+        self.data = None
+        self.mask = None
+        if self.stackfile is not None:
+            for f in [self.stackfile, self.stackfile + '.mask']:
+                if os.path.isfile(f): os.remove(f)
+            self.stackfile = None
+
+
+def dq_ccd_insert(filename, sdb, dq=None):
     """Insert CCD information into the database 
 
     Parameters
@@ -152,13 +271,12 @@ def dq_ccd_insert(filename, sdb):
 
     sdb: sdb_user.mysql
        Connection to the sdb database
+
+    dq: saltdq.DQAccumulator
+       If given, the information is added to it and written to the
+       database when it is flushed
     """
-    logic="FileName='%s'" % os.path.basename(filename)
-    FileData_Id = sdb.select('FileData_Id','FileData',logic)[0][0]
     i = 0
-    record=sdb.select('FileData_Id', 'PipelineDataQuality_CCD', 'FileData_Id=%i and Extension=%i' % (FileData_Id, i))
-    update=False
-    if record: update=True
 
     #lets measureme the statistics in a 200x200 box in each image
     struct = CCDData.read(filename, unit='adu')
@@ -171,19 +289,26 @@ def dq_ccd_insert(filename, sdb):
     omean=None
     orms=None
 
-    ins_cmd=''
-    if omean is not None: ins_cmd='OverscanMean=%s,' % omean
-    if orms is not None:  ins_cmd+='OverscanRms=%s,' % orms
-    if mean is not None:  ins_cmd+='BkgdMean=%f,' % mean
-    if sig is not None:   ins_cmd+='BkgdRms=%f' % sig
-    if update:
-       ins_cmd=ins_cmd.rstrip(',')
-       sdb.update(ins_cmd, 'PipelineDataQuality_CCD', 'FileData_Id=%i and Extension=%i' % (FileData_Id, i))
+    if dq is None:
+        acc = DQAccumulator(sdb)
     else:
-       ins_cmd+=',FileData_Id=%i, Extension=%i' % (FileData_Id, i)
-       sdb.insert(ins_cmd, 'PipelineDataQuality_CCD')
+        acc = dq
+    acc.add(os.path.basename(filename), Extension=i, OverscanMean=omean, OverscanRms=orms, 
+            BkgdMean=mean, BkgdRms=sig)
+    if dq is None: flush_dq(acc)
+
+def flush_dq(dq):
+    """Write the data quality information collected in dq to the database
 
-def dq_order_insert(filename, sdb):
+    Parameters
+    ----------
+    dq: saltdq.DQAccumulator
+       Data quality information
+    """
+    for fname in dq.flush():
+        logging.warning('{} is not in the database'.format(fname))
+
+def dq_order_insert(filename, sdb, geometry=None):
     """Insert order information into the database 
 
     Parameters
@@ -193,43 +318,52 @@ def dq_order_insert(filename, sdb):
 
     sdb: sdb_user.mysql
        Connection to the sdb database
+
+    geometry: dict or None
+       Geometry of the orders from read_order_geometry.  If None, it is read
+       from the file next to the order frame
     """
-    hdu = fits.open(filename)
-    data = hdu[0].data
+    if geometry is None: geometry = read_order_geometry(filename)
    
     # get the minimum and maximum order
-    min_order = int(data[data>0].min())
-    max_order = int(data[data>0].max())
+    min_order = min(geometry)
+    max_order = max(geometry)
 
     #the name must of a specific format
     bname = os.path.basename(filename)
     sname = bname.split('.')[0].split('_')
     obsdate = sname[1]
     mode = sname[2] + " " + sname[3]
-    night_id = sdb.select('NightInfo_Id', 'NightInfo', "Date='{}-{}-{}'".format(obsdate[0:4], obsdate[4:6], obsdate[6:8]))[0][0]
-    mode_id = sdb.select('HrsMode_Id', 'HrsMode', "ExposureMode = '{}'".format(mode))[0][0]
+    night_id = sdb.query('SELECT NightInfo_Id FROM NightInfo WHERE Date=%s', 
+                         ('{}-{}-{}'.format(obsdate[0:4], obsdate[4:6], obsdate[6:8]),))[0][0]
+    mode_id = sdb.query('SELECT HrsMode_Id FROM HrsMode WHERE ExposureMode=%s', (mode,))[0][0]
     
 
-    ys, xs =data.shape
+    xs = len(geometry[min_order]['y_lower'])
     xc = int(xs/2.0)  
-    arr = data[:, xc]
     logging.info('Uploading HRS Order Measurements for {}'.format(filename))
+    existing = set([int(r[0]) for r in sdb.query('SELECT HrsOrder FROM DQ_HrsOrder WHERE Filename=%s', (bname,))])
+    updates = []
+    inserts = []
     for i in range(min_order, max_order+1):
-        mask = (arr == i)
-        indices = np.where(mask)[0]
-        y_lower = indices.min()
-        y_upper = indices.max()
-        log_cmd = "Filename = '{}' and HrsOrder =  {}".format(bname, i)
-        record = sdb.select('y_upper', 'DQ_HrsOrder', log_cmd)
-        ins_cmd = "x_reference={},y_lower={},y_upper={}".format(xc, y_lower, y_upper)
-        if record:
-           sdb.update(ins_cmd, 'DQ_HrsOrder', log_cmd)
+        if i not in geometry or geometry[i]['y_lower'][xc] < 0:
+            logging.warning('Order {} is not in column {} of {}'.format(i, xc, filename))
+            continue
+        y_lower = int(geometry[i]['y_lower'][xc])
+        y_upper = int(geometry[i]['y_upper'][xc])
+        if i in existing:
+           updates.append((xc, y_lower, y_upper, bname, i))
         else:
-           ins_cmd = "Filename='{}', HrsOrder={},HrsMode_Id={},NightInfo_Id={},".format(bname, i, mode_id, night_id)  + ins_cmd
-           sdb.insert(ins_cmd, 'DQ_HrsOrder')
+           inserts.append((bname, i, mode_id, night_id, xc, y_lower, y_upper))
+
+    with sdb.transaction():
+        sdb.executemany('UPDATE DQ_HrsOrder SET x_reference=%s, y_lower=%s, y_upper=%s '
+                        'WHERE Filename=%s and HrsOrder=%s', updates)
+        sdb.executemany('INSERT INTO DQ_HrsOrder (Filename, HrsOrder, HrsMode_Id, NightInfo_Id, x_reference, y_lower, y_upper) '
+                        'VALUES (%s, %s, %s, %s, %s, %s, %s)', inserts)
         
 
-def hrsbias(rawpath, outpath, link=False, mem_limit=1e9, sdb=None, clobber=True):
+def hrsbias(rawpath, outpath, link=False, mem_limit=1e9, sdb=None, image_list=None, clobber=True):
    """hrsbias processes the HRS red and blue bias frames in a directory
 
    Parameters
@@ -243,6 +377,13 @@ def hrsbias(rawpath, outpath, link=False, mem_limit=1e9, sdb=None, clobber=True)
    link: boolean
       Add symbolic link to HRS_CALS directory
 
+   mem_limit: float
+      Maximum memory in bytes to use when combining the frames
+
+   image_list: HeaderCollection or None
+      Summary of the raw frames.  If None, the headers of the frames in 
+      rawpath are read
+
    clobber: boolean
       Overwrite existing files
 
@@ -250,7 +391,7 @@ def hrsbias(rawpath, outpath, link=False, mem_limit=1e9, sdb=None, clobber=True)
    """
    if not os.path.isdir(rawpath): return 
 
-   image_list = ImageFileCollection(rawpath)
+   if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
    if len(image_list.files)==0: return
 
    #make output directory
@@ -260,55 +401,64 @@ def hrsbias(rawpath, outpath, link=False, mem_limit=1e9, sdb=None, clobber=True)
    obsdate=get_obsdate(image_list.summary['file'][0])
  
 
-   #process the red bias frames
-   matches = (image_list.summary['obstype'] == 'Bias') * (image_list.summary['detnam'] == 'HRDET')
-   rbias_list = []
-   for fname in image_list.summary['file'][matches]:
-        ccd = red_process(rawpath+fname)
-        rbias_list.append(ccd)
-        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb)
-
-   if rbias_list:
-        if os.path.isfile("{0}/RBIAS_{1}.fits".format(outpath, obsdate)) and clobber: 
-            os.remove("{0}/RBIAS_{1}.fits".format(outpath, obsdate))
-        rbias = ccdproc.combine(rbias_list, method='median', output_file="{0}/RBIAS_{1}.fits".format(outpath, obsdate), mem_limit=mem_limit)
-        del rbias_list
+   if sdb is not None: dq = DQAccumulator(sdb)
 
    #process the red bias frames
-   matches = (image_list.summary['obstype'] == 'Bias') * (image_list.summary['detnam'] == 'HBDET')
-   hbias_list = []
-   for fname in image_list.summary['file'][matches]:
-        ccd = blue_process(rawpath+fname)
-        hbias_list.append(ccd)
-        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb)
-
-   if hbias_list:
-        if os.path.isfile("{0}/HBIAS_{1}.fits".format(outpath, obsdate)) and clobber: 
-            os.remove("{0}/HBIAS_{1}.fits".format(outpath, obsdate))
-        hbias = ccdproc.combine(hbias_list, method='median', output_file="{0}/HBIAS_{1}.fits".format(outpath, obsdate), mem_limit=mem_limit)
-        del hbias_list
-
+   matches = image_list.select(obstype='Bias', detnam='HRDET')
+   rbias_list = FrameStack(len(matches), workdir=outpath, mem_limit=mem_limit)
+   try:
+       for fname in matches:
+            ccd = red_process(rawpath+fname)
+            rbias_list.add(ccd)
+            if sdb is not None: dq_ccd_insert(rawpath + fname, sdb, dq=dq)
+
+       if len(rbias_list):
+            if os.path.isfile("{0}/RBIAS_{1}.fits".format(outpath, obsdate)) and clobber: 
+                os.remove("{0}/RBIAS_{1}.fits".format(outpath, obsdate))
+            rbias = rbias_list.combine(output_file="{0}/RBIAS_{1}.fits".format(outpath, obsdate))
+   finally:
+       rbias_list.close()
 
-   #provide the link to the bias frame
-        if link:
-           ldir = '/salt/HRS_Cals/CAL_BIAS/{0}/{1}/'.format(obsdate[0:4], obsdate[4:8])
-           if not os.path.isdir(ldir): os.mkdir(ldir)
-           ldir = '/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product'.format(obsdate[0:4], obsdate[4:8])
-           if not os.path.isdir(ldir): os.mkdir(ldir)
+   #process the red bias frames
+   matches = image_list.select(obstype='Bias', detnam='HBDET')
+   hbias_list = FrameStack(len(matches), workdir=outpath, mem_limit=mem_limit)
+   try:
+       for fname in matches:
+            ccd = blue_process(rawpath+fname)
+            hbias_list.add(ccd)
+            if sdb is not None: dq_ccd_insert(rawpath + fname, sdb, dq=dq)
+       if sdb is not None: flush_dq(dq)
+
+       if len(hbias_list):
+            if os.path.isfile("{0}/HBIAS_{1}.fits".format(outpath, obsdate)) and clobber: 
+                os.remove("{0}/HBIAS_{1}.fits".format(outpath, obsdate))
+            hbias = hbias_list.combine(output_file="{0}/HBIAS_{1}.fits".format(outpath, obsdate))
+
+
+       #provide the link to the bias frame
+            if link:
+               ldir = '/salt/HRS_Cals/CAL_BIAS/{0}/{1}/'.format(obsdate[0:4], obsdate[4:8])
+               if not os.path.isdir(ldir): os.mkdir(ldir)
+               ldir = '/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product'.format(obsdate[0:4], obsdate[4:8])
+               if not os.path.isdir(ldir): os.mkdir(ldir)
     
-           infile="{0}/RBIAS_{1}.fits".format(outpath, obsdate)
-           link='/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product/RBIAS_{2}.fits'.format(obsdate[0:4], obsdate[4:8], obsdate)
-           if os.path.islink(link) and clobber: os.remove(link)
-           os.symlink(infile, link)
-           infile="{0}/HBIAS_{1}.fits".format(outpath, obsdate)
-           link='/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product/HBIAS_{2}.fits'.format(obsdate[0:4], obsdate[4:8], obsdate)
-           if os.path.islink(link) and clobber: os.remove(link)
-           os.symlink(infile, link)
+               infile="{0}/RBIAS_{1}.fits".format(outpath, obsdate)
+               link='/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product/RBIAS_{2}.fits'.format(obsdate[0:4], obsdate[4:8], obsdate)
+               if os.path.islink(link) and clobber: os.remove(link)
+               os.symlink(infile, link)
+               get_catalog('/salt/HRS_Cals/').add(link)
+               infile="{0}/HBIAS_{1}.fits".format(outpath, obsdate)
+               link='/salt/HRS_Cals/CAL_BIAS/{0}/{1}/product/HBIAS_{2}.fits'.format(obsdate[0:4], obsdate[4:8], obsdate)
+               if os.path.islink(link) and clobber: os.remove(link)
+               os.symlink(infile, link)
+               get_catalog('/salt/HRS_Cals/').add(link)
+   finally:
+       hbias_list.close()
 
 
 def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000, first_order=53, 
             y_start=30, y_limit=3920, smooth_length=20, smooth_fraction=0.4, filter_size=151,
-            link=False, sdb=None, clobber=True):
+            link=False, sdb=None, mem_limit=1e9, image_list=None, clobber=True):
    """hrsflat processes the HRS flatfields.  It will process for a given detector and a mode
 
    Parameters
@@ -325,6 +475,13 @@ def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000,
    sdb: sdb_user.mysql
       SDB object to upload data quality
 
+   mem_limit: float
+      Maximum memory in bytes to use when combining the frames
+
+   image_list: HeaderCollection or None
+      Summary of the raw frames.  If None, the headers of the frames in 
+      rawpath are read
+
    clobber: boolean
       Overwrite existing files
 
@@ -332,7 +489,7 @@ def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000,
    """
    if not os.path.isdir(rawpath): return
 
-   image_list = ImageFileCollection(rawpath)
+   if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
    if len(image_list.files)==0: return
 
    #make output directory
@@ -355,19 +512,27 @@ def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000,
       raise ValueError('detname must be a valid HRS Detector name')
 
    #process the flat  frames
-   matches = (image_list.summary['obstype'] == 'Flat field') * (image_list.summary['detnam'] == detname) * (image_list.summary['obsmode'] == obsmode) * (image_list.summary['propid'] != 'JUNK')
-   flat_list = []
-   for fname in image_list.summary['file'][matches]:
-        logging.info('Processing flat image {}'.format(fname))
-        ccd = process(rawpath+fname, masterbias=master_bias, error=True, rdnoise=rdnoise)
-        flat_list.append(ccd)
-        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb)
-
-   if flat_list:
-        outfile = "{0}/{2}FLAT_{1}_{3}.fits".format(outpath, obsdate, prefix, obsmode.replace(' ', '_'))
-        logging.info('Created master flat {}'.format(os.path.basename(outfile)))
-        if os.path.isfile(outfile) and clobber:  os.remove(outfile)
-        flat = ccdproc.combine(flat_list, method='median', output_file=outfile)
+   matches = image_list.select(obstype='Flat field', detnam=detname, obsmode=obsmode, exclude={'propid':'JUNK'})
+   flat_list = FrameStack(len(matches), workdir=outpath, mem_limit=mem_limit)
+   if sdb is not None: dq = DQAccumulator(sdb)
+   try:
+       for fname in matches:
+            logging.info('Processing flat image {}'.format(fname))
+            ccd = process(rawpath+fname, masterbias=master_bias, error=True, rdnoise=rdnoise)
+            flat_list.add(ccd)
+            if sdb is not None: dq_ccd_insert(rawpath + fname, sdb, dq=dq)
+       if sdb is not None: flush_dq(dq)
+
+       nflat = len(flat_list)
+       if nflat:
+            outfile = "{0}/{2}FLAT_{1}_{3}.fits".format(outpath, obsdate, prefix, obsmode.replace(' ', '_'))
+            logging.info('Created master flat {}'.format(os.path.basename(outfile)))
+            if os.path.isfile(outfile) and clobber:  os.remove(outfile)
+            flat = flat_list.combine(output_file=outfile)
+   finally:
+       flat_list.close()
+
+   if nflat:
 
         norm = clean_flatimage(flat.data, filter_size=filter_size, flux_limit=0.3,
                 block_size=100, percentile_low=30, median_size=5)
@@ -390,7 +555,8 @@ def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000,
         logging.info('Created order frame {}'.format(os.path.basename(order_file)))
         hdu = fits.PrimaryHDU(frame)
         hdu.writeto(order_file, clobber=True)
-        if sdb: dq_order_insert(order_file, sdb)
+        geometry = write_order_geometry(order_file, frame)
+        if sdb: dq_order_insert(order_file, sdb, geometry=geometry)
 
         if link:
             link='/salt/HRS_Cals/CAL_FLAT/{0}/{1}/product/{2}'.format(obsdate[0:4], obsdate[4:8], os.path.basename(outfile))
@@ -398,12 +564,18 @@ def hrsflat(rawpath, outpath, detname, obsmode, master_bias=None, f_limit=1000,
             print(outfile)
             print(link)
             os.symlink(outfile, link)
+            get_catalog('/salt/HRS_Cals/').add(link)
             olink='/salt/HRS_Cals/CAL_FLAT/{0}/{1}/product/{2}'.format(obsdate[0:4], obsdate[4:8], os.path.basename(order_file))
             if os.path.islink(olink) and clobber: os.remove(olink)
             os.symlink(order_file, olink)
+            get_catalog('/salt/HRS_Cals/').add(olink)
+            glink = geometry_file(olink)
+            if os.path.isfile(geometry_file(order_file)):
+                if os.path.islink(glink) and clobber: os.remove(glink)
+                os.symlink(geometry_file(order_file), glink)
 
 def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=None, master_order=None,
-           sol_dir=None,  link=False, sdb=None, clobber=True):
+           sol_dir=None,  link=False, sdb=None, nproc=0, geometry=None, image_list=None, clobber=True):
    """hrsarc processes the HRS Arc files.
 
    Parameters
@@ -420,6 +592,17 @@ def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=Non
    sdb: sdb_user.mysql
       SDB object to upload data quality
 
+   nproc: int
+      Number of processes used to solve the orders of each arc.  If 0, all
+      of the cpus are used
+
+   geometry: dict or None
+      Geometry of the orders of master_order from read_order_geometry
+
+   image_list: HeaderCollection or None
+      Summary of the raw frames.  If None, the headers of the frames in 
+      rawpath are read
+
    clobber: boolean
       Overwrite existing files
 
@@ -427,7 +610,7 @@ def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=Non
    """
    if not os.path.isdir(rawpath): return
 
-   image_list = ImageFileCollection(rawpath)
+   if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
    if len(image_list.files)==0: return
  
    #make output directory
@@ -448,11 +631,12 @@ def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=Non
       raise ValueError('detname must be a valid HRS Detector name')
 
    #process the arc frames
-   matches = (image_list.summary['obstype'] == 'Arc') * (image_list.summary['detnam'] == detname) * (image_list.summary['obsmode'] == obsmode ) * (image_list.summary['propid'] == 'CAL_ARC')
-   for fname in image_list.summary['file'][matches]: 
+   matches = image_list.select(obstype='Arc', detnam=detname, obsmode=obsmode, propid='CAL_ARC')
+   if sdb is not None: dq = DQAccumulator(sdb)
+   for fname in matches: 
         logging.info('Processing arc in {}'.format(fname))
         ccd  = process(rawpath+fname, masterbias=master_bias)
-        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb)
+        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb, dq=dq)
 
         #flat field the frame
         ccd=flatfield_science(ccd, master_flat, master_order, median_filter_size=None, interp=True)
@@ -461,7 +645,7 @@ def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=Non
         outfile = "{0}/p{1}".format(outpath, fname)
         ccd.write(outfile, clobber=True)
 
-        hrs_arc_process(ccd, master_order, sol_dir, outpath, sdb, filename=fname)
+        hrs_arc_process(ccd, master_order, sol_dir, outpath, sdb, filename=fname, nproc=nproc, geometry=geometry)
 
         if link:
             #link the individual file
@@ -470,9 +654,317 @@ def hrsarc(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=Non
                 link='/salt/HRS_Cals/CAL_ARC/{0}/{1}/product/{2}'.format(obsdate[0:4], obsdate[4:8], os.path.basename(db_file))
                 if os.path.islink(link) and clobber: os.remove(link)
                 os.symlink(db_file, link)
+                get_catalog('/salt/HRS_Cals/').add(link, mode=obsmode)
+
+   if sdb is not None: flush_dq(dq)
+
+def load_solutions(soldir):
+    """Read all of the wavelength solutions in soldir.  The solutions are only
+    read once for each directory
+
+    Parameters
+    ----------
+    soldir: str
+       Directory with the sol_<order>.pkl files for a mode
+
+    Returns
+    -------
+    solutions: dict
+       Dictionary of order: (shift_dict, ws)
+
+    """
+    if soldir not in _solution_cache:
+        solutions = {}
+        for sfile in glob.glob(soldir + 'sol_*.pkl'):
+            try:
+                n_order = int(os.path.basename(sfile)[4:-4])
+            except ValueError:
+                continue
+            solutions[n_order] = pickle.load(open(sfile))
+        _solution_cache[soldir] = solutions
+    return _solution_cache[soldir]
+
+def share_array(data):
+    """Copy an array into shared memory so it can be used by the processes of a 
+    pool without being copied to each of them
+
+    Returns
+    -------
+    shared: tuple
+       (shared memory, shape) 
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    raw = multiprocessing.RawArray(ctypes.c_double, int(data.size))
+    np.frombuffer(raw, dtype=np.float64)[:] = data.ravel()
+    return raw, data.shape
+
+def shared_array(shared):
+    """Return an array that uses the shared memory created by share_array"""
+    raw, shape = shared
+    return np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+def init_shared(arrays, values={}):
+    """Initialize a process of a pool with the shared arrays and other values"""
+    _shared.clear()
+    for k in arrays:
+        _shared[k] = shared_array(arrays[k])
+    _shared.update(values)
+
+def pool_size(nproc, ntasks):
+    """Number of processes to use for ntasks"""
+    if nproc is None or nproc < 1: nproc = multiprocessing.cpu_count()
+    #processes of a pool cannot start their own
+    if multiprocessing.current_process().daemon: nproc = 1
+    return max(1, min(nproc, ntasks))
+
+def order_index(order_data, flat_index=True):
+    """Index the pixels of each order in an order frame
+
+    Parameters
+    ----------
+    order_data: numpy.ndarray
+       Order frame where each pixel has the value of its order
+
+    flat_index: boolean
+       Include the indices of the pixels of each order
+
+    Returns
+    -------
+    index: dict
+       Dictionary of order: {'npix': number of pixels, 'bbox': (y_min, y_max, 
+       x_min, x_max), 'y_lower': first row of the order in each column, 
+       'y_upper': last row of the order in each column, 'index': indices of 
+       the pixels in the flattened frame}.  Columns without the order have
+       bounds of -1
+
+    """
+    ny, nx = order_data.shape
+    flat = order_data.ravel()
+    pixels = np.where(flat > 0)[0]
+    values = flat[pixels].astype(int)
+    isort = np.argsort(values, kind='mergesort')
+    pixels = pixels[isort]
+    values = values[isort]
+
+    index = {}
+    orders = np.unique(values)
+    starts = np.searchsorted(values, orders, side='left')
+    ends = np.searchsorted(values, orders, side='right')
+    for n_order, i1, i2 in zip(orders, starts, ends):
+        idx = pixels[i1:i2]
+        y = idx // nx
+        x = idx % nx
+        #the pixels are in row order, so the first pixel in each column has
+        #the lowest row and the last has the highest
+        y_lower = -np.ones(nx, dtype=np.int32)
+        y_upper = -np.ones(nx, dtype=np.int32)
+        cols, first = np.unique(x, return_index=True)
+        y_lower[cols] = y[first]
+        cols, last = np.unique(x[::-1], return_index=True)
+        y_upper[cols] = y[::-1][last]
+        index[int(n_order)] = {'npix': int(i2 - i1), 'y_lower': y_lower, 'y_upper': y_upper,
+                               'bbox': (int(y.min()), int(y.max()), int(x.min()), int(x.max()))}
+        if flat_index: index[int(n_order)]['index'] = idx
+    return index
+
+def geometry_file(order_file):
+    """Name of the file with the geometry of an order frame"""
+    return order_file.replace('.fits', '_geometry.npz')
+
+def write_order_geometry(order_file, order_data):
+    """Write the geometry of the orders next to the order frame
+
+    Parameters
+    ----------
+    order_file: str
+       Name of the order frame
+
+    order_data: numpy.ndarray
+       Data in the order frame
+
+    Returns
+    -------
+    index: dict
+       Geometry of the orders as returned by order_index
+
+    """
+    index = order_index(order_data, flat_index=False)
+    orders = np.array(sorted(index.keys()), dtype=np.int32)
+    ny, nx = order_data.shape
+    npix = np.array([index[n]['npix'] for n in orders], dtype=np.int64)
+    bbox = np.array([index[n]['bbox'] for n in orders], dtype=np.int32).reshape(len(orders), 4)
+    y_lower = np.array([index[n]['y_lower'] for n in orders], dtype=np.int16).reshape(len(orders), nx)
+    y_upper = np.array([index[n]['y_upper'] for n in orders], dtype=np.int16).reshape(len(orders), nx)
+    gfile = geometry_file(order_file)
+    tmpfile = '{}.{}.npz'.format(gfile[:-4], os.getpid())
+    try:
+        np.savez_compressed(tmpfile, shape=np.array([ny, nx]), orders=orders, npix=npix, bbox=bbox,
+                            y_lower=y_lower, y_upper=y_upper)
+        os.rename(tmpfile, gfile)
+    except (IOError, OSError), e:
+        logging.warning('Could not write {} because {}'.format(gfile, e))
+        if os.path.isfile(tmpfile): os.remove(tmpfile)
+    return index
+
+def read_order_geometry(order_file, order_data=None):
+    """Read the geometry of the orders of an order frame.  If the geometry
+    file does not exist or is older than the order frame, it is created
+
+    Parameters
+    ----------
+    order_file: str
+       Name of the order frame
+
+    order_data: numpy.ndarray or None
+       Data in the order frame if it has already been read
+
+    Returns
+    -------
+    index: dict
+       Geometry of the orders as returned by order_index without the
+       indices of the pixels
+
+    """
+    gfile = geometry_file(order_file)
+    if os.path.isfile(gfile) and os.path.getmtime(gfile) >= os.path.getmtime(order_file):
+        try:
+            geom = np.load(gfile)
+            index = {}
+            for i, n_order in enumerate(geom['orders']):
+                index[int(n_order)] = {'npix': int(geom['npix'][i]), 'bbox': tuple(int(b) for b in geom['bbox'][i]),
+                                       'y_lower': geom['y_lower'][i].astype(np.int32),
+                                       'y_upper': geom['y_upper'][i].astype(np.int32)}
+            geom.close()
+            return index
+        except (IOError, KeyError, ValueError), e:
+            logging.warning('Could not read {} because {}'.format(gfile, e))
+    if order_data is None: order_data = fits.getdata(order_file)
+    return write_order_geometry(order_file, order_data)
+
+def order_rows(index, n_order, ny, margin=2):
+    """Return the range of rows that contain an order
+
+    Returns
+    -------
+    rows: tuple
+       (first row, last row + 1) including margin rows on either side
+
+    """
+    y_min, y_max, x_min, x_max = index[n_order]['bbox']
+    return max(0, y_min - margin), min(ny, y_max + 1 + margin)
+
+#parameters for detect_cosmics for the science frames
+cosmic_params = dict(inmask=None, sigclip=4.5, sigfrac=0.3,
+                   objlim=5.0, gain=1.0, readnoise=6.5,
+                   satlevel=65536.0, pssl=0.0, niter=4,
+                   sepmed=True, cleantype='meanmask', fsmode='median',
+                   psfmodel='gauss', psffwhm=2.5, psfsize=7,
+                   psfk=None, psfbeta=4.765, verbose=False)
+
+def cosmic_tiles(shape, tile_size, overlap):
+    """Split a frame into tiles
+
+    Returns
+    -------
+    tiles: list
+       List of (core, padded) where each is (y1, y2, x1, x2).  The core tiles
+       cover the frame without overlapping and each padded tile extends its
+       core by overlap pixels on each side
+
+    """
+    ny, nx = shape
+    tiles = []
+    for y1 in range(0, ny, tile_size):
+        for x1 in range(0, nx, tile_size):
+            y2 = min(ny, y1 + tile_size)
+            x2 = min(nx, x1 + tile_size)
+            padded = (max(0, y1 - overlap), min(ny, y2 + overlap), max(0, x1 - overlap), min(nx, x2 + overlap))
+            tiles.append(((y1, y2, x1, x2), padded))
+    return tiles
+
+def clean_tile(data, tile, params):
+    """Run detect_cosmics on a padded tile and return the core of the tile
+
+    Returns
+    -------
+    crmask, cleanarr: numpy.ndarray
+       Cosmic ray mask and cleaned data of the core of the tile
+
+    """
+    (y1, y2, x1, x2), (py1, py2, px1, px2) = tile
+    crmask, cleanarr = detect_cosmics(np.array(data[py1:py2, px1:px2]), **params)
+    core = (slice(y1 - py1, y2 - py1), slice(x1 - px1, x2 - px1))
+    return crmask[core], cleanarr[core]
+
+def clean_tile_task(tile):
+    """Clean a tile of the frame in _shared for a process of a pool"""
+    crmask, cleanarr = clean_tile(_shared['data'], tile, _shared['params'])
+    return tile, crmask, cleanarr
+
+def tiled_detect_cosmics(data, order_data=None, tile_size=1024, overlap=32, nproc=0, **params):
+    """Remove the cosmic rays from a frame by running detect_cosmics on 
+    overlapping tiles in parallel and stitching the results together
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+       Frame to clean
 
-def extract_arc(arc, order_frame, n_order, soldir, target=True, flux_limit=100):
-    shift_dict, ws = pickle.load(open(soldir+'sol_%i.pkl' % n_order))
+    order_data: numpy.ndarray or None
+       If given, tiles without any pixels in an order are not cleaned
+
+    tile_size: int
+       Size of the tiles
+
+    overlap: int
+       Number of pixels the tiles overlap on each side, so the cleaning at 
+       the edge of each tile is the same as for the whole frame
+
+    nproc: int
+       Number of processes.  If 0, all of the cpus are used
+
+    params:
+       Parameters for detect_cosmics
+
+    Returns
+    -------
+    crmask: numpy.ndarray
+       Mask of the cosmic rays
+
+    cleanarr: numpy.ndarray
+       Cleaned frame
+
+    """
+    tiles = cosmic_tiles(data.shape, tile_size, overlap)
+    if order_data is not None:
+        tiles = [t for t in tiles if (order_data[t[0][0]:t[0][1], t[0][2]:t[0][3]] > 0).any()]
+
+    crmask = np.zeros(data.shape, dtype=bool)
+    cleanarr = np.array(data, dtype=np.float32)
+
+    nproc = pool_size(nproc, len(tiles))
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=init_shared, 
+                                    initargs=({'data': share_array(data)}, {'params': params}))
+        try:
+            results = pool.map(clean_tile_task, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [(tile,) + clean_tile(data, tile, params) for tile in tiles]
+
+    for tile, tmask, tclean in results:
+        y1, y2, x1, x2 = tile[0]
+        crmask[y1:y2, x1:x2] = tmask
+        cleanarr[y1:y2, x1:x2] = tclean
+    return crmask, cleanarr
+
+def extract_arc(arc, order_frame, n_order, soldir, target=True, flux_limit=100, solution=None):
+    if solution is None:
+        solution = pickle.load(open(soldir+'sol_%i.pkl' % n_order))
+    shift_dict, ws = solution
     hrs = HRSOrder(n_order)
     hrs.set_order_from_array(order_frame.data)
     hrs.set_flux_from_array(arc.data, flux_unit=arc.unit)
@@ -521,8 +1013,7 @@ def dq_arc(sdb, ws, n_order, filename, obsmode='HIGH RESOLUTION', fiber='obj'):
        Object=0
 
     # get the filedata ID
-    logic="FileName='{}'".format(os.path.basename(filename))
-    FileData_Id = sdb.select('FileData_Id','FileData',logic)[0][0]
+    FileData_Id = sdb.query('SELECT FileData_Id FROM FileData WHERE FileName=%s', (os.path.basename(filename),))[0][0]
 
     # get the default frames for a given mode
     if os.path.basename(filename).startswith('H'):
@@ -532,13 +1023,15 @@ def dq_arc(sdb, ws, n_order, filename, obsmode='HIGH RESOLUTION', fiber='obj'):
 
     # get the x, w values for the nominal frame
     try:
-       results = sdb.select('X, wavelength', 'DQ_HrsArc', 'FileData_Id={} and HrsOrder={} and Object={}'.format(default_arcfile_dict[obsmode], n_order, Object))
+       results = sdb.query('SELECT X, wavelength FROM DQ_HrsArc WHERE FileData_Id=%s and HrsOrder=%s and Object=%s',
+                           (default_arcfile_dict[obsmode], int(n_order), Object))
        x=np.array(results)[:,0].astype(float)
        w=np.array(results)[:,1].astype(float)
     except:
        x = None
        w = None
 
+    rows = []
     for i in range(len(ws.x)):
         if abs(ws.wavelength[i]-ws(ws.x[i])) > 0.05: continue
         try:
@@ -546,18 +1039,94 @@ def dq_arc(sdb, ws, n_order, filename, obsmode='HIGH RESOLUTION', fiber='obj'):
            dx = ws.x[i]-x[j][0]
         except:
            dx = -99.99
-        ins_cmd = 'FileData_Id={fid}, HrsOrder={n_order}, x={x}, wavelength={wavelength}, DeltaX={dx}, Object={Object} ON DUPLICATE KEY UPDATE  wavelength={wavelength}, DeltaX={dx}, Object={Object};'.format(fid=FileData_Id, n_order=n_order, x=ws.x[i], wavelength=ws.wavelength[i], dx=dx, Object=Object)
-        sdb.insert(ins_cmd, 'DQ_HrsArc')
+        rows.append((FileData_Id, int(n_order), float(ws.x[i]), float(ws.wavelength[i]), float(dx), Object))
+
+    #all of the lines are written in one statement
+    sdb.executemany('INSERT INTO DQ_HrsArc (FileData_Id, HrsOrder, x, wavelength, DeltaX, Object) '
+                    'VALUES (%s, %s, %s, %s, %s, %s) '
+                    'ON DUPLICATE KEY UPDATE wavelength=VALUES(wavelength), DeltaX=VALUES(DeltaX), Object=VALUES(Object)',
+                    rows)
 
 
 
-def hrs_arc_process(arc, master_order, soldir, outpath, sdb=None, link=False, filename=None):
+def solve_arc_order(arc, master_order, n_order, solution, target_fiber):
+    """Match the lines in a single order of an arc and find the wavelength solution
+
+    Returns
+    -------
+    ws: WavelengthSolution.WavelengthSolution
+       Wavelength solution of the order before it is fit
+
+    sh: dict
+       Shift of each row of the order
+
+    """
+    x, w, f, ws, sh = extract_arc(arc, master_order, n_order, None, target=target_fiber,
+                                  solution=solution)
+    m_arr = ws_match_lines(x, f, ws, dw=1.0, kernal_size=3)
+    m, prob = match_probability(m_arr[:,1], m_arr[:,2],
+                    m_init=mod.models.Polynomial1D(1),
+                    fitter=mod.fitting.LinearLSQFitter(),
+                    tol=0.02, n_iter=5)
+    ws = WavelengthSolution.WavelengthSolution(m_arr[:,0][prob>0.1],
+                                       m_arr[:,2][prob>0.1],
+                                       ws.model)
+    return ws, sh
+
+def solve_arc_task(task):
+    """Solve an order of the arc in _shared for a process of a pool
+
+    task: (n_order, target_fiber)
+
+    returns (n_order, target_fiber, ws, sh, error)
+    """
+    n_order, target_fiber = task
+    arc = CCDData(_shared['arc'], unit=_shared['unit'])
+    master_order = CCDData(_shared['order'], unit=u.electron)
+    try:
+        ws, sh = solve_arc_order(arc, master_order, n_order, _shared['solutions'][n_order], target_fiber)
+    except Exception, e:
+        return n_order, target_fiber, None, None, str(e)
+    return n_order, target_fiber, ws, sh, None
+
+def hrs_arc_process(arc, master_order, soldir, outpath, sdb=None, link=False, filename=None, nproc=0,
+                    geometry=None):
     """process an hrs arc
+
+    The orders of both fibres are solved in parallel with nproc processes
+    (all of the cpus if nproc is 0).  The arc and order frame are shared with
+    the processes rather than copied to each of them.  If the geometry of the
+    orders is not given, it is found from master_order.
     """
     arm, xpos, target, res, w_c, y1, y2 = mode_setup_information(arc.header)
 
-    n_min = master_order.data[master_order.data>0].min()
-    n_max = master_order.data.max()
+    solutions = load_solutions(soldir)
+    if geometry is None: geometry = order_index(master_order.data, flat_index=False)
+    n_min = min(geometry)
+    n_max = max(geometry)
+    n_present = set(geometry.keys())
+    orders = [int(n) for n in np.arange(n_min, n_max) if int(n) in solutions and int(n) in n_present]
+
+    tasks = [(n_order, target_fiber) for target_fiber in [True, False] for n_order in orders]
+    nproc = pool_size(nproc, len(tasks))
+    if nproc > 1:
+        arrays = {'arc': share_array(arc.data), 'order': share_array(master_order.data)}
+        values = {'unit': arc.unit, 'solutions': solutions}
+        pool = multiprocessing.Pool(nproc, initializer=init_shared, initargs=(arrays, values))
+        try:
+            results = pool.map(solve_arc_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for n_order, target_fiber in tasks:
+            try:
+                ws, sh = solve_arc_order(arc, master_order, n_order, solutions[n_order], target_fiber)
+                results.append((n_order, target_fiber, ws, sh, None))
+            except Exception, e:
+                results.append((n_order, target_fiber, None, None, str(e)))
+
     ws_dict = {}
     for target_fiber in [True, False]:
         if target_fiber:
@@ -571,22 +1140,11 @@ def hrs_arc_process(arc, master_order, soldir, outpath, sdb=None, link=False, fi
             else:
                targ_ext = 'sky'
        
-        for n_order in np.arange(n_min, n_max):
-            if not os.path.isfile(soldir+'sol_%i.pkl' % n_order): continue
-            if (master_order.data==n_order).sum()==0: continue
-            try:
-                x, w, f, ws, sh = extract_arc(arc, master_order, int(n_order), soldir, target=target_fiber)
-                m_arr = ws_match_lines(x, f, ws, dw=1.0, kernal_size=3)
-                m, prob = match_probability(m_arr[:,1], m_arr[:,2],
-                                m_init=mod.models.Polynomial1D(1),
-                                fitter=mod.fitting.LinearLSQFitter(),
-                                tol=0.02, n_iter=5)
-            except Exception, e:
-                logging.warning(str(e))
+        for n_order, fiber, ws, sh, error in results:
+            if fiber != target_fiber: continue
+            if error is not None:
+                logging.warning(error)
                 continue
-            ws = WavelengthSolution.WavelengthSolution(m_arr[:,0][prob>0.1],
-                                               m_arr[:,2][prob>0.1],
-                                               ws.model)
             if sdb: dq_arc(sdb, ws, n_order, filename)
             ws.fit()
             ws_dict[n_order] = (ws, sh)
@@ -595,70 +1153,94 @@ def hrs_arc_process(arc, master_order, soldir, outpath, sdb=None, link=False, fi
 
 def get_arc(obsdate, prefix, mode=None, cal_dir='/salt/HRS_Cals/', nlim=180, sdb=None):
     """Find Arc solution closest in date
-    """
-    start_date = dt.datetime.strptime('{} 12:00:00'.format(obsdate), '%Y%m%d %H:%M:%S')
-
-    def get_name(start_date, i, cal_dir, prefix, mode):
-        date = start_date + dt.timedelta(seconds=i*24*3600.0)
-        obsdate = date.strftime('%Y%m%d')
-        cdir = '{cal_dir}CAL_ARC/{year}/{mmdd}/product/'.format(
-           cal_dir=cal_dir, year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix, mode=mode)
 
+    The arcs within nlim days are taken from the calibration catalog and
+    the products of the current night.  The modes of the arcs that are not
+    already known are found with a single query to the database.
+    """
+    catalog = get_catalog(cal_dir)
+    day = date_ordinal(obsdate)
+
+    #solutions in the current directory are used before those in cal_dir
+    cal_files = {}
+    for cfile in catalog.candidates(obsdate, 'ARC', prefix, nlim=nlim):
+        cal_files[os.path.basename(cfile)] = cfile
+    for cfile in glob.glob('hrs/product/dbp{}*_obj.pkl'.format(prefix)):
+        info = parse_product(cfile)
+        if info is None or abs(date_ordinal(info[3]) - day) >= nlim: continue
+        cal_files[os.path.basename(cfile)] = cfile
+
+    #the closest in date, with the later date first if two are equally close
+    def distance(name):
+        d = date_ordinal(parse_product(name)[3]) - day
+        return (abs(d), -d, name)
+    names = sorted(cal_files.keys(), key=distance)
+
+    modes = {}
+    for name in names:
+        if catalog.get_mode(cal_files[name]): modes[name] = catalog.get_mode(cal_files[name])
+
+    unknown = [name for name in names if name not in modes]
+    if unknown and sdb is not None:
         tab_cmd = 'FileData join ProposalCode using (ProposalCode_Id) join FitsHeaderImage using (FileData_Id)'
-        log_cmd = "FileName like '{prefix}{obsdate}%' and FileData.OBSMODE='{obsmode}' and Proposal_Code = 'CAL_ARC'" .format(prefix=prefix, obsmode=mode, obsdate=obsdate)
-
-        record = sdb.select('FileName', tab_cmd, log_cmd)
-        if record == (): return None
-        cfile = cdir + 'dbp'+record[0][0].replace('.fits', '_obj.pkl')
-        if os.path.isfile('hrs/product/{}'.format(os.path.basename(cfile))): return 'hrs/product/{}'.format(os.path.basename(cfile))
-        if os.path.isfile(cfile): return cfile
-
-        return None
-
-
-    for i in range(nlim):
-        #look into the past
-        cfile = get_name(start_date, i,  cal_dir, prefix, mode)
-        if cfile: return cfile
-        #look into the future
-        cfile = get_name(start_date, -i,  cal_dir, prefix, mode)
-        if cfile: return cfile
+        filenames = ','.join(["'{}'".format(name[3:].replace('_obj.pkl', '.fits')) for name in unknown])
+        log_cmd = "FileName in ({}) and Proposal_Code = 'CAL_ARC'".format(filenames)
+        for fname, arc_mode in sdb.select('FileName, FileData.OBSMODE', tab_cmd, log_cmd):
+            name = 'dbp' + fname.replace('.fits', '_obj.pkl')
+            modes[name] = arc_mode.strip().upper().replace(' ', '_')
+            catalog.set_mode(cal_files[name], arc_mode)
+        catalog.save()
+
+    mode = mode.strip().upper().replace(' ', '_')
+    for name in names:
+        if modes.get(name) != mode: continue
+        if os.path.isfile(cal_files[name]): return cal_files[name]
 
     return None
 
 
-def run_hrsflat(obsdate, rawpath, outpath, sdb=None, nlim=180, link=True):
-    """Run the flat fields"""
+def run_hrsflat(obsdate, rawpath, outpath, sdb=None, nlim=180, link=True, image_list=None):
+    """Run the flat fields.  Only the modes with flat fields are processed"""
+    if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
+    flats = image_list.view(obstype='Flat field', exclude={'propid':'JUNK'})
 
     # process the red flat fields
     prefix = 'R'
-    mccd =  get_hrs_calibration_frame(obsdate, prefix, 'BIAS',  mode=None, cal_dir='/salt/HRS_Cals/', nlim=nlim)
-    logging.info('Using {} for the Master Bias frame'.format(mccd))
-    masterbias = CCDData.read(mccd, units=u.adu)
-    for obsmode in ['HIGH STABILITY', 'LOW RESOLUTION', 'MEDIUM RESOLUTION', 'HIGH RESOLUTION']:
+    if len(flats.view(detnam='HRDET')):
+        mccd =  get_hrs_calibration_frame(obsdate, prefix, 'BIAS',  mode=None, cal_dir='/salt/HRS_Cals/', nlim=nlim)
+        logging.info('Using {} for the Master Bias frame'.format(mccd))
+        masterbias = CCDData.read(mccd, units=u.adu)
+    for obsmode in hrs_modes:
+        mode_list = flats.view(detnam='HRDET', obsmode=obsmode)
+        if len(mode_list) == 0: continue
         hrsflat(rawpath, outpath, detname='HRDET', obsmode=obsmode,  master_bias=masterbias,
                 first_order=53, y_start=4, y_limit=3920, smooth_length=20, smooth_fraction=0.4, filter_size=151,
-                clobber=True, sdb=sdb, link=link)
+                clobber=True, sdb=sdb, link=link, image_list=mode_list)
 
     #process blue flat fields
     prefix = 'H'
-    mccd =  get_hrs_calibration_frame(obsdate, prefix, 'BIAS',  mode=None, cal_dir='/salt/HRS_Cals/', nlim=nlim)
-    logging.info('Using {} for the Master Bias frame'.format(mccd))
-    masterbias = CCDData.read(mccd, units=u.adu)
-    for obsmode in ['HIGH STABILITY', 'LOW RESOLUTION', 'MEDIUM RESOLUTION', 'HIGH RESOLUTION']:
+    if len(flats.view(detnam='HBDET')):
+        mccd =  get_hrs_calibration_frame(obsdate, prefix, 'BIAS',  mode=None, cal_dir='/salt/HRS_Cals/', nlim=nlim)
+        logging.info('Using {} for the Master Bias frame'.format(mccd))
+        masterbias = CCDData.read(mccd, units=u.adu)
+    for obsmode in hrs_modes:
+        mode_list = flats.view(detnam='HBDET', obsmode=obsmode)
+        if len(mode_list) == 0: continue
         filter_size = 101
         if obsmode == 'LOW RESOLUTION': filter_size = 131
         try:
            hrsflat(rawpath, outpath, detname='HBDET', obsmode=obsmode,  master_bias=masterbias,
                 first_order=84, y_start=30, y_limit=3884, smooth_length=20, smooth_fraction=0.4, filter_size=filter_size,
-                clobber=True, sdb=sdb, link=link)
+                clobber=True, sdb=sdb, link=link, image_list=mode_list)
         except ValueError:
            hrsflat(rawpath, outpath, detname='HBDET', obsmode=obsmode,  master_bias=masterbias,
                 first_order=84, y_start=30, y_limit=3884, smooth_length=20, smooth_fraction=0.4, filter_size=101,
-                clobber=True, sdb=sdb, link=link)
+                clobber=True, sdb=sdb, link=link, image_list=mode_list)
 
-def run_hrsarcs(obsdate, rawpath, outpath,  nlim=180, sdb=None, link=True):
-    """Run HRS arc frames"""
+def run_hrsarcs(obsdate, rawpath, outpath,  nlim=180, sdb=None, link=True, image_list=None):
+    """Run HRS arc frames.  Only the modes with arcs are processed"""
+    if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
+    arcs = image_list.view(obstype='Arc', propid='CAL_ARC')
 
     mode_dict={}
     mode_dict['LOW RESOLUTION']='lr'
@@ -670,12 +1252,15 @@ def run_hrsarcs(obsdate, rawpath, outpath,  nlim=180, sdb=None, link=True):
     for prefix in ['R', 'H']:
        if prefix == 'R': detname='HRDET'
        if prefix == 'H': detname='HBDET'
+       if len(arcs.view(detnam=detname)) == 0: continue
 
        mccd =  get_hrs_calibration_frame(obsdate, prefix, 'BIAS',  mode=None, cal_dir='/salt/HRS_Cals/', nlim=nlim)
        logging.info('Using {} for the Master Bias frame'.format(mccd))
        masterbias = CCDData.read(mccd)
 
-       for obsmode in ['HIGH STABILITY', 'LOW RESOLUTION', 'MEDIUM RESOLUTION', 'HIGH RESOLUTION']: 
+       for obsmode in hrs_modes: 
+           mode_list = arcs.view(detnam=detname, obsmode=obsmode)
+           if len(mode_list) == 0: continue
 
            mccd =  get_hrs_calibration_frame(obsdate, prefix, 'FLAT', mode=obsmode.replace(' ', '_'), cal_dir='/salt/HRS_Cals/', nlim=nlim)
            logging.info('Using {} for the {} flat frame'.format(mccd, obsmode.lower()))
@@ -684,20 +1269,30 @@ def run_hrsarcs(obsdate, rawpath, outpath,  nlim=180, sdb=None, link=True):
            mccd =  get_hrs_calibration_frame(obsdate, prefix, 'ORDER', mode=obsmode.replace(' ', '_'), cal_dir='/salt/HRS_Cals/', nlim=nlim)
            logging.info('Using {} for the {} order frame'.format(mccd, obsmode.lower()))
            masterorder = CCDData.read(mccd, unit=u.electron)
+           geometry = read_order_geometry(mccd, masterorder.data)
 
            hrsarc(rawpath, outpath, detname=detname, obsmode=obsmode,  master_bias=masterbias,
                   master_flat=masterflat, master_order=masterorder, sol_dir='/home/sa/smc/hrs/{}/'.format(mode_dict[obsmode]),
-                  sdb=sdb, link=link, clobber=True)
+                  sdb=sdb, link=link, geometry=geometry, image_list=mode_list, clobber=True)
 
 
 
-def run_science(obsdate, rawpath, outpath, sdb=None, link=True, symdir='./', nlim=180, mfs=11):
-        #process bias frames
+def run_science(obsdate, rawpath, outpath, sdb=None, link=True, symdir='./', nlim=180, mfs=11, image_list=None,
+                nproc=0, cr_tile_size=0, cr_overlap=32, cr_skip_empty=False):
+        """Run the science frames.  Only the modes with science frames are processed.
+           nproc is the number of processes used to extract the orders of each
+           frame.  If 0, all of the cpus are used.  cr_tile_size, cr_overlap 
+           and cr_skip_empty set how the cosmic rays are cleaned and are 
+           described in hrsscience
+        """
+        if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
+        science = image_list.view(obstype='Science', exclude={'propid':'JUNK'})
 
         #process arc frames
         for prefix in ['R', 'H']:
            if prefix == 'R': detname='HRDET'
            if prefix == 'H': detname='HBDET'
+           if len(science.view(detnam=detname)) == 0: continue
            mccd = 'hrs/product/{prefix}{cal_type}_{year}{mmdd}.fits'.format(
                   cal_type="BIAS", year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix)
            if not os.path.isfile(mccd):
@@ -705,6 +1300,8 @@ def run_science(obsdate, rawpath, outpath, sdb=None, link=True, symdir='./', nli
            logging.info('Using {} for a bias file'.format(mccd))
            masterbias = CCDData.read(mccd)
            for obsmode in ['HIGH STABILITY', 'MEDIUM RESOLUTION', 'HIGH RESOLUTION', 'LOW RESOLUTION']:
+               mode_list = science.view(detnam=detname, obsmode=obsmode)
+               if len(mode_list) == 0: continue
                mccd = 'hrs/product/{prefix}{cal_type}_{year}{mmdd}_{mode}.fits'.format(
                       cal_type="FLAT", year=obsdate[0:4], mmdd=obsdate[4:8], prefix=prefix, mode=obsmode.replace(' ', '_'))
                if not os.path.isfile(mccd):
@@ -720,6 +1317,7 @@ def run_science(obsdate, rawpath, outpath, sdb=None, link=True, symdir='./', nli
                    mccd =  get_hrs_calibration_frame(obsdate, prefix, 'ORDER', mode=obsmode.replace(' ', '_'), cal_dir='/salt/HRS_Cals/', nlim=nlim)
                logging.info('Using {} for an {} order file'.format(mccd, obsmode.lower()))
                masterorder = CCDData.read(mccd, unit=u.electron)
+               geometry = read_order_geometry(mccd, masterorder.data)
                marc = get_arc(obsdate, prefix, mode=obsmode, cal_dir='/salt/HRS_Cals/', nlim=180, sdb=sdb)
                logging.info('Using {} for an {} object arc file'.format(marc, obsmode.lower()))
                arc_dict={}
@@ -732,13 +1330,16 @@ def run_science(obsdate, rawpath, outpath, sdb=None, link=True, symdir='./', nli
                if int(obsdate) < 20161107 and prefix=='H': masterbias=None
                hrsscience(rawpath, outpath, detname=detname, obsmode=obsmode,  master_bias=masterbias,
                   master_flat=masterflat, master_order=masterorder, arc_dict = arc_dict, median_filter_size=mfs,
-                  sdb=sdb, symdir=symdir, link=link, clobber=True)
+                  sdb=sdb, symdir=symdir, link=link, nproc=nproc, geometry=geometry, 
+                  cr_tile_size=cr_tile_size, cr_overlap=cr_overlap, cr_skip_empty=cr_skip_empty,
+                  image_list=mode_list, clobber=True)
 
     
 
 def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat=None, 
                master_order=None, median_filter_size=11, 
-               arc_dict=None,  sdb=None, symdir='./', link=False, clobber=True):
+               arc_dict=None,  sdb=None, symdir='./', link=False, nproc=1, geometry=None, 
+               cr_tile_size=0, cr_overlap=32, cr_skip_empty=False, image_list=None, clobber=True):
    """hrsscience processes the HRS science files.
 
    Parameters
@@ -758,6 +1359,27 @@ def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat
    link: boolean
       Link data to their proposals
 
+   nproc: int
+      Number of processes used to extract the orders of each frame.  If 0,
+      all of the cpus are used
+
+   geometry: dict or None
+      Geometry of the orders of master_order from read_order_geometry
+
+   cr_tile_size: int
+      If greater than 0, the cosmic rays are removed in tiles of this size
+      with nproc processes.  Otherwise the whole frame is cleaned at once
+
+   cr_overlap: int
+      Number of pixels that the tiles overlap
+
+   cr_skip_empty: boolean
+      Do not clean the tiles that do not contain any pixels in an order
+
+   image_list: HeaderCollection or None
+      Summary of the raw frames.  If None, the headers of the frames in 
+      rawpath are read
+
    clobber: boolean
       Overwrite existing files
 
@@ -766,7 +1388,7 @@ def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat
    print(os.getcwd())
    if not os.path.isdir(rawpath): return
 
-   image_list = ImageFileCollection(rawpath)
+   if image_list is None: image_list = HeaderCollection(rawpath, keywords=summary_keywords)
    if len(image_list.files)==0: return
  
    #make output directory
@@ -795,19 +1417,22 @@ def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat
       overscan_correct=False
 
    #process the arc frames
-   matches = (image_list.summary['obstype'] == 'Science') * (image_list.summary['detnam'] == detname) * (image_list.summary['obsmode'] == obsmode )  * (image_list.summary['propid'] != 'JUNK')
-   for fname in image_list.summary['file'][matches]: 
+   matches = image_list.select(obstype='Science', detnam=detname, obsmode=obsmode, exclude={'propid':'JUNK'})
+   if sdb is not None: dq = DQAccumulator(sdb)
+   index = geometry
+   for fname in matches: 
         logging.info('Reducing {}'.format(fname))
         ccd = process(rawpath+fname, masterbias=master_bias, oscan_correct=overscan_correct, error=True, rdnoise=rdnoise)
-        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb)
+        if sdb is not None: dq_ccd_insert(rawpath + fname, sdb, dq=dq)
 
         #cosmic ray clean the data
-        crmask, cleanarr = detect_cosmics(ccd.data, inmask=None, sigclip=4.5, sigfrac=0.3,
-                   objlim=5.0, gain=1.0, readnoise=6.5,
-                   satlevel=65536.0, pssl=0.0, niter=4,
-                   sepmed=True, cleantype='meanmask', fsmode='median',
-                   psfmodel='gauss', psffwhm=2.5, psfsize=7,
-                   psfk=None, psfbeta=4.765, verbose=False)
+        if cr_tile_size > 0:
+            order_data = None
+            if cr_skip_empty and master_order is not None: order_data = master_order.data
+            crmask, cleanarr = tiled_detect_cosmics(ccd.data, order_data=order_data, tile_size=cr_tile_size,
+                                                    overlap=cr_overlap, nproc=nproc, **cosmic_params)
+        else:
+            crmask, cleanarr = detect_cosmics(ccd.data, **cosmic_params)
         ccd.data = cleanarr
         if ccd.mask == None:
            ccd.mask = crmask
@@ -821,7 +1446,10 @@ def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat
         outfile = "{0}/p{1}".format(outpath, fname)
         ccd.write(outfile, clobber=True)
 
-        hrs_science_process(ccd, master_order, arc_dict, outpath, p_order=7, sdb=sdb, filename=fname, interp=True)
+        #the order frame is the same for all of the frames
+        if index is None: index = order_index(master_order.data, flat_index=False)
+        hrs_science_process(ccd, master_order, arc_dict, outpath, p_order=7, sdb=sdb, filename=fname, interp=True,
+                            index=index, nproc=nproc)
 
         if link:
             if ccd.header['PROPID'] == 'JUNK': continue
@@ -850,36 +1478,110 @@ def hrsscience(rawpath, outpath, detname, obsmode, master_bias=None, master_flat
                    if os.path.islink(link) and clobber: os.remove(link)
                    os.symlink(sfile, link)
 
+   if sdb is not None: flush_dq(dq)
+
         
-def hrs_science_process(ccd, master_order, arc_dict, outpath, p_order=7, interp=False, sdb=None, filename=None):
+def science_fiber(target, targ_ext):
+    """Return True if targ_ext is observed with the upper fiber"""
+    if target == 'upper' and targ_ext=='obj':  fiber = True
+    if target == 'upper' and targ_ext=='sky':  fiber = False
+    if target == 'lower' and targ_ext=='obj':  fiber = False 
+    if target == 'lower' and targ_ext=='sky':  fiber = True 
+    return fiber
+
+def extract_science_order(ccd, master_order, n_order, rows, ws, shift, y1, y2, fiber, interp):
+    """Extract a single order from the rows of the frame that contain it
+
+    Returns
+    -------
+    spectrum: list or None
+       [wavelength, flux, error, sky] or None if the order could not be extracted
+
+    """
+    ya, yb = rows
+    try:
+       w, f, e, fs  = extract_order(ccd[ya:yb, :], master_order[ya:yb, :], int(n_order), ws, shift, y1=y1, y2=y2, 
+                                    order=None, target=fiber, interp=interp)
+    except:
+       return None
+    return [w, f, e, fs]
+
+def extract_science_task(task):
+    """Extract an order from the science frame in _shared for a process of a pool
+
+    task: (targ_ext, n_order, rows, ws, shift, fiber)
+
+    returns (targ_ext, n_order, spectrum)
+    """
+    targ_ext, n_order, rows, ws, shift, fiber = task
+    uncertainty = None
+    if 'uncertainty' in _shared: uncertainty = _shared['uncertainty_type'](_shared['uncertainty'])
+    mask = None
+    if 'mask' in _shared: mask = _shared['mask'] > 0
+    ccd = CCDData(_shared['data'], unit=_shared['unit'], meta=_shared['header'], uncertainty=uncertainty, mask=mask)
+    master_order = CCDData(_shared['order'], unit=u.electron)
+    spectrum = extract_science_order(ccd, master_order, n_order, rows, ws, shift, _shared['y1'], _shared['y2'], 
+                                     fiber, _shared['interp'])
+    return targ_ext, n_order, spectrum
+
+def hrs_science_process(ccd, master_order, arc_dict, outpath, p_order=7, interp=False, sdb=None, filename=None,
+                        index=None, nproc=1):
     """process an hrs science frame
 
     Parameters
     ----------
     p_order: int
        Order of polynomical for normalization
+
+    index: dict or None
+       Index of the pixels in each order of master_order from order_index or
+       read_order_geometry.  If None, it is created from master_order
+
+    nproc: int
+       Number of processes used to extract the orders.  If 0, all of the cpus
+       are used
     """
     arm, xpos, target, res, w_c, y1, y2 = mode_setup_information(ccd.header)
 
-    n_min = master_order.data[master_order.data>0].min()
-    n_max = master_order.data.max()
-    
+    if index is None: index = order_index(master_order.data, flat_index=False)
+    ny = master_order.data.shape[0]
+
+    #extract all of the orders of both fibers
+    tasks = []
+    for targ_ext in ['sky', 'obj']:
+        fiber = science_fiber(target, targ_ext)
+        for n_order in arc_dict[targ_ext]:
+            if int(n_order) not in index: continue
+            ws, shift = arc_dict[targ_ext][n_order]
+            tasks.append((targ_ext, n_order, order_rows(index, int(n_order), ny), ws, shift, fiber))
+
+    nproc = pool_size(nproc, len(tasks))
+    if nproc > 1:
+        arrays = {'data': share_array(ccd.data), 'order': share_array(master_order.data)}
+        values = {'unit': ccd.unit, 'header': ccd.header, 'y1': y1, 'y2': y2, 'interp': interp}
+        if ccd.uncertainty is not None:
+            arrays['uncertainty'] = share_array(ccd.uncertainty.array)
+            values['uncertainty_type'] = ccd.uncertainty.__class__
+        if ccd.mask is not None:
+            arrays['mask'] = share_array(ccd.mask)
+        pool = multiprocessing.Pool(nproc, initializer=init_shared, initargs=(arrays, values))
+        try:
+            results = pool.map(extract_science_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for targ_ext, n_order, rows, ws, shift, fiber in tasks:
+            spectrum = extract_science_order(ccd, master_order, n_order, rows, ws, shift, y1, y2, fiber, interp)
+            results.append((targ_ext, n_order, spectrum))
 
     for targ_ext in ['sky', 'obj']:
         sp_dict = {}
-        if target == 'upper' and targ_ext=='obj':  fiber = True
-        if target == 'upper' and targ_ext=='sky':  fiber = False
-        if target == 'lower' and targ_ext=='obj':  fiber = False 
-        if target == 'lower' and targ_ext=='sky':  fiber = True 
+        fiber = science_fiber(target, targ_ext)
         logging.info('Extracting {} spectra using the {} fiber in {}'.format(targ_ext, 'upper' if fiber else 'lower', filename))
-        for n_order in arc_dict[targ_ext]:
-            if (master_order.data==n_order).sum()==0: continue
-            try:
-               ws, shift = arc_dict[targ_ext][n_order]
-               w, f, e, fs  = extract_order(ccd, master_order, int(n_order), ws, shift, y1=y1, y2=y2, order=None, target=fiber, interp=interp)
-               sp_dict[n_order] = [w,f, e, fs]
-            except:
-               pass
+        for ext, n_order, spectrum in results:
+            if ext == targ_ext and spectrum is not None: sp_dict[n_order] = spectrum
        
         if filename is not None:
             outfile = outpath + 'p' +filename.replace('.fits', '_{}.fits'.format(targ_ext))
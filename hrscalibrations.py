@@ -25,6 +25,7 @@ from pyraf import iraf
 import salttime
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
 from saltsafelog import logging
 from salterror import SaltError
 
@@ -49,7 +50,7 @@ def hrscalibrations(obsdate, sdbhost='sdb.saao', sdbname='sdb', \
        log.message('Sorting HRS calibration data')
 
        #connect to the database
-       sdb=saltmysql.connectdb(sdbhost,sdbname,sdbuser,password)
+       sdb=saltdbpool.connectdb(sdbhost,sdbname,sdbuser,password)
 
        #first select propcodes for all HRS data from that day and check for any CAL data
        table='FileData join ProposalCode using (ProposalCode_Id)' 
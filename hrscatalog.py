@@ -0,0 +1,323 @@
+################################# LICENSE ##################################
+# Copyright (c) 2015, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+#!/usr/bin/env python
+
+"""
+HRSCATALOG keeps a catalog of the HRS calibration products in the HRS_Cals
+directory so that the calibration closest in date to an observation can be
+found without searching the directory one night at a time.
+
+The products are found in the directories
+
+   CAL_BIAS/YYYY/MMDD/product/{prefix}BIAS_{YYYYMMDD}.fits
+   CAL_FLAT/YYYY/MMDD/product/{prefix}FLAT_{YYYYMMDD}_{mode}.fits
+   CAL_FLAT/YYYY/MMDD/product/{prefix}ORDER_{YYYYMMDD}_{mode}.fits
+   CAL_ARC/YYYY/MMDD/product/dbp{prefix}{YYYYMMDD}{number}_obj.pkl
+
+For each calibration type, arm and mode, the products are kept sorted by
+date and the nearest one is found with a binary search.  The observing mode
+of an arc is not part of its name, so arcs are indexed with a mode of None
+and the mode is found from the science database.
+
+The catalog is saved in the HRS_Cals directory along with the modification
+time of each product directory.  When it is loaded, only the product
+directories that have changed since it was saved are read again.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import os
+import re
+import json
+import bisect
+import datetime as dt
+
+
+catalog_file = 'hrs_calibration_catalog.json'
+
+cal_dirs = ['CAL_BIAS', 'CAL_FLAT', 'CAL_ARC']
+
+product_patterns = [
+    ('BIAS', re.compile(r'^(?P<prefix>[HR])BIAS_(?P<date>\d{8})\.fits$')),
+    ('FLAT', re.compile(r'^(?P<prefix>[HR])FLAT_(?P<date>\d{8})_(?P<mode>[A-Z_]+)\.fits$')),
+    ('ORDER', re.compile(r'^(?P<prefix>[HR])ORDER_(?P<date>\d{8})_(?P<mode>[A-Z_]+)\.fits$')),
+    ('ARC', re.compile(r'^dbp(?P<prefix>[HR])(?P<date>\d{8})\d+_obj\.pkl$')),
+    ]
+
+_catalogs = {}
+
+
+def parse_product(fname):
+    """Determine the calibration type, prefix, mode and date of a product
+    from its name
+
+    Parameters
+    ----------
+    fname: str
+       Name of the product
+
+    Returns
+    -------
+    info: tuple or None
+       (cal_type, prefix, mode, obsdate) or None if the file is not a
+       calibration product
+
+    """
+    name = os.path.basename(fname)
+    for cal_type, pattern in product_patterns:
+        m = pattern.match(name)
+        if m is None: continue
+        info = m.groupdict()
+        return cal_type, info['prefix'], info.get('mode'), info['date']
+    return None
+
+
+def date_ordinal(obsdate):
+    """Convert a date in YYYYMMDD to an ordinal day number"""
+    return dt.datetime.strptime(obsdate, '%Y%m%d').toordinal()
+
+
+def normalize_mode(mode):
+    """Return the mode as it appears in the product names"""
+    if mode is None: return None
+    return mode.strip().upper().replace(' ', '_')
+
+
+class HRSCalCatalog:
+    """Catalog of the HRS calibration products
+
+    Parameters
+    ----------
+    cal_dir: str
+       Directory with the calibration products
+
+    catalog_file: str or None
+       File to save the catalog to.  If None, the catalog is not saved
+
+    """
+
+    def __init__(self, cal_dir='/salt/HRS_Cals/', catalog_file=None):
+        self.cal_dir = cal_dir
+        self.catalog_file = catalog_file
+        self.dirs = {}
+        self.index = {}
+
+    def product_dirs(self):
+        """Find all of the product directories in cal_dir"""
+        pdirs = []
+        for cdir in cal_dirs:
+            cpath = os.path.join(self.cal_dir, cdir)
+            if not os.path.isdir(cpath): continue
+            for year in sorted(os.listdir(cpath)):
+                if not year.isdigit(): continue
+                ypath = os.path.join(cpath, year)
+                if not os.path.isdir(ypath): continue
+                for mmdd in sorted(os.listdir(ypath)):
+                    pdir = os.path.join(ypath, mmdd, 'product')
+                    if os.path.isdir(pdir): pdirs.append(pdir)
+        return pdirs
+
+    def scan(self):
+        """Update the catalog with the product directories that are new or
+        have changed since they were last read
+
+        Returns
+        -------
+        nchanged: int
+           Number of directories that were read
+
+        """
+        nchanged = 0
+        for pdir in self.product_dirs():
+            mtime = os.path.getmtime(pdir)
+            if pdir in self.dirs and self.dirs[pdir]['mtime'] == mtime: continue
+            files = [f for f in sorted(os.listdir(pdir)) if parse_product(f) is not None]
+            #keep the modes that have already been found for the arcs
+            modes = {}
+            if pdir in self.dirs: modes = self.dirs[pdir].get('modes', {})
+            self.dirs[pdir] = {'mtime': mtime, 'files': files,
+                               'modes': dict([(f, modes[f]) for f in files if f in modes])}
+            nchanged += 1
+        for pdir in list(self.dirs.keys()):
+            if not os.path.isdir(pdir):
+                del self.dirs[pdir]
+                nchanged += 1
+        if nchanged: self.build()
+        return nchanged
+
+    def build(self):
+        """Create the sorted index from the list of product directories"""
+        self.index = {}
+        for pdir in self.dirs:
+            for f in self.dirs[pdir]['files']:
+                cal_type, prefix, mode, obsdate = parse_product(f)
+                key = (cal_type, prefix, normalize_mode(mode))
+                self.index.setdefault(key, []).append((date_ordinal(obsdate), os.path.join(pdir, f)))
+        for key in self.index:
+            self.index[key].sort()
+
+    def load(self):
+        """Read the saved catalog and update it with any changes"""
+        if self.catalog_file is not None and os.path.isfile(self.catalog_file):
+            try:
+                fin = open(self.catalog_file)
+                try:
+                    self.dirs = json.load(fin).get('dirs', {})
+                finally:
+                    fin.close()
+            except (IOError, ValueError):
+                self.dirs = {}
+        self.build()
+        if self.scan(): self.save()
+
+    def save(self):
+        """Write out the catalog.  The catalog is only a cache, so nothing is
+        done if it cannot be written
+        """
+        if self.catalog_file is None: return
+        tmpfile = '{}.{}.tmp'.format(self.catalog_file, os.getpid())
+        try:
+            fout = open(tmpfile, 'w')
+            json.dump({'dirs': self.dirs}, fout, indent=1, sort_keys=True)
+            fout.close()
+            os.rename(tmpfile, self.catalog_file)
+        except (IOError, OSError):
+            if os.path.isfile(tmpfile): os.remove(tmpfile)
+
+    def add(self, fname, mode=None):
+        """Add a product that has just been linked into cal_dir
+
+        Parameters
+        ----------
+        fname: str
+           Path to the product in cal_dir
+
+        mode: str or None
+           Observing mode of an arc
+
+        """
+        info = parse_product(fname)
+        if info is None: return
+        cal_type, prefix, product_mode, obsdate = info
+        pdir = os.path.dirname(fname)
+        name = os.path.basename(fname)
+        entry = self.dirs.setdefault(pdir, {'mtime': None, 'files': [], 'modes': {}})
+        if os.path.isdir(pdir): entry['mtime'] = os.path.getmtime(pdir)
+        if name not in entry['files']:
+            entry['files'].append(name)
+            entry['files'].sort()
+            key = (cal_type, prefix, normalize_mode(product_mode))
+            bisect.insort(self.index.setdefault(key, []), (date_ordinal(obsdate), fname))
+        if mode is not None: self.set_mode(fname, mode)
+        self.save()
+
+    def set_mode(self, fname, mode):
+        """Record the observing mode of an arc"""
+        pdir = os.path.dirname(fname)
+        if pdir in self.dirs:
+            self.dirs[pdir].setdefault('modes', {})[os.path.basename(fname)] = normalize_mode(mode)
+
+    def get_mode(self, fname):
+        """Return the observing mode recorded for an arc or None"""
+        pdir = os.path.dirname(fname)
+        if pdir not in self.dirs: return None
+        return self.dirs[pdir].get('modes', {}).get(os.path.basename(fname))
+
+    def candidates(self, obsdate, cal_type, prefix, mode=None, nlim=180, past_only=False):
+        """Return the products in order of their distance in date from obsdate.
+        Products at the same distance are returned in the order later date
+        first.
+
+        Parameters
+        ----------
+        obsdate: str
+           Observing date in YYYYMMDD
+
+        cal_type: str
+           Calibration type: 'BIAS', 'FLAT', 'ORDER', 'ARC'
+
+        prefix: str
+           Prefix for the instrument
+
+        mode: str or None
+           Observing mode of the product
+
+        nlim: int
+           Only products less than nlim days from obsdate are returned
+
+        past_only: boolean
+           Only return products on or before obsdate
+
+        Returns
+        -------
+        cal_files: list
+           Paths of the products
+
+        """
+        entries = self.index.get((cal_type, prefix, normalize_mode(mode)), [])
+        day = date_ordinal(obsdate)
+        if past_only:
+            i = bisect.bisect_left(entries, (day+1,))
+            last = i
+        else:
+            i = bisect.bisect_left(entries, (day,))
+            last = len(entries)
+        j = i - 1
+        cal_files = []
+        while True:
+            after = None
+            before = None
+            if i < last: after = entries[i][0] - day
+            if j >= 0: before = day - entries[j][0]
+            if after is not None and after < nlim and (before is None or after <= before):
+                cal_files.append(entries[i][1])
+                i += 1
+            elif before is not None and before < nlim:
+                cal_files.append(entries[j][1])
+                j -= 1
+            else:
+                break
+        return cal_files
+
+    def nearest(self, obsdate, cal_type, prefix, mode=None, nlim=180, past_only=False):
+        """Find the product closest in date to obsdate
+
+        Returns
+        -------
+        cal_file: str or None
+           Path to the product or None if there is none within nlim days
+
+        """
+        for cal_file in self.candidates(obsdate, cal_type, prefix, mode=mode, nlim=nlim, past_only=past_only):
+            if os.path.isfile(cal_file): return cal_file
+        return None
+
+
+def get_catalog(cal_dir='/salt/HRS_Cals/'):
+    """Return the catalog of the calibration products in cal_dir.  It is read
+    once for each process
+
+    Parameters
+    ----------
+    cal_dir: str
+       Directory with the calibration products
+
+    Returns
+    -------
+    catalog: HRSCalCatalog
+       Catalog of the products
+
+    """
+    cal_dir = os.path.abspath(cal_dir)
+    if cal_dir not in _catalogs:
+        catalog = HRSCalCatalog(cal_dir, os.path.join(cal_dir, catalog_file))
+        catalog.load()
+        _catalogs[cal_dir] = catalog
+    return _catalogs[cal_dir]
@@ -26,6 +26,7 @@ from iraf import pysalt
 import salttime
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
 from saltsafelog import logging
 from salterror import SaltError
 
@@ -46,7 +47,7 @@ def pipelinestatus(obsdate, status, message=None, rawsize=None, reducedsize=None
     with logging(logfile,debug) as log:
 
        #connect the database
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, password)
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, password)
 
        #get the nightinfo_id
        night_id=saltmysql.getnightinfoid(sdb, obsdate)
@@ -48,6 +48,7 @@ pyexecute("pipetools$saltftp.py",verbose=no)
 pyexecute("pipetools$salthtml.py",verbose=no)
 pyexecute("pipetools$saltobsid.py",verbose=no)
 pyexecute("pipetools$saltpipe.py",verbose=no)
+pyexecute("pipetools$saltwatch.py",verbose=no)
 pyexecute("pipetools$saltsdbloadfits.py",verbose=no)
 pyexecute("pipetools$saltquery.py",verbose=no)
 pyexecute("pipetools$saltarchive.py",verbose=no)
@@ -16,6 +16,13 @@ S M Crawford (SAAO)    0.1          09 Jun 2013
 
 Updates
 ------------------------------------------------
+20261018  -Process the frames in each step with a pool of processes
+          -Write the data quality information in a single transaction
+          -Keep the cleaned bias and flat frames in memory until they are
+           combined
+          -Group the calibration frames with the index of saltcalgroup, which
+           matches the angles within a tolerance
+          -Use a connection from the pool of saltdbpool
 
 Todo
 ------------------------------------------------
@@ -25,6 +32,7 @@ Todo
 from __future__ import with_statement
 
 import sys,glob, os, shutil, time
+import multiprocessing
 import numpy as np
 from astropy.io import fits
 
@@ -38,8 +46,8 @@ from saltxtalk  import xtalk
 from saltbias import bias
 from saltflat import flat
 from saltcrclean import multicrclean
-from saltcombine import saltcombine 
 from saltmosaic import saltmosaic
+from saltcombine import saltcombine
 
 from specidentify import specidentify
 from specrectify import specrectify
@@ -49,6 +57,9 @@ import saltsafestring as saltstring
 import saltsafekey as saltkey
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
+from saltdq import DQAccumulator
+from saltcalgroup import CalibrationIndex
 from saltsafelog import logging, history
 
 from salterror import SaltError
@@ -58,6 +69,11 @@ debug=True
 biasheader_list=['INSTRUME', 'DETMODE', 'CCDSUM', 'GAINSET', 'ROSPEED', 'NWINDOW']
 flatheader_list=['INSTRUME', 'DETMODE', 'CCDSUM', 'GAINSET', 'ROSPEED', 'FILTER', 'GRATING', 'GR-ANGLE', 'AR-ANGLE', 'NWINDOW']
 
+#angles are compared as numbers and are the same if they agree within
+#angle_tolerance degrees.  All other keywords are compared as strings
+angleheader_list=['GR-ANGLE', 'AR-ANGLE']
+angle_tolerance=0.01
+
 
 # -----------------------------------------------------------
 # core routine
@@ -66,11 +82,18 @@ def saltadvance(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
 	geomfile=None,subover=True,trim=True,masbias=None, 
         subbias=False, median=False, function='polynomial', order=5,rej_lo=3,
         rej_hi=3,niter=5,interp='linear',  sdbhost='',sdbname='',sdbuser='', password='',
-        clobber=False, cleanup=True, logfile='salt.log', verbose=True):
+        clobber=False, cleanup=True, logfile='salt.log', verbose=True, nproc=1, mem_limit=4e9):
    """SALTADVANCE provides advanced data reductions for a set of data.  It will 
       sort the data, and first process the biases, flats, and then the science 
       frames.  It will record basic quality control information about each of 
       the steps.
+
+      The frames in each step are independent, so they are processed by
+      nproc processes (0=all available cores).  The cleaned bias and flat
+      frames are kept in memory, up to a total of mem_limit bytes, until
+      they are combined into the master frames.  The master frames are
+      combined with saltcombine, so the frames are written out before each
+      combine and, if cleanup is True, deleted again afterwards.
    """
    plotover=False
 
@@ -85,7 +108,7 @@ def saltadvance(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
        outpath=saltio.abspath(outpath)
 
        #log into the database
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, password)
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, password)
 
        #does the gain database file exist
        if gaindb:
@@ -115,6 +138,18 @@ def saltadvance(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
            obsstruct=createobslogfits(headerDict)
            saltio.writefits(obsstruct, obslogfile)
 
+       #the data quality information is written at the end
+       dq=DQAccumulator(sdb)
+
+       #the options for processing each frame.  The history is recorded here
+       #as it is taken from the arguments of this task
+       fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
+       options=dict(outpath=outpath, dblist=dblist, xdict=xdict, geomfile=geomfile, subover=subover,
+                    trim=trim, median=median, function=function, order=order, rej_lo=rej_lo,
+                    rej_hi=rej_hi, niter=niter, interp=interp, plotover=plotover, hist=hist,
+                    clobber=clobber, logfile=logfile, verbose=verbose, write=not cleanup)
+       frames=CalibrationFrames(mem_limit, cleanup=cleanup)
+
        #create the list of bias frames and process them
        filename=obsstruct.data.field('FILENAME')
        detmode=obsstruct.data.field('DETMODE')
@@ -126,194 +161,257 @@ def saltadvance(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
        #set the bias list of objects
        biaslist=filename[(ccdtype=='ZERO')*(propcode=='CAL_BIAS')]
        masterbias_dict={}
-       for img in infiles:
-           if os.path.basename(img) in biaslist:
-               #open the image
-               struct=fits.open(img)
-               bimg=outpath+'bxgp'+os.path.basename(img)
-
-               #print the message
-               if log:
-                   message='Processing Zero frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-               #process the image
-               struct=clean(struct, createvar=True, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
-                            verbose=verbose)
- 
-               #update the database
-               updatedq(os.path.basename(img), struct, sdb)
+       masterbias_index=calibrationindex(biasheader_list)
+       tasks=[('bias', img, options) for img in infiles if os.path.basename(img) in biaslist]
+       for result in runframes(tasks, nproc):
+           #update the database
+           updatedq(os.path.basename(result['infile']), None, sdb, stats=result['dq'], dq=dq)
 
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
-
-               # write FITS file
-               saltio.writefits(struct,bimg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #add files to the master bias list
-               masterbias_dict=compareimages(struct, bimg, masterbias_dict, keylist=biasheader_list)
+           #add files to the master bias list
+           masterbias_dict=groupimage(result['keys'], result['outfile'], masterbias_dict, masterbias_index)
+           frames.add(result['outfile'], result.pop('frame'), clobber)
 
        #create the master bias frame
        for i in masterbias_dict.keys():
            bkeys=masterbias_dict[i][0]
            blist=masterbias_dict[i][1:]
            mbiasname=outpath+createmasterbiasname(blist, bkeys)
-           bfiles=','.join(blist)
-           saltcombine(bfiles, mbiasname, method='median', reject='sigclip', mask=False, 
-                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,    \
-                       hthresh=3, clobber=False, logfile=logfile,verbose=verbose)
+           frames.combine(blist, mbiasname, logfile=logfile, verbose=verbose)
 
            
 
        #create the list of flatfields and process them
        flatlist=filename[ccdtype=='FLAT']
        masterflat_dict={}
-       for img in infiles:
-           if os.path.basename(img) in flatlist:
-               #open the image
-               struct=fits.open(img)
-               fimg=outpath+'bxgp'+os.path.basename(img)
-
-               #print the message
-               if log:
-                   message='Processing Flat frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-               #process the image
-               struct=clean(struct, createvar=True, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
-                            verbose=verbose)
-
-               #update the database
-               updatedq(os.path.basename(img), struct, sdb)
+       masterflat_index=calibrationindex(flatheader_list)
+       tasks=[('flat', img, options) for img in infiles if os.path.basename(img) in flatlist]
+       for result in runframes(tasks, nproc):
+           #update the database
+           updatedq(os.path.basename(result['infile']), None, sdb, stats=result['dq'], dq=dq)
 
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
-
-               # write FITS file
-               saltio.writefits(struct,fimg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #add files to the master bias list
-               masterflat_dict=compareimages(struct, fimg, masterflat_dict,  keylist=flatheader_list)
+           #add files to the master flat list
+           masterflat_dict=groupimage(result['keys'], result['outfile'], masterflat_dict, masterflat_index)
+           frames.add(result['outfile'], result.pop('frame'), clobber)
 
        #create the master flat frame
        for i in masterflat_dict.keys():
            fkeys=masterflat_dict[i][0]
            flist=masterflat_dict[i][1:]
            mflatname=outpath+createmasterflatname(flist, fkeys)
-           ffiles=','.join(flist)
-           saltcombine(ffiles, mflatname, method='median', reject='sigclip', mask=False, 
-                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,    \
-                       hthresh=3, clobber=False, logfile=logfile,verbose=verbose)
+           frames.combine(flist, mflatname, logfile=logfile, verbose=verbose)
 
        #process the arc data
        arclist=filename[(ccdtype=='ARC') * (obsmode=='SPECTROSCOPY') * (masktype=='LONGSLIT')]
-       for i, img in enumerate(infiles):
+       tasks=[('arc', img, options) for img in infiles if os.path.basename(img) in arclist]
+       for result in runframes(tasks, nproc):
+           #measure the arcdata--the solutions are all written to the same
+           #database so this is done one arc at a time
+           img=result['infile']
            nimg=os.path.basename(img)
-           if nimg in arclist:
-               #open the image
-               struct=fits.open(img)
-               simg=outpath+'bxgp'+os.path.basename(img)
-               obsdate=os.path.basename(img)[1:9]
-
-               #print the message
-               if log:
-                   message='Processing ARC frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-
-               struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, 
-                            log=log, verbose=verbose)
-
-               # write FITS file
-               saltio.writefits(struct,simg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #mosaic the images
-               mimg=outpath+'mbxgp'+os.path.basename(img)
-               saltmosaic(images=simg, outimages=mimg,outpref='',geomfile=geomfile,
-                    interp=interp,cleanup=True,clobber=clobber,logfile=logfile,
-                    verbose=verbose)
-
-               #remove the intermediate steps
-               saltio.delete(simg)
-
-
-               #measure the arcdata
-               arcimage=outpath+'mbxgp'+nimg
-               dbfile=outpath+obsdate+'_specid.db'
-               lamp = obsstruct.data.field('LAMPID')[i]
-               lamp = lamp.replace(' ', '')
-               lampfile = iraf.osfn("pysalt$data/linelists/%s.salt" % lamp)
-               print arcimage, lampfile, os.getcwd()
-               specidentify(arcimage, lampfile, dbfile, guesstype='rss', 
-                                guessfile='', automethod='Matchlines', function='legendre',
-                                order=3, rstep=100, rstart='middlerow', mdiff=20, thresh=3,
-                                startext=0, niter=5, smooth=3, inter=False, clobber=True, logfile=logfile, 
-                                verbose=verbose)
-               try:
-                   ximg = outpath+'xmbxgp'+os.path.basename(arcimage)
-                   specrectify(images=arcimage, outimages=ximg, outpref='', solfile=dbfile, caltype='line',
-                              function='legendre', order=3, inttype='interp', w1=None, w2=None, dw=None,
-                              nw=None, blank=0.0, conserve=True, nearest=True, clobber=True,
-                              logfile=logfile, verbose=verbose)
-               except:
-                   pass
+           i=infiles.index(img)
+           obsdate=nimg[1:9]
+           arcimage=result['outfile']
+           dbfile=outpath+obsdate+'_specid.db'
+           lamp = obsstruct.data.field('LAMPID')[i]
+           lamp = lamp.replace(' ', '')
+           lampfile = iraf.osfn("pysalt$data/linelists/%s.salt" % lamp)
+           print arcimage, lampfile, os.getcwd()
+           specidentify(arcimage, lampfile, dbfile, guesstype='rss', 
+                            guessfile='', automethod='Matchlines', function='legendre',
+                            order=3, rstep=100, rstart='middlerow', mdiff=20, thresh=3,
+                            startext=0, niter=5, smooth=3, inter=False, clobber=True, logfile=logfile, 
+                            verbose=verbose)
+           try:
+               ximg = outpath+'xmbxgp'+os.path.basename(arcimage)
+               specrectify(images=arcimage, outimages=ximg, outpref='', solfile=dbfile, caltype='line',
+                          function='legendre', order=3, inttype='interp', w1=None, w2=None, dw=None,
+                          nw=None, blank=0.0, conserve=True, nearest=True, clobber=True,
+                          logfile=logfile, verbose=verbose)
+           except:
+               pass
 
 
               
        #process the science data
-       for i, img in enumerate(infiles):
+       tasks=[]
+       for img in infiles:
            nimg=os.path.basename(img)
            if not (nimg in flatlist or nimg in biaslist or nimg in arclist):
-     
-               #open the image
-               struct=fits.open(img)
-               if struct[0].header['PROPID'].count('CAL_GAIN'): continue
-               simg=outpath+'bxgp'+os.path.basename(img)
-   
-
-               #print the message
-               if log:
-                   message='Processing science frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-
-               #Check to see if it is RSS 2x2 and add bias subtraction
-               instrume=saltkey.get('INSTRUME', struct[0]).strip()
-               gainset = saltkey.get('GAINSET', struct[0])    
-               rospeed = saltkey.get('ROSPEED', struct[0])    
-               target = saltkey.get('OBJECT', struct[0]).strip()
-               exptime = saltkey.get('EXPTIME', struct[0])
-               obsmode = saltkey.get('OBSMODE', struct[0]).strip()
-               detmode = saltkey.get('DETMODE', struct[0]).strip()
-               masktype = saltkey.get('MASKTYP', struct[0]).strip()
+               tasks.append(('science', img, options))
+       for result in runframes(tasks, nproc):
+           #update the database
+           if result['dq'] is not None:
+               updatedq(os.path.basename(result['infile']), None, sdb, stats=result['dq'], dq=dq)
+
+       #update the database
+       flushdq(dq, log)
+
+
+       #clean up the results
+       if cleanup:
+          #clean up the bias frames
+          for i in masterbias_dict.keys():
+               blist=masterbias_dict[i][1:]
+               for b in blist: 
+                   if os.path.isfile(b): saltio.delete(b)
+
+          #clean up the flat frames
+          for i in masterflat_dict.keys():
+               flist=masterflat_dict[i][1:]
+               for f in flist: 
+                   if os.path.isfile(f): saltio.delete(f)
+
+
+def runframes(tasks, nproc=1):
+   """Process a list of frames with nproc processes.  The results are
+      returned one at a time as they are needed, so only the frames that
+      are kept by the caller stay in memory
+
+      returns iterator over the results of reduceframe in the same order as
+      tasks
+   """
+   if nproc < 1: nproc = multiprocessing.cpu_count()
+   if multiprocessing.current_process().daemon: nproc = 1
+   nproc = min(nproc, len(tasks))
+   if nproc <= 1:
+       for task in tasks:
+           yield reduceframe(task)
+       return
+
+   pool = multiprocessing.Pool(nproc)
+   try:
+       for result in pool.imap(reduceframe, tasks):
+           yield result
+   finally:
+       pool.close()
+       pool.join()
+
+
+def reduceframe(task):
+   """Reduce a single frame.  The frame is cleaned and written out.  Arc
+      frames and science frames are also mosaicked and science frames are 
+      rectified if they are longslit spectra.
+
+      task: (phase, img, options) where phase is 'bias', 'flat', 'arc' or 'science'
+
+      returns dictionary with the input file (infile), the output file
+      (outfile), the data quality statistics (dq) and the header values to
+      group calibration frames (keys).  The cleaned bias and flat frames
+      are also returned (frame, see packframe) and are only written out if
+      options['write'] is True
+   """
+   phase, img, options = task
+   outpath=options['outpath']
+   logfile=options['logfile']
+   verbose=options['verbose']
+   clobber=options['clobber']
+   geomfile=options['geomfile']
+   interp=options['interp']
+   result={'infile':img, 'outfile':None, 'dq':None, 'keys':None, 'frame':None}
+
+   with logging(logfile,debug) as log:
+       #open the image
+       struct=fits.open(img)
+       simg=outpath+'bxgp'+os.path.basename(img)
+
+       if phase=='bias' or phase=='flat':
+           #print the message
+           if log:
+               message='Processing %s frame %s' % ({'bias':'Zero', 'flat':'Flat'}[phase], img)
+               log.message(message, with_stdout=verbose)
+
+           #process the image
+           struct=clean(struct, createvar=True, badpixelstruct=None, mult=True, 
+                        dblist=options['dblist'], xdict=options['xdict'], subover=options['subover'],
+                        trim=options['trim'], subbias=False, bstruct=None, median=options['median'],
+                        function=options['function'], order=options['order'], rej_lo=options['rej_lo'],
+                        rej_hi=options['rej_hi'], niter=options['niter'], plotover=options['plotover'],
+                        log=log, verbose=verbose)
+
+           #measure the data quality 
+           result['dq']=dqstats(struct)
+
+           #return the frame to be combined and write it out if requested
+           housekeeping(struct, options['hist'])
+           result['outfile']=simg
+           result['keys']=headerkeys(struct, {'bias':biasheader_list, 'flat':flatheader_list}[phase])
+           result['frame']=packframe(struct)
+           if options['write']: saltio.writefits(struct,simg, clobber=clobber)
+           saltio.closefits(struct)
+           return result
+
+       if phase=='arc':
+           #print the message
+           if log:
+               message='Processing ARC frame %s' % img
+               log.message(message, with_stdout=verbose)
+
+           struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
+                        dblist=options['dblist'], xdict=options['xdict'], subover=options['subover'],
+                        trim=options['trim'], subbias=False, bstruct=None, median=options['median'],
+                        function=options['function'], order=options['order'], rej_lo=options['rej_lo'],
+                        rej_hi=options['rej_hi'], niter=options['niter'], plotover=options['plotover'],
+                        log=log, verbose=verbose)
+
+           # write FITS file
+           saltio.writefits(struct,simg, clobber=clobber)
+           saltio.closefits(struct)
+
+           #mosaic the images
+           mimg=outpath+'mbxgp'+os.path.basename(img)
+           saltmosaic(images=simg, outimages=mimg,outpref='',geomfile=geomfile,
+                interp=interp,cleanup=True,clobber=clobber,logfile=logfile,
+                verbose=verbose)
+
+           #remove the intermediate steps
+           saltio.delete(simg)
+           result['outfile']=mimg
+           return result
+
+       #process the science data
+       if struct[0].header['PROPID'].count('CAL_GAIN'): return result
+
+       #print the message
+       if log:
+           message='Processing science frame %s' % img
+           log.message(message, with_stdout=verbose)
+
+
+       #Check to see if it is RSS 2x2 and add bias subtraction
+       instrume=saltkey.get('INSTRUME', struct[0]).strip()
+       gainset = saltkey.get('GAINSET', struct[0])    
+       rospeed = saltkey.get('ROSPEED', struct[0])    
+       target = saltkey.get('OBJECT', struct[0]).strip()
+       exptime = saltkey.get('EXPTIME', struct[0])
+       obsmode = saltkey.get('OBSMODE', struct[0]).strip()
+       detmode = saltkey.get('DETMODE', struct[0]).strip()
+       masktype = saltkey.get('MASKTYP', struct[0]).strip()
   
-               
-               xbin, ybin = saltkey.ccdbin( struct[0], img)
-               obsdate=os.path.basename(img)[1:9]
-               bstruct=None
-               crtype=None
+       
+       xbin, ybin = saltkey.ccdbin( struct[0], img)
+       obsdate=os.path.basename(img)[1:9]
+       bstruct=None
+       crtype=None
+       thresh=5 
+       mbox=11 
+       bthresh=5.0,
+       flux_ratio=0.2 
+       bbox=25 
+       gain=1.0 
+       rdnoise=5.0 
+       fthresh=5.0 
+       bfactor=2
+       gbox=3 
+       maxiter=5
+    
+       subbias=False
+       if instrume=='RSS' and gainset=='FAINT' and rospeed=='SLOW':
+           bfile='P%sBiasNM%ix%iFASL.fits' % (obsdate, xbin, ybin)
+           if os.path.exists(bfile):
+              bstruct=fits.open(bfile)
+              subbias=True
+           if detmode=='Normal' and target!='ARC' and xbin < 5 and ybin < 5:
+               crtype='edge' 
                thresh=5 
                mbox=11 
                bthresh=5.0,
@@ -324,108 +422,159 @@ def saltadvance(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
                fthresh=5.0 
                bfactor=2
                gbox=3 
-               maxiter=5
-    
-               subbias=False
-               if instrume=='RSS' and gainset=='FAINT' and rospeed=='SLOW':
-                   bfile='P%sBiasNM%ix%iFASL.fits' % (obsdate, xbin, ybin)
-                   if os.path.exists(bfile):
-                      bstruct=fits.open(bfile)
-                      subbias=True
-                   if detmode=='Normal' and target!='ARC' and xbin < 5 and ybin < 5:
-                       crtype='edge' 
-                       thresh=5 
-                       mbox=11 
-                       bthresh=5.0,
-                       flux_ratio=0.2 
-                       bbox=25 
-                       gain=1.0 
-                       rdnoise=5.0 
-                       fthresh=5.0 
-                       bfactor=2
-                       gbox=3 
-                       maxiter=3
+               maxiter=3
     
-               #process the image
-               struct=clean(struct, createvar=True, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=subbias,
-                            bstruct=bstruct, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, 
-                            crtype=crtype,thresh=thresh,mbox=mbox, bbox=bbox,      \
-                            bthresh=bthresh, flux_ratio=flux_ratio, gain=gain, rdnoise=rdnoise, 
-                            bfactor=bfactor, fthresh=fthresh, gbox=gbox, maxiter=maxiter,
-                            log=log, verbose=verbose)
-
-               
-
-               #update the database
-               updatedq(os.path.basename(img), struct, sdb)
-
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
-
-               # write FITS file
-               saltio.writefits(struct,simg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #mosaic the files--currently not in the proper format--will update when it is
-               if not saltkey.fastmode(saltkey.get('DETMODE', struct[0])):
-                   mimg=outpath+'mbxgp'+os.path.basename(img)
-                   saltmosaic(images=simg, outimages=mimg,outpref='',geomfile=geomfile,
-                        interp=interp,fill=True, cleanup=True,clobber=clobber,logfile=logfile,
-                        verbose=verbose)
-
-                   #remove the intermediate steps
-                   saltio.delete(simg)
-
-               #if the file is spectroscopic mode, apply the wavelength correction
-               if obsmode == 'SPECTROSCOPY' and masktype.strip()=='LONGSLIT':
-                  dbfile=outpath+obsdate+'_specid.db'
-                  try:
-                     ximg = outpath+'xmbxgp'+os.path.basename(img)
-                     specrectify(images=mimg, outimages=ximg, outpref='', solfile=dbfile, caltype='line', 
-                              function='legendre', order=3, inttype='interp', w1=None, w2=None, dw=None,
-                              nw=None, blank=0.0, conserve=True, nearest=True, clobber=True, 
-                              logfile=logfile, verbose=verbose)
-                  except Exception, e:
-                     log.message('%s' % e)
+       #process the image
+       struct=clean(struct, createvar=True, badpixelstruct=None, mult=True, 
+                    dblist=options['dblist'], xdict=options['xdict'], subover=options['subover'],
+                    trim=options['trim'], subbias=subbias, bstruct=bstruct, median=options['median'],
+                    function=options['function'], order=options['order'], rej_lo=options['rej_lo'],
+                    rej_hi=options['rej_hi'], niter=options['niter'], plotover=options['plotover'],
+                    crtype=crtype,thresh=thresh,mbox=mbox, bbox=bbox,      \
+                    bthresh=bthresh, flux_ratio=flux_ratio, gain=gain, rdnoise=rdnoise, 
+                    bfactor=bfactor, fthresh=fthresh, gbox=gbox, maxiter=maxiter,
+                    log=log, verbose=verbose)
+
+       #measure the data quality 
+       result['dq']=dqstats(struct)
+
+       #write the file out
+       writeframe(struct, simg, options['hist'], clobber)
+       result['outfile']=simg
+
+       #mosaic the files--currently not in the proper format--will update when it is
+       if not saltkey.fastmode(saltkey.get('DETMODE', struct[0])):
+           mimg=outpath+'mbxgp'+os.path.basename(img)
+           saltmosaic(images=simg, outimages=mimg,outpref='',geomfile=geomfile,
+                interp=interp,fill=True, cleanup=True,clobber=clobber,logfile=logfile,
+                verbose=verbose)
+
+           #remove the intermediate steps
+           saltio.delete(simg)
+           result['outfile']=mimg
+
+       #if the file is spectroscopic mode, apply the wavelength correction
+       if obsmode == 'SPECTROSCOPY' and masktype.strip()=='LONGSLIT':
+          dbfile=outpath+obsdate+'_specid.db'
+          try:
+             ximg = outpath+'xmbxgp'+os.path.basename(img)
+             specrectify(images=mimg, outimages=ximg, outpref='', solfile=dbfile, caltype='line', 
+                      function='legendre', order=3, inttype='interp', w1=None, w2=None, dw=None,
+                      nw=None, blank=0.0, conserve=True, nearest=True, clobber=True, 
+                      logfile=logfile, verbose=verbose)
+             result['outfile']=ximg
+          except Exception, e:
+             log.message('%s' % e)
+
+   return result
+
+
+def housekeeping(struct, hist):
+   """Add the housekeeping keywords to a cleaned frame"""
+   saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
+   saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
+   saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
+   saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
+
+
+def writeframe(struct, outfile, hist, clobber):
+   """Add the housekeeping keywords to a cleaned frame and write it out"""
+   housekeeping(struct, hist)
+
+   # write FITS file
+   saltio.writefits(struct,outfile, clobber=clobber)
+   saltio.closefits(struct)
+
+
+def packframe(struct):
+   """Pack the headers and data of a frame so that it can be returned from
+      another process
+
+      returns list of (header string, data) for each extension
+   """
+   return [(hdu.header.tostring(), hdu.data) for hdu in struct]
 
 
-       #clean up the results
-       if cleanup:
-          #clean up the bias frames
-          for i in masterbias_dict.keys():
-               blist=masterbias_dict[i][1:]
-               for b in blist: saltio.delete(b)
+def unpackframe(frame):
+   """Create a fits structure from a frame packed with packframe
 
-          #clean up the flat frames
-          for i in masterflat_dict.keys():
-               flist=masterflat_dict[i][1:]
-               for f in flist: saltio.delete(f)
+      returns fits.HDUList
+   """
+   hdus=[]
+   for i, (header, data) in enumerate(frame):
+       header=fits.Header.fromstring(header)
+       if i==0:
+           hdus.append(fits.PrimaryHDU(data=data, header=header))
+       else:
+           hdus.append(fits.ImageHDU(data=data, header=header))
+   return fits.HDUList(hdus)
 
 
-def updatedq(img, struct, sdb):
-   """Add information about the image to the database
+def framesize(frame):
+   """Return the size of the data in a packed frame in bytes"""
+   return sum([data.nbytes for header, data in frame if data is not None])
+
+
+class CalibrationFrames:
+   """Cleaned calibration frames that are kept in memory until they are
+      combined into a master frame.  Once mem_limit bytes are held, further
+      frames are written to disk straight away.  If cleanup is True, the
+      files that are written only to be combined are deleted afterwards
    """
- 
-   #get the filenumber
-   #check to see if the FileData was created
-   logic="FileName='%s'" % img
-   records=saltmysql.select(sdb,'FileData_Id','FileData',logic)
-   try:
-       FileData_Id=records[0][0]
-   except:
-       message='WARNING:  File not yet in database'
-       print message
-       return
+
+   def __init__(self, mem_limit=4e9, cleanup=True):
+       self.mem_limit = mem_limit
+       self.cleanup = cleanup
+       self.frames = {}
+       self.written = set()
+       self.nbytes = 0
+
+   def add(self, outfile, frame, clobber=False):
+       """Keep a frame in memory or write it to outfile"""
+       size = framesize(frame)
+       if self.nbytes + size <= self.mem_limit:
+           self.frames[outfile] = frame
+           self.nbytes += size
+       elif not os.path.isfile(outfile):
+           self.write(outfile, frame, clobber)
+
+   def write(self, outfile, frame, clobber=False):
+       """Write a frame to outfile"""
+       saltio.writefits(unpackframe(frame), outfile, clobber=clobber)
+       self.written.add(outfile)
+
+   def release(self, outfile):
+       """Remove a frame from memory"""
+       frame = self.frames.pop(outfile, None)
+       if frame is not None: self.nbytes -= framesize(frame)
+
+   def combine(self, flist, mastername, logfile='salt.log', verbose=True):
+       """Combine a group of frames into a master frame with saltcombine and
+          remove them from memory
+       """
+       for f in flist:
+           if f in self.frames and not os.path.isfile(f):
+               self.write(f, self.frames[f])
+       for f in flist: self.release(f)
+       try:
+           saltcombine(','.join(flist), mastername, method='median', reject='sigclip', mask=False,
+                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,
+                       hthresh=3, clobber=False, logfile=logfile,verbose=verbose)
+       finally:
+           if self.cleanup:
+               for f in flist:
+                   if f in self.written:
+                       saltio.delete(f)
+                       self.written.discard(f)
 
 
-   #get the information from the image
+def dqstats(struct):
+   """Measure the data quality of each science extension of the image
+
+      returns list of (extension, overscan mean, overscan rms, background 
+      mean, background rms)
+   """
+   stats=[]
    for i in range(1,len(struct)):
      if struct[i].name=='SCI':
        try:
@@ -446,30 +595,42 @@ def updatedq(img, struct, sdb):
           mean,med,sig=saltstat.iterstat(struct[i].data[dy1:dy2,dx1:dx2], 5, 5)
        except:
           mean, med, sig=(None, None, None)
+       stats.append((i, omean, orms, mean, sig))
+   return stats
 
-       #update the database with this information
-       #check to see if you need to update or insert
-       record=saltmysql.select(sdb, 'FileData_Id', 'PipelineDataQuality_CCD', 'FileData_Id=%i and Extension=%i' % (FileData_Id, i))
-       update=False
-       if record: update=True
- 
-       ins_cmd=''
-       if omean is not None: ins_cmd='OverscanMean=%s,' % omean
-       if orms is not None:  ins_cmd+='OverscanRms=%s,' % orms
-       if mean is not None:  ins_cmd+='BkgdMean=%f,' % mean
-       if sig is not None:   ins_cmd+='BkgdRms=%f' % sig 
-       if update:
-          ins_cmd=ins_cmd.rstrip(',')    
-          saltmysql.update(sdb, ins_cmd, 'PipelineDataQuality_CCD', 'FileData_Id=%i and Extension=%i' % (FileData_Id, i))
+
+def updatedq(img, struct, sdb, stats=None, dq=None):
+   """Add information about the image to the database.  If the data quality
+      statistics have already been measured, they can be given as stats
+      instead of measuring them from struct.  If a DQAccumulator is given
+      as dq, the information is added to it and written when it is flushed
+   """
+   #get the information from the image
+   if stats is None: stats=dqstats(struct)
+
+   if dq is None:
+       acc=DQAccumulator(sdb)
+   else:
+       acc=dq
+   for i, omean, orms, mean, sig in stats:
+       acc.add(img, Extension=i, OverscanMean=omean, OverscanRms=orms, BkgdMean=mean, BkgdRms=sig)
+
+   if dq is None: flushdq(acc)
+
+def flushdq(dq, log=None):
+   """Write the data quality information to the database"""
+   for img in dq.flush():
+       message='WARNING:  %s not yet in database' % img
+       if log:
+           log.warning(message)
        else:
-          ins_cmd+=',FileData_Id=%i, Extension=%i' % (FileData_Id, i)
-          saltmysql.insert(sdb, ins_cmd, 'PipelineDataQuality_CCD')
+           print message
 
-def compareimages(struct, oimg, imdict, keylist):
-   """See if the current structure is held in the dictionary of images.  If it is,
-       then add it to the list.  If it isn't then create a new entry
+def headerkeys(struct, keylist):
+   """Read the header values used to group the calibration frames
+
+      returns list of strings
    """
-   #create the list of header parameters
    klist=[]
    for k in keylist:
        try:
@@ -477,19 +638,61 @@ def compareimages(struct, oimg, imdict, keylist):
        except:
            value=''
        klist.append(value)
+   return klist
 
-   if len(imdict)==0: 
-       imdict[oimg]=[klist, oimg]
-       return imdict
+def compareimages(struct, oimg, imdict, keylist, index=None):
+   """See if the current structure is held in the dictionary of images.  If it is,
+       then add it to the list.  If it isn't then create a new entry
+   """
+   if index is None:
+       index=calibrationindex(keylist)
+       for i in imdict:
+           index.add(keyrecord(imdict[i][0], keylist), i)
+   return groupimage(headerkeys(struct, keylist), oimg, imdict, index)
 
-   #compare each value of imdict to the structure
-   for i in imdict.keys():
-       if klist==imdict[i][0]:
-          imdict[i].append(oimg)
-          return imdict
+def calibrationindex(keylist):
+   """Create the index of the groups of calibration frames with the header
+      values of keylist
+
+      returns saltcalgroup.CalibrationIndex
+   """
+   return CalibrationIndex(keylist, tolerance=angle_tolerance)
+
+def keyrecord(klist, keylist):
+   """Create the record of the header values klist for the index.  The
+      angles are converted to numbers
+
+      returns dictionary of keyword: value
+   """
+   record={}
+   for k, value in zip(keylist, klist):
+       if k in angleheader_list:
+           try:
+               value=float(value)
+           except ValueError:
+               pass
+       record[k]=value
+   return record
+
+def groupimage(klist, oimg, imdict, index):
+   """Add an image to the group in imdict with the same header values
+      klist.  If there is no group, then create a new entry
+
+      index is the CalibrationIndex of the groups in imdict from
+      calibrationindex.  It should be kept between calls so that each image
+      is only compared with the groups that could match
+   """
+   record=keyrecord(klist, index.keylist)
+
+   #add the image to the group with the same values
+   matches=index.match(record)
+   if matches:
+       imdict[matches[0]].append(oimg)
+       return imdict
 
    #create a new one if it isn't found
    imdict[oimg]=[klist, oimg]
+   index.add(record, oimg)
        
    return imdict
  
@@ -36,12 +36,25 @@
 # -----------------------------------------------------------------------
 # Martin Still (SAAO)    0.2          10 Jan 2007
 # S M Crawford (SAAO)    0.3          21 Oct 2007  Removed c-code
+# S M Crawford (SAAO)    0.4          18 Oct 2026  Added convmode
+# S M Crawford (SAAO)    0.5          18 Oct 2026  Added frame selection
 
 # saltbin2fit converts binary files from SALT slot mode to standard
 # FITS format.
+#
+# convmode selects how vid2fits writes each file:
+#   standard -- one extension per frame and amplifier, written frame by frame
+#   batch    -- the same layout written in a single pass from a memory
+#               mapped binary file
+#   cube     -- one data cube per amplifier with a table of the frame times
+#
+# Only some of the frames of each file are converted if framerange
+# (first,last frame number), step (keep every Nth frame) or utrange
+# (HH:MM:SS,HH:MM:SS) are given.  Blank ranges convert all of the frames.
 
 from pyraf import iraf
 import os, time, glob, string
+import multiprocessing
 import vid2fits
 
 import saltprint, saltio
@@ -53,7 +66,10 @@ debug=True
 # -----------------------------------------------------------
 # core routine
 
-def saltbin2fit(inpath,outpath,cleanup,fitsconfig,logfile,verbose,status=0):
+convmodes = ['standard', 'batch', 'cube']
+
+def saltbin2fit(inpath,outpath,cleanup,fitsconfig,logfile,verbose,nproc=0,convmode='standard',
+                framerange='',step=1,utrange='',status=0):
 
     status = 0
     output = {}
@@ -77,13 +93,39 @@ def saltbin2fit(inpath,outpath,cleanup,fitsconfig,logfile,verbose,status=0):
     message += 'logfile='+logfile+' '
     yn = 'n'
     if (verbose): yn = 'y'
-    message += 'verbose='+yn+'\n'
+    message += 'verbose='+yn+' '
+    message += 'nproc='+str(nproc)+' '
+    message += 'convmode='+convmode+' '
+    message += 'framerange='+str(framerange)+' '
+    message += 'step='+str(step)+' '
+    message += 'utrange='+str(utrange)+'\n'
     saltprint.log(logfile,message,verbose)
 
 # start time
 
     saltprint.time('SALTBIN2FIT started at  ',logfile,verbose)
 
+# check the conversion mode
+
+    convmode = convmode.strip().lower()
+    if convmode not in convmodes:
+        message = 'SALTBIN2FIT: ERROR -- convmode must be one of '+', '.join(convmodes)
+        status = saltprint.err(logfile,message)
+
+# check the frames to convert
+
+    if (status == 0):
+        try:
+            framerange = vid2fits.parserange(framerange)
+            utrange = vid2fits.parserange(utrange, str)
+            if utrange is not None:
+                for ut in utrange: vid2fits.utseconds(ut)
+            step = int(step)
+            if step < 1: raise SaltError('step must be at least 1')
+        except (SaltError, ValueError), e:
+            message = 'SALTBIN2FIT: ERROR -- '+str(e)
+            status = saltprint.err(logfile,message)
+
 # check directory inpath exists
 
     if (status == 0): inpath, status = saltio.pathexists(inpath,logfile)
@@ -162,40 +204,34 @@ def saltbin2fit(inpath,outpath,cleanup,fitsconfig,logfile,verbose,status=0):
     print maxnexthead
     if (status == 0):
 
-        #set yo tge counting for the image headers
-        i=0
-        inhead=headlist[i]
-        i+=1
-        #if only one image header exists
-        nexthead=maxnexthead
-        if i<len(headlist):
-        #if more than one header list
-            nexthead=findimagenumber(headlist[i])
-
-        #loop through the binned images to convert each one
-        for binimg in binlist:
-            #name the output file
-            fitsimg=string.replace(binimg,'.bin','.fits')
-
-            #find the right inhead for each frame
-            if findimagenumber(binimg) >= nexthead:
-                inhead=headlist[i]
-                i += 1
-                if i < len(headlist):
-                    nexthead=findimagenumber(headlist[i])
-                else:
-                    nexthead=maxnexthead
-
-            #convert the images
-            vid2fits.vid2fits(inhead,binimg,fitsimg,fitsconfig)
+        #assign the header file to each of the binary files
+        tasks = [t + (fitsconfig, convmode, (framerange, step, utrange)) for t in assignheaders(binlist, headlist, maxnexthead)]
+
+        #convert the images, in parallel if more than one process is requested
+        if nproc < 1: nproc = multiprocessing.cpu_count()
+        #processes of a pool cannot start their own
+        if multiprocessing.current_process().daemon: nproc = 1
+        nproc = min(nproc, len(tasks))
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
             try:
-                 message = 'SALTBIN2FIT: Created '+fitsimg+' from '+binimg
-                 message += ' using header file  '+inhead
-                 saltprint.log(logfile,message,verbose)
-            except:
-                message = 'SALTBIN2FIT ERROR: Unable to create '+fitsimg+' from '+binimg
+                results = pool.map(convertbinfile, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(convertbinfile, tasks)
+
+        #record the results in the log
+        for binimg, inhead, fitsimg, error in results:
+            if error is None:
+                message = 'SALTBIN2FIT: Created '+fitsimg+' from '+binimg
                 message += ' using header file  '+inhead
                 saltprint.log(logfile,message,verbose)
+            else:
+                message = 'SALTBIN2FIT ERROR: Unable to create '+fitsimg+' from '+binimg
+                message += ' using header file  '+inhead+' because '+error
+                status = saltprint.err(logfile,message)
 
 
 
@@ -207,6 +243,62 @@ def saltbin2fit(inpath,outpath,cleanup,fitsconfig,logfile,verbose,status=0):
     else:
         saltprint.time('SALTBIN2FIT aborted at  ',logfile,verbose)
 
+def assignheaders(binlist, headlist, maxnexthead):
+    """Assign the header definition file to each binary file.  A header file
+       applies to all binary files from its own image number up to the image
+       number of the next header file.
+
+       returns list of (binimg, inhead, fitsimg)
+    """
+    tasks = []
+
+    #set yo tge counting for the image headers
+    i=0
+    inhead=headlist[i]
+    i+=1
+    #if only one image header exists
+    nexthead=maxnexthead
+    if i<len(headlist):
+    #if more than one header list
+        nexthead=findimagenumber(headlist[i])
+
+    #loop through the binned images to find the header for each one
+    for binimg in binlist:
+        #name the output file
+        fitsimg=string.replace(binimg,'.bin','.fits')
+
+        #find the right inhead for each frame
+        if findimagenumber(binimg) >= nexthead:
+            inhead=headlist[i]
+            i += 1
+            if i < len(headlist):
+                nexthead=findimagenumber(headlist[i])
+            else:
+                nexthead=maxnexthead
+
+        tasks.append((binimg, inhead, fitsimg))
+
+    return tasks
+
+def convertbinfile(task):
+    """Convert a single binary file with vid2fits.  task is a tuple of
+       (binimg, inhead, fitsimg, fitsconfig, convmode, selection), where
+       selection is (framerange, step, utrange).  Errors are returned
+       rather than raised so that the results of a pool of workers can be
+       collected.
+
+       returns binimg, inhead, fitsimg, error
+    """
+    binimg, inhead, fitsimg, fitsconfig, convmode, selection = task
+    framerange, step, utrange = selection
+    try:
+        vid2fits.vid2fits(inhead,binimg,fitsimg,fitsconfig,
+                          batch=(convmode=='batch'),cube=(convmode=='cube'),
+                          framerange=framerange,step=step,utrange=utrange)
+    except Exception, e:
+        return binimg, inhead, fitsimg, str(e)
+    return binimg, inhead, fitsimg, None
+
 def findimagenumber (filename):
     """find the number for each image file"""
     #split the file so that name is a string equal to OBSDATE+number
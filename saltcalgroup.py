@@ -0,0 +1,143 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTCALGROUP provides an index to group frames with the same instrument
+configuration, for example to find all the data that a calibration frame
+can be used for.
+
+Each frame is stored under a key made from its configuration keywords.
+Strings are stripped and converted to upper case.  Floating point values,
+such as the grating and articulation angles, are placed in buckets the
+size of the tolerance.  Values that agree within the tolerance are always
+in the same or neighbouring buckets, so a search only has to look at the
+neighbouring buckets rather than at every frame.  The candidates that are
+found can be checked with an exact comparison function.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import math
+import itertools
+
+import numpy as np
+
+
+def normalize(value, tolerance=0.01):
+   """Normalize a keyword value for the key of the index
+
+      returns (type, value) where type is 'str' for strings, 'bool' for
+      booleans, 'float' for numbers placed in buckets of size tolerance and
+      None for values that are not used to index the frames.  All numeric
+      types, including integers and numpy scalars from a table, are placed
+      in the same buckets so that a header value and a table value can match
+   """
+   if isinstance(value, (basestring, np.str_)):
+       return ('str', value.strip().upper())
+   if isinstance(value, (bool, np.bool_)):
+       return ('bool', bool(value))
+   if isinstance(value, (int, long, float, np.number)):
+       return ('float', int(math.floor(float(value) / tolerance)))
+   return (None, None)
+
+
+def groupkey(record, keylist, tolerance=0.01, numeric=True):
+   """Create the key for a record from the values of keylist.  The record can
+      be a row of a table, a dictionary or any object that can be indexed
+      by the keyword names.  If numeric is False, numbers are left out of
+      the key
+
+      returns tuple
+   """
+   key = []
+   for k in keylist:
+       try:
+           t, v = normalize(record[k], tolerance)
+       except (KeyError, IndexError, ValueError):
+           t, v = None, None
+       if t == 'float' and not numeric: t, v = None, None
+       key.append((t, v))
+   return tuple(key)
+
+
+class CalibrationIndex:
+   """Index of frames by their configuration
+
+      Parameters
+      ----------
+      keylist: list
+           keywords that set the configuration
+      tolerance: float
+           values of floating point keywords that agree within the
+           tolerance are considered to be the same
+      compare: function
+           if given, candidates are only returned if
+           compare(record, candidate record, keylist) is True.  The
+           numeric keywords are then left out of the index and are only
+           checked by compare
+   """
+
+   def __init__(self, keylist, tolerance=0.01, compare=None):
+       self.keylist = list(keylist)
+       self.tolerance = tolerance
+       self.compare = compare
+       self.numeric = compare is None
+       self.groups = {}
+
+   def __len__(self):
+       return sum([len(self.groups[k]) for k in self.groups])
+
+   def add(self, record, item=None):
+       """Add a record to the index.  item is returned when the record
+          matches a search and defaults to the record itself
+       """
+       if item is None: item = record
+       key = groupkey(record, self.keylist, self.tolerance, self.numeric)
+       self.groups.setdefault(key, []).append((record, item))
+
+   def neighbours(self, key):
+       """Return all of the keys that could hold a match for key"""
+       options = []
+       for t, v in key:
+           if t == 'float':
+               options.append([(t, v-1), (t, v), (t, v+1)])
+           else:
+               options.append([(t, v)])
+       return [tuple(k) for k in itertools.product(*options)]
+
+   def match(self, record, reverse=False):
+       """Find the items whose records match the configuration of record.
+          If reverse is True, the comparison function is called as
+          compare(candidate record, record, keylist)
+
+          returns list of items
+       """
+       key = groupkey(record, self.keylist, self.tolerance, self.numeric)
+       items = []
+       for k in self.neighbours(key):
+           for other, item in self.groups.get(k, []):
+               if self.compare is not None:
+                   if reverse:
+                       if not self.compare(other, record, self.keylist): continue
+                   elif not self.compare(record, other, self.keylist): continue
+               elif not self.within(key, groupkey(other, self.keylist, self.tolerance, self.numeric), record, other):
+                   continue
+               items.append(item)
+       return items
+
+   def within(self, key, okey, record, other):
+       """Check that the floating point values of two records agree within
+          the tolerance
+       """
+       for i, k in enumerate(self.keylist):
+           if key[i][0] == 'float' and abs(record[k] - other[k]) > self.tolerance: return False
+       return True
@@ -0,0 +1,204 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTCOPY copies the raw data into the working directory of the pipeline
+
+The copy can be made in several ways:
+
+auto     -- use a reflink if the file system supports it, otherwise a copy
+reflink  -- copy-on-write clone of the file (btrfs, xfs).  Only the metadata
+            is written
+hardlink -- link to the same data on disk.  Only the metadata is written.
+            Any task that updates a file in place, such as saltfixsec, also
+            changes the original, so breaklinks must be run on the files
+            before they are updated
+copy     -- copy the data in chunks with several processes
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import os, shutil
+import multiprocessing
+
+from salterror import SaltError
+
+#ioctl to clone a file on linux
+FICLONE = 0x40049409
+
+copymodes = ['auto', 'reflink', 'hardlink', 'copy']
+
+
+def reflink(infile, outfile):
+   """Create a copy-on-write clone of infile.  Raises IOError if the file
+      system does not support it
+   """
+   import fcntl
+   fin = open(infile, 'rb')
+   try:
+       fout = open(outfile, 'wb')
+       try:
+           fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+       except IOError:
+           fout.close()
+           os.remove(outfile)
+           raise
+       fout.close()
+   finally:
+       fin.close()
+   shutil.copystat(infile, outfile)
+
+
+def hardlink(infile, outfile):
+   """Link outfile to the same data as infile.  Raises OSError if they are
+      on different file systems
+   """
+   os.link(infile, outfile)
+
+
+def copychunk(task):
+   """Copy part of a file.  The output file must already exist
+
+      task: (infile, outfile, offset, length)
+   """
+   infile, outfile, offset, length = task
+   fin = open(infile, 'rb')
+   fout = open(outfile, 'r+b')
+   try:
+       fin.seek(offset)
+       fout.seek(offset)
+       while length > 0:
+           block = fin.read(min(length, 2**22))
+           if not block: break
+           fout.write(block)
+           length -= len(block)
+   finally:
+       fin.close()
+       fout.close()
+
+
+def chunkcopy(filelist, nproc=0, chunksize=2**26):
+   """Copy a list of files by splitting them into chunks and copying the
+      chunks in parallel
+
+      filelist: list of (infile, outfile)
+   """
+   tasks = []
+   for infile, outfile in filelist:
+       size = os.path.getsize(infile)
+       fout = open(outfile, 'wb')
+       fout.truncate(size)
+       fout.close()
+       for offset in range(0, size, chunksize):
+           tasks.append((infile, outfile, offset, min(chunksize, size-offset)))
+
+   #processes of a pool cannot start their own
+   if nproc < 1: nproc = multiprocessing.cpu_count()
+   if multiprocessing.current_process().daemon: nproc = 1
+   nproc = min(nproc, len(tasks))
+
+   if nproc > 1:
+       pool = multiprocessing.Pool(nproc)
+       try:
+           pool.map(copychunk, tasks)
+       finally:
+           pool.close()
+           pool.join()
+   else:
+       for task in tasks:
+           copychunk(task)
+
+   for infile, outfile in filelist:
+       shutil.copystat(infile, outfile)
+
+
+def copyfile(infile, outfile, mode='auto'):
+   """Copy a single file
+
+      returns the mode that was used to copy the file
+   """
+   return copyfiles([(infile, outfile)], mode=mode, nproc=1)[0]
+
+
+def copyfiles(filelist, mode='auto', nproc=0):
+   """Copy a list of files.  Any existing output files are replaced
+
+      filelist: list of (infile, outfile)
+
+      returns list of the modes used to copy each file
+   """
+   if mode not in copymodes:
+       raise SaltError('SALTCOPY -- %s is not a valid copy mode' % mode)
+
+   modes = []
+   tocopy = []
+   for infile, outfile in filelist:
+       if os.path.lexists(outfile): os.remove(outfile)
+
+       used = 'copy'
+       if mode in ['auto', 'reflink']:
+           try:
+               reflink(infile, outfile)
+               used = 'reflink'
+           except IOError, e:
+               if mode == 'reflink':
+                   raise SaltError('SALTCOPY -- Could not create a reflink of %s because %s' % (infile, e))
+       if used == 'copy' and mode == 'hardlink':
+           try:
+               hardlink(infile, outfile)
+               used = 'hardlink'
+           except OSError, e:
+               if mode == 'hardlink':
+                   raise SaltError('SALTCOPY -- Could not link %s because %s' % (infile, e))
+       if used == 'copy': tocopy.append((infile, outfile))
+       modes.append(used)
+
+   if tocopy: chunkcopy(tocopy, nproc=nproc)
+   return modes
+
+
+def breaklinks(filelist, nproc=0):
+   """Replace the files that are hard links with a copy of their data, so
+      that they can be updated in place without changing the other links
+
+      returns list of the files that were copied
+   """
+   linked = [f for f in filelist if os.path.isfile(f) and os.stat(f).st_nlink > 1]
+   tmplist = [(f, '%s.%i.tmp' % (f, os.getpid())) for f in linked]
+   chunkcopy(tmplist, nproc=nproc)
+   for infile, tmpfile in tmplist:
+       os.rename(tmpfile, infile)
+   return linked
+
+
+def copydir(inpath, outpath, mode='auto', nproc=0):
+   """Copy the contents of inpath to outpath.  outpath is created if it does
+      not exist
+
+      returns dictionary of the number of files copied with each mode
+   """
+   if not os.path.isdir(inpath):
+       raise SaltError('SALTCOPY -- %s is not a directory' % inpath)
+
+   filelist = []
+   for root, dirs, files in os.walk(inpath):
+       outroot = os.path.join(outpath, os.path.relpath(root, inpath))
+       if not os.path.isdir(outroot): os.makedirs(outroot)
+       for name in files:
+           infile = os.path.join(root, name)
+           if os.path.isfile(infile):
+               filelist.append((infile, os.path.join(outroot, name)))
+
+   counts = {}
+   for used in copyfiles(filelist, mode=mode, nproc=nproc):
+       counts[used] = counts.get(used, 0) + 1
+   return counts
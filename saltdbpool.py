@@ -0,0 +1,203 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTDBPOOL keeps one connection to each database for the whole process so
+that the tasks of the pipeline can share it rather than each opening their
+own.
+
+connectdb takes the same arguments as saltsafemysql.connectdb and returns a
+connection from the pool, keyed by host, database, user and port.  Before
+a connection that has not been used for a while is returned, it is checked
+with a ping and it is opened again if the server has closed it.  If the
+server closes the connection while it is in use, the statement is run
+again once on a new connection, but only if nothing has been written since
+the last commit, so that part of a transaction is never lost.  Closing a
+connection from the pool only returns it to the pool, so the tasks can still
+close their connections when they are done.  closeall closes all of the
+connections at the end of the night.
+
+Connections cannot be shared between processes, so a process started by
+multiprocessing opens its own connections.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import os, time
+
+import saltsafemysql as saltmysql
+from salterror import SaltError
+
+#connections that have been idle for longer than this are checked before use
+check_interval=60.0
+
+#codes of the MySQL errors when the server has closed the connection
+lost_errors=(2006, 2013)
+
+#statements that do not change the database and can always be run again
+read_statements=['SELECT', 'SHOW', 'DESCRIBE']
+
+_pool={}
+
+
+def connectionlost(e):
+   """Check if an error was raised because the server closed the connection"""
+   return e.__class__.__name__=='OperationalError' and len(e.args)>0 and e.args[0] in lost_errors
+
+
+class PooledCursor:
+   """Cursor of a connection from the pool.  All methods are passed on to the
+      MySQLdb cursor.  If the server has closed the connection, execute and
+      executemany open it again and run the statement once more, as long as
+      nothing has been written since the last commit
+   """
+
+   def __init__(self, conn, args):
+       self.conn=conn
+       self.args=args
+       self.cursor=conn.db.cursor(*args)
+
+   def __getattr__(self, name):
+       return getattr(self.cursor, name)
+
+   def run(self, method, command, params):
+       retry=not self.conn.pending
+       try:
+           result=getattr(self.cursor, method)(command, params)
+       except Exception, e:
+           if not (retry and connectionlost(e)): raise
+           self.conn.reconnect()
+           self.cursor=self.conn.db.cursor(*self.args)
+           result=getattr(self.cursor, method)(command, params)
+       statement=command.strip().split(None, 1)[0].upper()
+       if statement in ['COMMIT', 'ROLLBACK']:
+           self.conn.pending=False
+       elif statement not in read_statements:
+           self.conn.pending=True
+       return result
+
+   def execute(self, command, params=None):
+       return self.run('execute', command, params)
+
+   def executemany(self, command, params):
+       return self.run('executemany', command, params)
+
+
+class PooledConnection:
+   """Connection from the pool.  All methods are passed on to the MySQLdb
+      connection except close, which only returns it to the pool
+   """
+
+   def __init__(self, key, connect):
+       self.key=key
+       self.connect=connect
+       self.db=connect()
+       self.lastused=time.time()
+       self.nconnect=1
+       self.pending=False
+
+   def __getattr__(self, name):
+       return getattr(self.db, name)
+
+   def cursor(self, *args):
+       return PooledCursor(self, args)
+
+   def commit(self):
+       self.db.commit()
+       self.pending=False
+
+   def rollback(self):
+       self.db.rollback()
+       self.pending=False
+
+   def healthy(self):
+       """Check that the connection to the server is still open"""
+       try:
+           self.db.ping()
+       except Exception:
+           return False
+       return True
+
+   def reconnect(self):
+       """Open the connection again"""
+       try:
+           self.db.close()
+       except Exception:
+           pass
+       self.db=self.connect()
+       self.nconnect+=1
+       self.pending=False
+
+   def checkout(self):
+       """Make sure the connection can be used and return it"""
+       if time.time()-self.lastused > check_interval and not self.healthy():
+           self.reconnect()
+       self.lastused=time.time()
+       return self
+
+   def close(self):
+       """Return the connection to the pool"""
+       self.lastused=time.time()
+
+   def shutdown(self):
+       """Close the connection to the server"""
+       try:
+           self.db.close()
+       except Exception:
+           pass
+
+
+def connectdb(host, dbname, user, password, port=None):
+   """Return a connection to a database from the pool.  A new connection is
+      only opened the first time a database is used by a process
+
+      returns PooledConnection
+   """
+   key=(os.getpid(), host, dbname, user, port)
+
+   def connect():
+       if port is None:
+           return saltmysql.connectdb(host, dbname, user, password)
+       import MySQLdb
+       try:
+           return MySQLdb.connect(host=host, db=dbname, user=user, passwd=password, port=port)
+       except Exception, e:
+           raise SaltError('SALTDBPOOL -- Could not connect to %s on %s because %s' % (dbname, host, e))
+
+   if key not in _pool:
+       _pool[key]=PooledConnection(key, connect)
+   return _pool[key].checkout()
+
+
+def connectmysql(host, dbname, user, password, port=None):
+   """Return an sdb_mysql.mysql object that uses a connection from the pool
+
+      returns sdb_mysql.mysql
+   """
+   from sdb_mysql import mysql
+   return mysql(host, dbname, user, password, port=port, db=connectdb(host, dbname, user, password, port))
+
+
+def closeall():
+   """Close all of the connections opened by this process"""
+   for key in _pool.keys():
+       if key[0]!=os.getpid(): continue
+       _pool.pop(key).shutdown()
+
+
+def stats():
+   """Return the number of times each database was connected to by this
+      process
+
+      returns dictionary of (host, dbname, user, port): number of connections
+   """
+   return dict([(k[1:], _pool[k].nconnect) for k in _pool if k[0]==os.getpid()])
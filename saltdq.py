@@ -0,0 +1,191 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTDQ collects data quality measurements while the data are reduced and
+writes them to the science database in a single transaction
+
+The FileData_Id of every file is found with one query.  The rows that are
+already in each table are then found with one more query, and they are
+updated while the others are inserted, with one executemany for each set
+of columns.  A row is identified by its FileData_Id and, for tables such as
+PipelineDataQuality_CCD, its Extension, in the same way as the single row
+updates did, so the tables do not need a unique key on these columns.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+
+def connection(sdb):
+   """Return the MySQLdb connection of either an sdb_mysql.mysql object or
+      a connection from saltsafemysql.connectdb
+   """
+   return getattr(sdb, 'db', sdb)
+
+
+def findfileids(sdb, filenames):
+   """Find the FileData_Id of a list of files with a single query
+
+      Parameters
+      ----------
+      sdb: sdb_mysql.mysql or MySQLdb connection
+           connection to the science database
+      filenames: list
+           names of the files as recorded in FileData
+
+      Returns
+      -------
+      fileids: dict
+           dictionary of file name: FileData_Id for the files that are in
+           the database
+   """
+   filenames = list(set(filenames))
+   if not filenames: return {}
+   cmd = 'SELECT FileName, FileData_Id FROM FileData WHERE FileName IN (%s)' % \
+         ','.join(['%s'] * len(filenames))
+   cursor = connection(sdb).cursor()
+   cursor.execute(cmd, filenames)
+   record = cursor.fetchall()
+   cursor.close()
+   return dict([(r[0], r[1]) for r in record])
+
+
+class DQAccumulator:
+   """Collect the data quality measurements for a set of files and write
+      them to the database in one transaction
+
+      Parameters
+      ----------
+      sdb: sdb_mysql.mysql or MySQLdb connection
+           connection to the science database
+   """
+
+   def __init__(self, sdb):
+       self.sdb = sdb
+       self.rows = {}
+
+   def __len__(self):
+       return sum([len(self.rows[t]) for t in self.rows])
+
+   def add(self, filename, table='PipelineDataQuality_CCD', **values):
+       """Add the measurements for a file.  Values that are None are not
+          written, so they keep their current value in the database
+
+          Parameters
+          ----------
+          filename: string
+               name of the file as recorded in FileData
+          table: string
+               table to write the values to
+          values:
+               columns and values, for example Extension=1, BkgdMean=10.2
+       """
+       row = {}
+       for k in values:
+           if values[k] is None: continue
+           try:
+               row[k] = float(values[k])
+           except (TypeError, ValueError):
+               row[k] = values[k]
+       if 'Extension' in row: row['Extension'] = int(row['Extension'])
+       self.rows.setdefault(table, []).append((filename, row))
+
+   def flush(self):
+       """Write all of the measurements to the database and commit them
+
+          Returns
+          -------
+          missing: list
+               files that are not in FileData and were not written
+       """
+       if not self.rows: return []
+
+       allfiles = []
+       for table in self.rows:
+           allfiles.extend([f for f, row in self.rows[table]])
+       fileids = findfileids(self.sdb, allfiles)
+       missing = sorted(set([f for f in allfiles if f not in fileids]))
+
+       db = connection(self.sdb)
+       cursor = db.cursor()
+       try:
+           for table in sorted(self.rows):
+               rows = []
+               for filename, row in self.rows[table]:
+                   if filename not in fileids: continue
+                   row = dict(row)
+                   row['FileData_Id'] = fileids[filename]
+                   rows.append(row)
+               writerows(cursor, table, rows)
+           db.commit()
+       except:
+           db.rollback()
+           raise
+       finally:
+           cursor.close()
+
+       self.rows = {}
+       return missing
+
+
+def rowkey(row):
+   """Return the columns that identify a row"""
+   return tuple([k for k in ['FileData_Id', 'Extension'] if k in row])
+
+
+def writerows(cursor, table, rows):
+   """Insert or update a list of rows of a table.  The rows that already
+      exist are found with one query and are updated and the others are
+      inserted.  The statements are not committed
+
+      Parameters
+      ----------
+      cursor: cursor
+           cursor of the connection to the science database
+      table: string
+           name of the table
+      rows: list
+           dictionaries of column: value.  Each row is identified by its
+           FileData_Id and its Extension, if it has one
+   """
+   if not rows: return
+
+   #find the rows that are already in the table
+   existing = set()
+   for key in sorted(set([rowkey(row) for row in rows])):
+       ids = sorted(set([row['FileData_Id'] for row in rows if rowkey(row) == key]))
+       cmd = 'SELECT %s FROM %s WHERE FileData_Id IN (%s)' % (','.join(key), table, ','.join(['%s'] * len(ids)))
+       cursor.execute(cmd, ids)
+       existing.update([(key, tuple(r)) for r in cursor.fetchall()])
+
+   #rows are grouped by the columns they set.  A row that appears twice is
+   #inserted the first time and updated the second time
+   inserts = {}
+   updates = {}
+   for row in rows:
+       key = rowkey(row)
+       value = (key, tuple([row[k] for k in key]))
+       columns = tuple(sorted([k for k in row if k not in key]))
+       if value in existing:
+           if columns:
+               updates.setdefault((key, columns), []).append([row[k] for k in columns + key])
+       else:
+           existing.add(value)
+           inserts.setdefault(key + columns, []).append([row[k] for k in key + columns])
+
+   for names in sorted(inserts):
+       cmd = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ','.join(names), ','.join(['%s'] * len(names)))
+       cursor.executemany(cmd, inserts[names])
+   for key, columns in sorted(updates):
+       cmd = 'UPDATE %s SET %s WHERE %s' % (table, ','.join(['%s=%%s' % k for k in columns]),
+                                            ' AND '.join(['%s=%%s' % k for k in key]))
+       cursor.executemany(cmd, updates[(key, columns)])
@@ -42,6 +42,7 @@ import saltsafestring as saltstring
 import saltsafekey as saltkey
 import saltsafeio as saltio
 from saltsafelog import logging, history
+from saltheadercache import get_cache
 
 from salterror import SaltError    
 
@@ -97,6 +98,10 @@ def salteditkey(images,outimages,outpref, keyfile, recfile=None,clobber=False,lo
        # Set up the rules to change the files
        keyedits=readkeyfile(keyfile, log=log, verbose=verbose)
 
+       #the current values are taken from the header cache
+       cache=get_cache()
+       cache.update([img for img in infiles if [f for f in keyedits if checkfitsfile(img, f, keyedits[f])]], nproc=0)
+
        #now step through the images
        for img, oimg in zip(infiles, outfiles):
 
@@ -108,21 +113,31 @@ def salteditkey(images,outimages,outpref, keyfile, recfile=None,clobber=False,lo
 
            if klist:
 
-               #open up the new files
-               struct = saltio.openfits(img,mode=openmode)
-               struct.verify('fix')
-
+               #record the changes
+               header=cache.getheader(img)
+               changed=False
                for kdict in klist:
                    for keyword in kdict:
-                       #record the changes
                        value=kdict[keyword]
                        fitcol.append(img)
                        keycol.append(keyword)
                        newcol.append(value)
                        try:
-                           oldcol.append(struct[0].header[keyword].lstrip())
+                           oldcol.append(header[keyword].lstrip())
                        except:
                            oldcol.append('None')
+                       if str(header.get(keyword, '')).strip()!=str(value).strip(): changed=True
+
+               #the file is left alone if the edits have already been applied
+               if not changed and img==oimg: continue
+
+               #open up the new files
+               struct = saltio.openfits(img,mode=openmode)
+               struct.verify('fix')
+
+               for kdict in klist:
+                   for keyword in kdict:
+                       value=kdict[keyword]
                        #update the keyword
                        if saltkey.found(keyword, struct[0]):
                            try:
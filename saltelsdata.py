@@ -58,6 +58,7 @@ from pyraf import iraf
 
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
 from salterror import SaltError, SaltIOError
 
 from saltsafelog import logging
@@ -85,7 +86,7 @@ def saltelsdata(propcode, obsdate, elshost, elsname, elsuser, elspass,
 
        #open the database
        els=saltmysql.connectelsview(elshost, elsname, elsuser, elspass)
-       sdb=saltmysql.connectdb(sdbhost,sdbname,sdbuser, password)  
+       sdb=saltdbpool.connectdb(sdbhost,sdbname,sdbuser, password)  
 
        #create the values for the entire night
   
@@ -49,6 +49,7 @@ from email.mime.text import MIMEText
 import saltsafekey as saltkey
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
 import saltsafestring as saltstring
 from saltsafelog import logging, history
 
@@ -107,7 +108,7 @@ def saltemail(propcode, obsdate,readme,server='mail.saao.ac.za',username='', pas
             log.error(message)
 
        # log into the mysql data base and download a list of proposal codes
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, password)
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, password)
        select='distinct Proposal_Code'
        table='FileData join ProposalCode using (ProposalCode_Id)'
        logic="FileName like '%" + obsdate + "%'"
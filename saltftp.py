@@ -37,6 +37,7 @@ import tarfile, glob, os, ftplib
 
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
 from salterror import SaltError, SaltIOError
 
 from saltsafelog import logging
@@ -162,7 +163,7 @@ def tarallfiles(obsdate, pid, datapath, beachdir, sdbhost, sdbname, sdbuser,pass
 
 def getproposalcodes(obsdate, sdbhost,sdbname,sdbuser, sdbpassword):
     """Retrieve all the proposal observed on a given date"""
-    db=saltmysql.connectdb(sdbhost,sdbname,sdbuser,sdbpassword)
+    db=saltdbpool.connectdb(sdbhost,sdbname,sdbuser,sdbpassword)
     state_select='Distinct Proposal_Code'
     state_from='FileData join ProposalCode using (ProposalCode_Id)'
     state_logic="FileName like '%"+obsdate+"%'"
@@ -195,7 +196,7 @@ def movetobeachhead(pid,zipfile, datapath, beachdir, sdbhost, sdbname, sdbuser,p
 
    #log into database and determine username from proposer name
    sdbpassword=password
-   db=saltmysql.connectdb(sdbhost,sdbname,sdbuser,sdbpassword)
+   db=saltdbpool.connectdb(sdbhost,sdbname,sdbuser,sdbpassword)
    state_select='p.Username'
    state_from='ProposalCode as c join ProposalContact as pc using (ProposalCode_Id) join Investigator as i on (pc.Contact_Id=i.Investigator_Id) join PiptUser as p using (PiptUser_Id)'
    state_logic="c.Proposal_Code='%s'" % pid
@@ -0,0 +1,349 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTHEADERCACHE keeps the FITS headers of the files of a night so that the
+stages of the pipeline can look up keywords without opening the files
+again.
+
+The cache is kept in the working directory of the night.  Each file is
+recorded by its path with its size and modification time, and its headers
+are read again only if either of these has changed, for example after the
+keywords have been edited.  The headers are read without reading the pixel
+data.  Only the keywords with a value are kept, so COMMENT and HISTORY
+cards are not in the cache.
+
+HeaderCollection gives the files in a directory and a summary table of
+their headers.  A collection can be built once and views of it with only
+the frames that a stage needs can be passed on, and select finds the rows
+of a summary that match a set of keywords.
+
+The cache is saved after the headers of a list of files have been read
+together and when the process exits.  It is only a cache, so if it cannot
+be read or written the headers are simply read from the files.
+
+The cache is read by saltpipe to find the proposal of each frame and the
+frames that saltwatch has already reduced, by salteditkey for the old
+values of the keywords it edits, by saltsdbloadfits for the headers it
+loads into the science database and by hrsadvance through
+HeaderCollection.  The observation log is made by saltobslog, which reads
+the files itself and does not use the cache.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import os, glob, json, atexit
+import multiprocessing
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn
+
+from salterror import SaltError
+
+#name of the cache in the working directory
+cachefile='saltheaders.json'
+
+#extensions of the files that are FITS files
+fitsext=['.fits', '.fit', '.fts']
+
+_caches={}
+
+
+def filestat(path):
+   """Return the size and modification time of a file"""
+   s=os.stat(path)
+   return s.st_size, s.st_mtime
+
+
+def headercards(header):
+   """Return the keywords and values of a header that can be cached
+
+      returns list of [keyword, value]
+   """
+   cards=[]
+   for card in header.cards:
+       key=card.keyword
+       if key in ['', 'COMMENT', 'HISTORY']: continue
+       value=card.value
+       if isinstance(value, (bool, np.bool_)):
+           value=bool(value)
+       elif isinstance(value, (int, long, np.integer)):
+           value=int(value)
+       elif isinstance(value, (float, np.floating)):
+           value=float(value)
+       elif not isinstance(value, basestring):
+           continue
+       cards.append([key, value])
+   return cards
+
+
+def readheader(path):
+   """Read the headers of all the extensions of a file without reading the
+      pixel data
+
+      returns path, size, mtime, list of cards of each extension
+   """
+   try:
+       size, mtime=filestat(path)
+       hdu=fits.open(path, memmap=True)
+       try:
+           return path, size, mtime, [headercards(h.header) for h in hdu]
+       finally:
+           hdu.close()
+   except Exception, e:
+       raise SaltError('SALTHEADERCACHE -- Could not read the header of %s because %s' % (path, e))
+
+
+class HeaderCache:
+   """Headers of the files of a night
+
+      Parameters
+      ----------
+      cachefile: string or None
+           file to save the cache to.  If None, the cache is not saved
+   """
+
+   def __init__(self, cachefile=None):
+       self.cachefile=cachefile
+       self.entries={}
+       self.headers={}
+       self.modified=False
+
+   def __len__(self):
+       return len(self.entries)
+
+   def load(self):
+       """Read the saved cache"""
+       if self.cachefile is None or not os.path.isfile(self.cachefile): return
+       try:
+           fin=open(self.cachefile)
+           try:
+               self.entries=json.load(fin).get('files', {})
+           finally:
+               fin.close()
+       except (IOError, ValueError):
+           self.entries={}
+
+   def save(self):
+       """Write out the cache.  Nothing is done if it cannot be written"""
+       if self.cachefile is None or not self.modified: return
+       tmpfile='%s.%i.tmp' % (self.cachefile, os.getpid())
+       try:
+           fout=open(tmpfile, 'w')
+           json.dump({'files': self.entries}, fout, separators=(',', ':'))
+           fout.close()
+           os.rename(tmpfile, self.cachefile)
+           self.modified=False
+       except (IOError, OSError):
+           if os.path.isfile(tmpfile): os.remove(tmpfile)
+
+   def current(self, path):
+       """Check if the cached headers of a file are up to date"""
+       if path not in self.entries: return False
+       try:
+           size, mtime=filestat(path)
+       except OSError:
+           return False
+       entry=self.entries[path]
+       return entry['size']==size and entry['mtime']==mtime
+
+   def update(self, paths, nproc=1, save=True):
+       """Read the headers of the files that are not in the cache or have
+          changed since they were read.  If nproc is less than one, one
+          process is used for each cpu.  If save is True, the cache is
+          saved if any headers were read
+
+          returns number of files that were read
+       """
+       paths=[os.path.abspath(p) for p in paths]
+       stale=[p for p in sorted(set(paths)) if not self.current(p)]
+       if not stale: return 0
+
+       if nproc < 1: nproc=multiprocessing.cpu_count()
+       if multiprocessing.current_process().daemon: nproc=1
+       nproc=max(1, min(nproc, len(stale)))
+       if nproc==1:
+           results=[readheader(p) for p in stale]
+       else:
+           pool=multiprocessing.Pool(nproc)
+           try:
+               results=pool.map(readheader, stale)
+           finally:
+               pool.close()
+               pool.join()
+
+       for path, size, mtime, cards in results:
+           self.entries[path]={'size':size, 'mtime':mtime, 'cards':cards}
+           self.headers.pop(path, None)
+       self.modified=True
+       if save: self.save()
+       return len(results)
+
+   def getheaders(self, path):
+       """Return the headers of all the extensions of a file
+
+          returns list of astropy.io.fits.Header
+       """
+       path=os.path.abspath(path)
+       if not self.current(path): self.update([path], save=False)
+       if path not in self.headers:
+           self.headers[path]=[fits.Header([tuple(c) for c in cards]) for cards in self.entries[path]['cards']]
+       return self.headers[path]
+
+   def getheader(self, path, ext=0):
+       """Return the header of one extension of a file
+
+          returns astropy.io.fits.Header
+       """
+       headers=self.getheaders(path)
+       try:
+           return headers[ext]
+       except IndexError:
+           raise SaltError('SALTHEADERCACHE -- %s does not have extension %i' % (path, ext))
+
+   def getvalue(self, path, keyword, default=None, ext=0):
+       """Return the value of a keyword in a file or default if the
+          keyword is not in its header
+       """
+       return self.getheader(path, ext).get(keyword, default)
+
+   def summary(self, paths, keywords=None, ext=0, nproc=1):
+       """Create a table of the keywords of a list of files in the same form
+          as the summary of a ccdproc ImageFileCollection.  The table has
+          a column with the file name and a column with the lower case name
+          of each keyword.  Values that are not in a header are masked.
+
+          If keywords is None, all of the keywords are included
+
+          returns astropy.table.Table
+       """
+       self.update(paths, nproc=nproc)
+       headers=[self.getheaders(p) for p in paths]
+       headers=[h[ext] if len(h) > ext else fits.Header() for h in headers]
+
+       if keywords is None:
+           keywords=[]
+           found=set()
+           for h in headers:
+               for k in h.keys():
+                   if k not in found:
+                       found.add(k)
+                       keywords.append(k)
+
+       summary=Table()
+       summary['file']=[os.path.basename(p) for p in paths]
+       for k in keywords:
+           values=[h.get(k) for h in headers]
+           mask=[v is None for v in values]
+           present=[v for v in values if v is not None]
+           if present and isinstance(present[0], basestring):
+               fill=''
+           elif present and isinstance(present[0], bool):
+               fill=False
+           else:
+               fill=0
+           summary[k.lower()]=MaskedColumn([fill if m else v for v, m in zip(values, mask)], mask=mask)
+       return summary
+
+
+class HeaderCollection:
+   """Files in a directory and the summary of their headers, which can be
+      used in place of a ccdproc ImageFileCollection
+
+      Parameters
+      ----------
+      location: string
+           directory with the files
+      keywords: list or None
+           keywords to include in the summary.  If None, all of the keywords
+           are included
+      cache: HeaderCache or None
+           cache to read the headers from.  If None, the cache of the
+           working directory is used
+      summary: astropy.table.Table or None
+           if given, the collection is made from this summary and the
+           directory is not read
+   """
+
+   def __init__(self, location, keywords=None, cache=None, nproc=1, summary=None):
+       self.location=location
+       if summary is None:
+           if cache is None: cache=get_cache()
+           paths=[]
+           for ext in fitsext:
+               paths.extend(glob.glob(os.path.join(location, '*'+ext)))
+           paths.sort()
+           summary=cache.summary(paths, keywords=keywords, nproc=nproc)
+       self.summary=summary
+       self.files=list(summary['file'])
+
+   def __len__(self):
+       return len(self.files)
+
+   def select(self, exclude=None, **criteria):
+       """Return the names of the files that match the criteria.  See select
+          for the form of the criteria
+
+          returns list of file names
+       """
+       return list(self.summary['file'][select(self.summary, exclude, **criteria)])
+
+   def view(self, exclude=None, **criteria):
+       """Return a collection with only the files that match the criteria
+
+          returns HeaderCollection
+       """
+       return HeaderCollection(self.location, summary=self.summary[select(self.summary, exclude, **criteria)])
+
+
+def matchcolumn(summary, keyword, values):
+   """Return a boolean array that is True for the rows where keyword has
+      one of values.  Rows where the keyword is not set never match
+   """
+   if keyword not in summary.colnames: return np.zeros(len(summary), dtype=bool)
+   if isinstance(values, basestring) or not np.iterable(values): values=[values]
+   column=summary[keyword]
+   return np.in1d(np.asarray(column), list(values)) & ~np.ma.getmaskarray(column)
+
+
+def select(summary, exclude=None, **criteria):
+   """Find the rows of a summary that match all of the criteria.  The
+      criteria are given as column=value or column=list of values, for
+      example select(summary, obstype='Bias', detnam=['HRDET', 'HBDET']).
+      exclude is a dictionary of column: values that the rows must not
+      have, for example {'propid':'JUNK'}
+
+      returns boolean array
+   """
+   mask=np.ones(len(summary), dtype=bool)
+   for keyword in criteria:
+       mask&=matchcolumn(summary, keyword, criteria[keyword])
+   if exclude:
+       for keyword in exclude:
+           mask&=~matchcolumn(summary, keyword, exclude[keyword])
+   return mask
+
+
+def get_cache(workdir='.'):
+   """Return the header cache of a working directory.  It is read once for
+      each process
+
+      returns HeaderCache
+   """
+   workdir=os.path.abspath(workdir)
+   if workdir not in _caches:
+       cache=HeaderCache(os.path.join(workdir, cachefile))
+       cache.load()
+       atexit.register(cache.save)
+       _caches[workdir]=cache
+   return _caches[workdir]
@@ -13,6 +13,7 @@ import saltsafekey as saltkey
 import saltsafestring as saltstring
 from saltsafelog import logging
 from salterror import SaltError, SaltIOError
+from saltcalgroup import CalibrationIndex
 
 debug=True
 
@@ -105,14 +106,20 @@ def saltobsid(propcode,obslog,rawpath,prodpath,outpath,prefix='mbxgp', fprefix='
        #Include bias frames
        log.message('SALTOBSID -- filtering bias files to proposal directories\n', with_stdout=verbose)
 
+       #index the data by their configuration
+       biasindex=CalibrationIndex(biasheader_list, compare=comparefiles)
+       flatindex=CalibrationIndex(flatheader_list, compare=comparefiles)
+       for j in range(len(obstab)):
+           biasindex.add(obstab[j], j)
+           flatindex.add(obstab[j], j)
+
        for i in range(len(obstab)):
            fname=obstab[i]['filename']
            prop_list=[]
            #if it is a zero, check to see what other data have the same settings 
            if obstab[i]['CCDTYPE'].strip().upper()=='ZERO' or obstab[i]['OBJECT'].strip().upper() in ['BIAS', 'ZERO']:
-               for j in range(len(obstab)):
-                   if comparefiles(obstab[i], obstab[j], biasheader_list):
-                       prop_list.append(obstab[i]['PROPID'])
+               for j in biasindex.match(obstab[i]):
+                   prop_list.append(obstab[i]['PROPID'])
 
            prop_list=saltio.removebadpids(set(prop_list))
            for pdir in prop_list:
@@ -145,9 +152,8 @@ def saltobsid(propcode,obslog,rawpath,prodpath,outpath,prefix='mbxgp', fprefix='
 
            #if it is a calibration standard, see what other data have the same settings
            if obstab[i]['PROPID'].strip().upper() in calproplist:
-               for j in range(len(obstab)):
-                   if comparefiles(obstab[i], obstab[j],  flatheader_list):
-                       prop_list.append(obstab[j]['PROPID'])
+               for j in flatindex.match(obstab[i]):
+                   prop_list.append(obstab[j]['PROPID'])
 
 
            prop_list=saltio.removebadpids(set(prop_list))
@@ -167,9 +173,8 @@ def saltobsid(propcode,obslog,rawpath,prodpath,outpath,prefix='mbxgp', fprefix='
            prop_list=[]
            for k in biasheader_list:
                bdict[k]=saltkey.get(k, struct[0])
-           for i in range(len(obstab)):
-               if comparefiles(obstab[i], bdict,  biasheader_list):
-                   prop_list.append(obstab[i]['PROPID'])
+           for i in biasindex.match(bdict, reverse=True):
+               prop_list.append(obstab[i]['PROPID'])
            struct.close()
 
            #copy the files over to the directory
@@ -22,6 +22,13 @@ Updates
           -Included loading the data onto the ftp server
            and uploading information into database
 20121109  -Added slotreadtimefix 
+20261018  -Copy and pre-process the raw data for each
+           instrument concurrently
+          -Run the pipeline as a graph of stages with
+           saltscheduler and added resume
+          -Validate the checkpoint manifest when resuming
+          -Link or clone the raw data instead of copying it
+          -Share the database connections with saltdbpool
 
 """
 
@@ -29,7 +36,7 @@ Updates
 
 from __future__ import with_statement
 
-import os, time, ftplib, glob, shutil
+import os, time, ftplib, glob, shutil, json
 import numpy as np
 import scipy as sp
 from astropy.io import fits
@@ -46,8 +53,12 @@ from pyraf.iraf import pysalt
 import salttime
 import saltsafekey as saltkey
 import saltsafemysql as saltmysql
+import saltdbpool
+import saltdq
+from saltheadercache import get_cache
 import saltsafeio as saltio
 import saltsafestring as saltstring
+import saltcopy
 
 from saltsafelog import logging, history
 
@@ -55,8 +66,9 @@ from saltbin2fit import saltbin2fit
 from salthrspreprocess import salthrspreprocess
 
 from saltobsid import saltobsid
+from saltobslog import obslog as obslog_headers, createobslogfits
 from salthtml import salthtml
-from saltsdbloadfits import saltsdbloadfits
+from saltsdbloadfits import saltsdbloadfits, findrawfilename
 from saltftp import saltftp
 from bvitftp import bvitftp
 
@@ -73,10 +85,17 @@ from hrsclean import hrsclean
 from saltadvance import saltadvance
 
 from salterror import SaltError
+from saltscheduler import Stage, StageScheduler
 
 
 debug=True
 
+#manifest of the stages run by the pipeline in the working directory
+stagefile='saltpipe_manifest.json'
+
+#record of the frames processed by SALTWATCH in the working directory
+watchfile='saltwatch.json'
+
 # Make sure the plotting functions work with an older version of matplotlib
 
 
@@ -86,7 +105,8 @@ debug=True
 def saltpipe(obsdate,pinames,archive,ftp,email,emserver,emuser,empasswd,bcc, qcpcuser,qcpcpasswd,
              ftpserver,ftpuser,ftppasswd,sdbhost, sdbname, sdbuser, sdbpass, elshost, elsname, 
              elsuser, elspass, median,function,order,rej_lo,rej_hi,niter,interp,
-             clobber, runstatus, logfile,verbose):
+             clobber, runstatus, logfile,verbose, nproc=0, resume=False, copymode='auto',
+             convmode='standard', convproc=1):
 
    # set up
 
@@ -104,15 +124,19 @@ def saltpipe(obsdate,pinames,archive,ftp,email,emserver,emuser,empasswd,bcc, qcp
 
 
    # stop if the obsdate temporary directory already exists
+   # unless a previous run is being resumed
 
    obsdir='%s' % obsdate
-   if os.path.exists(obsdir):
+   if os.path.exists(obsdir) and not resume:
        emessage += 'The temporary working directory ' + os.getcwd() + '/'
        emessage += obsdate + ' already exists. '
        raise SaltError(emessage)
+   if resume and not os.path.isfile(obsdir+'/'+stagefile):
+       emessage += 'No record of a previous run found in ' + os.getcwd() + '/' + obsdate
+       raise SaltError(emessage)
 
    # create a temporary working directory and move to it
-   saltio.createdir(obsdir)
+   if not resume: saltio.createdir(obsdir)
    saltio.changedir(obsdir)
    workpath = saltio.abspath('.')
 
@@ -127,7 +151,7 @@ def saltpipe(obsdate,pinames,archive,ftp,email,emserver,emuser,empasswd,bcc, qcp
    with logging(logfile,debug) as log:
 
        #connect to the database
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
        
        #get the nightinfo id   
        nightinfoid=saltmysql.getnightinfoid(sdb, obsdate)
@@ -138,6 +162,7 @@ def saltpipe(obsdate,pinames,archive,ftp,email,emserver,emuser,empasswd,bcc, qcp
        state_logic=""
        records=saltmysql.select(sdb, state_select, state_tables, state_logic)
        propids=[k[0] for k in records]
+       sdb.close()
 
        # Calculate the current date
        currentdate=salttime.currentobsdate()
@@ -177,275 +202,450 @@ def saltpipe(obsdate,pinames,archive,ftp,email,emserver,emuser,empasswd,bcc, qcp
            emessage += '\n' + message + '\n'
            log.message(message)
 
-       #copy the data to the working directory
-       if lastrssnum > 1:
-           message = 'Copy ' + rssrawpath + ' --> ' + workpath + 'raw/'
-           log.message(message)
-           saltio.copydir(rssrawpath,'rss/raw')
-       if lastscmnum > 1:
-           message = 'Copy ' + scmrawpath + ' --> ' + workpath + 'raw/'
-           log.message(message)
-           saltio.copydir(scmrawpath,'scam/raw')
-
-       #copy and pre-process the HRS data
-       saltio.createdir('hrs')
-       saltio.createdir('hrs/raw')
-
+       # check directories for the raw HRS data
        hrsbrawpath = makerawdir(obsdate, 'hbdet')
-       message = 'Copy ' + hrsbrawpath + ' --> ' + workpath + 'raw/'
-       log.message(message)
-       salthrspreprocess(hrsbrawpath, 'hrs/raw/', clobber=True, log=log, verbose=verbose)
-       lasthrbnum=len(glob.glob('hrs/raw/*fits'))
-       
        hrsrrawpath = makerawdir(obsdate, 'hrdet')
-       message = 'Copy ' + hrsrrawpath + ' --> ' + workpath + 'raw/'
-       log.message(message)
-       salthrspreprocess(hrsrrawpath, 'hrs/raw/', clobber=True, log=log, verbose=verbose)
-       lasthrsnum=max(lasthrbnum, len(glob.glob('hrs/raw/*fits')))
-
-       if lastrssnum>1 or lastscmnum>1:
-           message = 'Copy of data is complete'
-           log.message(message)
-       else:
-           message = 'No data was taken on %s' % obsdate
-           log.message(message)
+       saltio.createdir('hrs')
+       saltio.createdir('hrs/raw')
+       saltio.createdir('hrs/product')
+
+       #the values shared by all of the stages
+       state = dict(obsdate=obsdate, propcode=propcode, workpath=workpath, keyfile=keyfile,
+                    propids=propids, nightinfoid=nightinfoid, lastrssnum=lastrssnum,
+                    lastscmnum=lastscmnum, ftp=ftp, email=email, emserver=emserver,
+                    emuser=emuser, empasswd=empasswd, bcc=bcc, sender=sender,
+                    ftppasswd=ftppasswd, sdbhost=sdbhost, sdbname=sdbname, sdbuser=sdbuser,
+                    sdbpass=sdbpass, elshost=elshost, elsname=elsname, elsuser=elsuser,
+                    elspass=elspass, median=median, function=function, order=order,
+                    rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, interp=interp, clobber=clobber,
+                    runstatus=runstatus, starttime=starttime, copymode=copymode, convmode=convmode,
+                    convproc=convproc, logfile=logfile, verbose=verbose)
+
+       #run all of the stages of the pipeline
+       scheduler = StageScheduler(pipelinestages(state, rssrawpath, scmrawpath, hrsbrawpath, hrsrrawpath),
+                                  recordfile=stagefile)
+       try:
+           scheduler.run(state, nproc=nproc, log=log, resume=resume, checkrows=checksdbrows)
+       finally:
+           log.message(scheduler.summary(), with_header=False)
+           saltdbpool.closeall()
 
-       #process the data RSS data
-       if lastrssnum>1:
-           preprocessdata('rss', 'P', obsdate, keyfile, log, logfile, verbose)
+   #return to the original working directory
+   saltio.changedir(basedir)
 
-       #process the  SCAM data
-       if lastscmnum>1:
-           preprocessdata('scam', 'S', obsdate, keyfile, log, logfile, verbose)
 
-       #process the HRS data
-       if lasthrsnum>=1:
-           preprocessdata('hrs', 'H', obsdate, keyfile, log, logfile, verbose)
-           preprocessdata('hrs', 'R', obsdate, keyfile, log, logfile, verbose)
-         
+def pipelinestages(state, rssrawpath, scmrawpath, hrsbrawpath, hrsrrawpath):
+   """Create the list of stages for the pipeline.  The order in which the
+      stages are run is set by their inputs and outputs (see saltscheduler)
+
+      returns list of Stage
+   """
+   obsdate = state['obsdate']
+   rssraw = 'rss/raw/P*.fits'
+   scmraw = 'scam/raw/S*.fits'
+   hrbraw = 'hrs/raw/H*.fits'
+   hrrraw = 'hrs/raw/R*.fits'
+   rssprod = 'rss/product/*bxgp*.fits'
+   scmprod = 'scam/product/*bxgp*.fits'
+   hrsprod = 'hrs/product/*bgph*.fits'
+
+   stages = []
+
+   #copy and pre-process the data for each instrument
+   if state['lastrssnum'] > 1:
+       stages.append(ingeststage('rss', 'P', rssrawpath))
+   if state['lastscmnum'] > 1:
+       stages.append(ingeststage('scam', 'S', scmrawpath))
+   stages.append(ingeststage('hrs', 'H', hrsbrawpath))
+   stages.append(ingeststage('hrs', 'R', hrsrrawpath))
+
+   #check the proposal ids.  The raw files are only read, so they are not
+   #outputs of this stage and are not checksummed again
+   stages.append(Stage('propid', stage_propid, inputs=[rssraw, scmraw, hrbraw, hrrraw],
+                       outputs=['propid']))
+
+   #process the data
+   stages.append(Stage('process_rss', stage_process, args=('rss',), inputs=[rssraw, 'propid'],
+                       outputs=[rssprod, 'rss/product/P%sOBSLOG.fits' % obsdate]))
+   stages.append(Stage('process_scam', stage_process, args=('scam',), inputs=[scmraw, 'propid'],
+                       outputs=[scmprod, 'scam/product/S%sOBSLOG.fits' % obsdate]))
+   stages.append(Stage('process_hrs', stage_hrsprocess, inputs=[hrbraw, hrrraw, 'propid'],
+                       outputs=[hrsprod, 'hrs/product/H%sOBSLOG.fits' % obsdate]))
+
+   #collate the data for the individual PIs
+   stages.append(Stage('obsid', stage_obsid,
+                       inputs=[rssprod, scmprod, hrsprod, 'rss/product/P%sOBSLOG.fits' % obsdate,
+                               'scam/product/S%sOBSLOG.fits' % obsdate, 'hrs/product/H%sOBSLOG.fits' % obsdate],
+                       outputs=['obsid']))
+
+   #upload the data to the database
+   stages.append(Stage('sdbload', stage_sdbload, inputs=[rssprod, scmprod, hrbraw, hrrraw, 'propid'],
+                       outputs=['sdb:FileData'], resources=['sdb']))
+
+   #run the advanced HRS pipeline
+   stages.append(Stage('hrsadvance', stage_hrsadvance, inputs=['sdb:FileData', 'obsid', hrsprod,
+                                                           'hrs/product/H%sOBSLOG.fits' % obsdate],
+                       outputs=['hrsadvance'], resources=['sdb']))
+
+   #construct observation and pipeline documentation
+   stages.append(Stage('html', stage_html, inputs=['obsid'], outputs=['html']))
+   stages.append(Stage('elsdata', stage_elsdata, inputs=['obsid', 'sdb:FileData'], outputs=['elsdata'],
+                       resources=['sdb']))
+
+   #distribute the data
+   stages.append(Stage('ftp', stage_ftp, inputs=['html', 'elsdata', 'hrsadvance'], outputs=['ftp']))
+   stages.append(Stage('email', stage_email, inputs=['ftp'], outputs=['email']))
+   stages.append(Stage('status', stage_status, inputs=['email'], outputs=['status']))
+
+   return stages
+
+
+def ingeststage(instrume, prefix, rawpath):
+   """Create the stage to copy and pre-process the raw data for one
+      instrument.  For HRS, each arm is a separate stream with the prefix
+      of its files.
+
+      returns Stage
+   """
+   names = {'P':'ingest_rss', 'S':'ingest_scam', 'H':'ingest_hrsb', 'R':'ingest_hrsr'}
+   return Stage(names[prefix], stage_ingest, args=(instrume, prefix, rawpath),
+                outputs=['%s/raw/%s*.fits' % (instrume, prefix)])
+
+
+def stage_ingest(state, instrume, prefix, rawpath):
+   """Copy and pre-process the raw data for one instrument"""
+   ingeststream(instrume, prefix, rawpath, state['obsdate'], state['keyfile'], state['logfile'], state['verbose'],
+                copymode=state['copymode'], convmode=state['convmode'], convproc=state['convproc'])
+
+
+def stage_propid(state):
+   """Check that all data was given a proper proposal id"""
+   #only do it for semesters after the start of science operations
+   if int(state['obsdate'])<20110901: return
+
+   with logging(state['logfile'],debug) as log:
+       # Check to see that the PROPID keyword exists and if not add it
+       message = '\nSALTPIPE -- Checking for PROPID keyword'
+       log.message(message)
 
+       propids=state['propids']
+       #check rss data
+       rssstatus=runcheckforpropid(glob.glob('rss/raw/P*.fits'), propids, log)
+       #check scam data
+       scmstatus=runcheckforpropid(glob.glob('scam/raw/S*.fits'), propids, log)
+       #check hrsB data
+       hrsbstatus=runcheckforpropid(glob.glob('hrs/raw/H*.fits'), propids, log)
+       #check hrsB data
+       hrsrstatus=runcheckforpropid(glob.glob('hrs/raw/R*.fits'), propids, log)
+
+       if not rssstatus  or not scmstatus or not hrsbstatus or not hrsrstatus: 
+           msg='The PROPIDs for these files needs to be updated and re-start the pipeline'
+           raise SaltError("Invalid PROPID in images:"+msg)
+
+
+def stage_process(state, instrume):
+   """Process the RSS or SALTICAM data"""
+   rawsize, rawnum, prodsize, prodnum=processdata(instrume, state['obsdate'], state['propcode'], state['median'],
+                  state['function'], state['order'], state['rej_lo'], state['rej_hi'], state['niter'],
+                  state['interp'], state['logfile'], state['verbose'], obsid=False)
+
+   #advance process the data
+   #NB: Turned off right now due to RSS being off
+   if instrume=='rss' and rawnum > 0:
+       pass #advanceprocess('rss', obsdate,  propcode, median, function, order, rej_lo, rej_hi, niter, interp,sdbhost, sdbname, sdbuser, sdbpass, logfile, verbose)
+
+   if instrume=='scam': instrume='scm'
+   return {instrume+'rawsize':rawsize, instrume+'rawnum':rawnum,
+           instrume+'prodsize':prodsize, instrume+'prodnum':prodnum}
+
+
+def stage_hrsprocess(state):
+   """Process the HRS data"""
+   rawsize, rawnum, prodsize, prodnum=hrsprocess('hrs', state['obsdate'], state['propcode'], state['median'],
+                  state['function'], state['order'], state['rej_lo'], state['rej_hi'], state['niter'],
+                  state['interp'], state['logfile'], state['verbose'], obsid=False)
+   return {'hrsrawsize':rawsize, 'hrsrawnum':rawnum, 'hrsprodsize':prodsize, 'hrsprodnum':prodnum}
+
+
+def stage_obsid(state):
+   """Collate the data for the individual PIs"""
+   obsdate=state['obsdate']
+   outpath = '.'
+   for instrume, prefix in [('rss', 'P'), ('scam', 'S'), ('hrs', 'H')]:
+       obslog = '%s/product/%s%sOBSLOG.fits' % (instrume, prefix, obsdate)
+       if not os.path.isfile(obslog): continue
+       rawpath = instrume+'/raw'
+       prodpath = instrume+'/product'
+       if instrume=='hrs':
+           saltobsid(propcode=state['propcode'],obslog=obslog,rawpath=rawpath,prodpath=prodpath, outpath=outpath,
+                     prefix='mbgph', fprefix='bgph',clobber=True,logfile=state['logfile'],verbose=state['verbose'])
+       else:
+           saltobsid(propcode=state['propcode'],obslog=obslog,rawpath=rawpath,prodpath=prodpath, outpath=outpath,
+                     clobber=True,logfile=state['logfile'],verbose=state['verbose'])
+
+
+def stage_sdbload(state):
+   """Upload the data to the database"""
+   workpath=state['workpath']
+   sdbhost, sdbname, sdbuser, sdbpass = state['sdbhost'], state['sdbname'], state['sdbuser'], state['sdbpass']
+   logfile, verbose = state['logfile'], state['verbose']
+
+   #upload the data to the database.  The files that SALTWATCH loaded during
+   #the night and that have not changed since are not loaded again
+   watched=watchedproducts()
+   img_list=glob.glob(workpath+'scam/product/*bxgp*.fits')
+   img_list.extend(glob.glob(workpath+'rss/product/*bxgp*.fits'))
+   img_list.extend(glob.glob(workpath+'hrs/raw/*.fits'))
+   load_list=[k for k in img_list if os.path.abspath(k) not in watched]
+   if load_list:
+       img=','.join('%s' %  (k) for k in load_list)
+       saltsdbloadfits(images=img, sdbname=sdbname, sdbhost=sdbhost, sdbuser=sdbuser, \
+              password=sdbpass, logfile=logfile, verbose=verbose)
+
+
+   #add junk sources to the database
+   raw_list=glob.glob(workpath+'scam/raw/S*.fits')
+   raw_list.extend(glob.glob(workpath+'rss/raw/P*.fits'))
+   cache=get_cache()
+   cache.update(raw_list, nproc=0)
+   junk_list=[img for img in raw_list if str(cache.getvalue(img, 'PROPID', '')).strip()=='JUNK']
+   load_list=[k for k in junk_list if os.path.abspath(k) not in watched]
+   if load_list:
+       img=','.join(load_list)
+       saltsdbloadfits(images=img, sdbname=sdbname, sdbhost=sdbhost, sdbuser=sdbuser, \
+              password=sdbpass, logfile=logfile, verbose=verbose)
+   img_list.extend(junk_list)
+
+   #record the rows that were loaded
+   fileids=[]
+   if img_list:
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
+       fileids=sorted([int(k) for k in saltdq.findfileids(sdb, [findrawfilename(img) for img in img_list]).values()])
+       sdb.close()
+   return {'sdbrows':{'FileData.FileData_Id':fileids}}
 
-       #check that all data was given a proper proposal id
-       #only do it for semesters after the start of science operations
-       if int(obsdate)>=20110901:
-           # Check to see that the PROPID keyword exists and if not add it
-           message = '\nSALTPIPE -- Checking for PROPID keyword'
-           log.message(message)
 
-           #check rss data
-           rssstatus=runcheckforpropid(glob.glob('rss/raw/P*.fits'), propids, log)
-           #check scam data
-           scmstatus=runcheckforpropid(glob.glob('scam/raw/S*.fits'), propids, log)
-           #check hrsB data
-           hrsbstatus=runcheckforpropid(glob.glob('hrs/raw/H*.fits'), propids, log)
-           #check hrsB data
-           hrsrstatus=runcheckforpropid(glob.glob('hrs/raw/R*.fits'), propids, log)
+def stage_hrsadvance(state):
+   """Run advanced pipeline -- currently this assumes all files are in the database"""
+   if state.get('hrsrawnum', 0)>0:
+       with logging(state['logfile'],debug) as log:
+           log.message('Processing {} HRS images'.format(state['hrsrawnum']))
+       run_hrsadvance(state['obsdate'], state['sdbhost'], state['sdbname'], state['sdbuser'], state['sdbpass'], state['logfile'])
 
-           if not rssstatus  or not scmstatus or not hrsbstatus or not hrsrstatus: 
-               msg='The PROPIDs for these files needs to be updated and re-start the pipeline'
-               raise SaltError("Invalid PROPID in images:"+msg)
 
-       sdb.close()
-       #process the RSS data
-       rssrawsize, rssrawnum, rssprodsize, rssprodnum=processdata('rss', obsdate,  propcode, median, function, order, rej_lo, rej_hi, niter, interp,logfile, verbose)
-      
-       #advance process the data
-       #NB: Turned off right now due to RSS being off
-       if rssrawnum > 0:
-           pass #advanceprocess('rss', obsdate,  propcode, median, function, order, rej_lo, rej_hi, niter, interp,sdbhost, sdbname, sdbuser, sdbpass, logfile, verbose)
-
-       #process the SCAM data
-       scmrawsize, scmrawnum, scmprodsize, scmprodnum=processdata('scam', obsdate, propcode,  median, function, order, rej_lo, rej_hi, niter, interp,logfile, verbose)
-
-       #process the HRS data
-       hrsrawsize, hrsrawnum, hrsprodsize, hrsprodnum=hrsprocess('hrs', obsdate, propcode, median, function, order, rej_lo, rej_hi, niter, interp, logfile, verbose)
-
-       #upload the data to the database
-       img_list=glob.glob(workpath+'scam/product/*bxgp*.fits')
-       img_list.extend(glob.glob(workpath+'rss/product/*bxgp*.fits'))
-       img_list.extend(glob.glob(workpath+'hrs/raw/*.fits'))
-       if img_list:
-           img=','.join('%s' %  (k) for k in img_list)
-           saltsdbloadfits(images=img, sdbname=sdbname, sdbhost=sdbhost, sdbuser=sdbuser, \
-                  password=sdbpass, logfile=logfile, verbose=verbose)
-
-
-       #add junk sources to the database
-       raw_list=glob.glob(workpath+'scam/raw/S*.fits')
-       raw_list.extend(glob.glob(workpath+'rss/raw/P*.fits'))
-       if raw_list:
-          img=''
-          for img in raw_list:
-              hdu=fits.open(img)
-              if hdu[0].header['PROPID'].strip()=='JUNK':
-                saltsdbloadfits(images=img, sdbname=sdbname, sdbhost=sdbhost, sdbuser=sdbuser, \
-                    password=sdbpass, logfile=logfile, verbose=verbose)
-              hdu.close()
-
-       # run advanced pipeline -- currently this assumes all files are in the database
-       if hrsrawnum>0:
-           log.message('Processing {} HRS images'.format(hrsrawnum))
-           run_hrsadvance(obsdate, sdbhost, sdbname, sdbuser, sdbpass, logfile)
-       
+def stage_html(state):
+   """Construct observation and pipeline documentation"""
+   obsdate=state['obsdate']
+   rssrawnum=state.get('rssrawnum', 0)
+   scmrawnum=state.get('scmrawnum', 0)
+   hrsrawnum=state.get('hrsrawnum', 0)
+   lasthrsnum=len(glob.glob('hrs/raw/*fits'))
 
-       # construct observation and pipeline documentation
-       if lastrssnum > 1 and rssrawnum>0:
-           rssobslog = 'rss/product/P' + obsdate + 'OBSLOG.fits'
-       else:
-           rssobslog = 'none'
+   if state['lastrssnum'] > 1 and rssrawnum>0:
+       rssobslog = 'rss/product/P' + obsdate + 'OBSLOG.fits'
+   else:
+       rssobslog = 'none'
 
-       if lastscmnum > 1 and scmrawnum>0:
-           scmobslog = 'scam/product/S' + obsdate + 'OBSLOG.fits'
-       else:
-           scmobslog = 'None'
+   if state['lastscmnum'] > 1 and scmrawnum>0:
+       scmobslog = 'scam/product/S' + obsdate + 'OBSLOG.fits'
+   else:
+       scmobslog = 'None'
 
-       if lasthrsnum > 1 and hrsrawnum>0:
-           hrsobslog = 'hrs/product/H' + obsdate + 'OBSLOG.fits'
-       else:
-           hrsobslog = 'None'
+   if lasthrsnum > 1 and hrsrawnum>0:
+       hrsobslog = 'hrs/product/H' + obsdate + 'OBSLOG.fits'
+   else:
+       hrsobslog = 'None'
+
+   htmlpath = '.'
+   nightlog = '../nightlogs/' + obsdate + '.log'
+   readme = iraf.osfn('pipetools$html/readme.template')
+   if not os.path.isfile(nightlog):
+       nightlog = ''
+       message = 'No night log {} found'.format(nightlog)
+       with logging(state['logfile'],debug) as log:
+           log.warning(message)
 
+   if (rssrawnum > 0 or scmrawnum > 0 or hrsrawnum>0):
+       salthtml(propcode=state['propcode'],scamobslog=scmobslog,rssobslog=rssobslog, hrsobslog=hrsobslog, htmlpath=htmlpath,
+                  nightlog=nightlog,readme=readme,clobber=True,logfile=state['logfile'],
+                  verbose=state['verbose'])
 
 
-       if rssrawnum==0 and scmrawnum==0 and hrsrawnum==0:
-           msg='No data  processed for  %s' % obsdate
-           email=False
-           ftp=False
-           log.message(msg)
-
-       htmlpath = '.'
-       nightlog = '../nightlogs/' + obsdate + '.log'
-       readme = iraf.osfn('pipetools$html/readme.template')
-       if not os.path.isfile(nightlog):
-           nightlog = ''
-           message = 'No night log {} found'.format(nightlog)
-           log.warning(message)
+def stage_elsdata(state):
+   """Add in the environmental information"""
+   obsdate=state['obsdate']
+   sdbhost, sdbname, sdbuser, sdbpass = state['sdbhost'], state['sdbname'], state['sdbuser'], state['sdbpass']
 
-       if (rssrawnum > 0 or scmrawnum > 0 or hrsrawnum>0):
-           salthtml(propcode=propcode,scamobslog=scmobslog,rssobslog=rssobslog, hrsobslog=hrsobslog, htmlpath=htmlpath,
-                      nightlog=nightlog,readme=readme,clobber=True,logfile=logfile,
-                      verbose=verbose)
-
-       #add a pause to allow syncing of the databases
-       time.sleep(10)
-
-       #Add in the environmental information
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
-       if (rssrawnum > 0 or scmrawnum > 0 or hrsrawnum>0):
-           propids=saltmysql.getpropcodes(sdb, obsdate)
-           for pid in propids:
-               try:
-                  saltelsdata(pid, obsdate, elshost, elsname, elsuser, elspass,
-                           sdbhost,sdbname,sdbuser, sdbpass, clobber, logfile,verbose) 
-               except:
-                  continue
-
-               try:
-                  outfile='%s_%s_elsdata.fits' % (pid, obsdate)
-                  outdir='%s/doc/' % (pid)
-                  shutil.move(outfile, outdir)
-               except:
-                  os.remove(outfile)
-       sdb.close()
+   #add a pause to allow syncing of the databases
+   time.sleep(10)
 
-       #ftp the data
-       beachdir='/salt/ftparea/'
-       if ftp:
+   #Add in the environmental information
+   sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
+   if (state.get('rssrawnum', 0) > 0 or state.get('scmrawnum', 0) > 0 or state.get('hrsrawnum', 0)>0):
+       propids=saltmysql.getpropcodes(sdb, obsdate)
+       for pid in propids:
            try:
-               saltftp(propcode=propcode,obsdate=obsdate, datapath=workpath,
-                   password=ftppasswd,beachdir=beachdir,sdbhost=sdbhost,
-                   sdbname=sdbname,sdbuser=sdbuser,splitfiles=False, 
-                   cleanup=True,clobber=True,logfile=logfile, verbose=verbose)
-           except Exception,e:
-               message="Not able to copy data to FTP area:\n%s " % e
-               raise SaltError(message)     
-           #run with the splitting of files
-           try: 
-               saltftp(propcode=propcode,obsdate=obsdate, datapath=workpath,
-                   password=ftppasswd,beachdir=beachdir,sdbhost=sdbhost,
-                   sdbname=sdbname,sdbuser=sdbuser,splitfiles=True, 
-                   cleanup=True,clobber=True,logfile=logfile, verbose=verbose)
-           except Exception,e:
-               message="Not able to copy data to FTP area:\n%s " % e
-               raise SaltError(message)     
-           #try moving the BVIT data
+              saltelsdata(pid, obsdate, state['elshost'], state['elsname'], state['elsuser'], state['elspass'],
+                       sdbhost,sdbname,sdbuser, sdbpass, state['clobber'], state['logfile'],state['verbose']) 
+           except:
+              continue
+
            try:
-               bvitfile= iraf.osfn('pipetools$html/readme.bvit.template')
-               bvitftp('ALL', obsdate, sdbhost=sdbhost,sdbname=sdbname,sdbuser=sdbuser, 
-                       password=ftppasswd, server=emserver,username=emuser,sender=sender, 
-                       bcc=bcc, emailfile=bvitfile, notify=True, clobber=True,
-                       logfile=logfile, verbose=verbose)
-           except Exception, e:
-               message="ERROR: Not able to copy BVIT to FTP area:\n%s " % e
-               print SaltError(message)     
-               saltio.email(emserver,emuser,ftppassword,sender,'crawford@saao.ac.za','', 'BVIT Died',message)
-           
+              outfile='%s_%s_elsdata.fits' % (pid, obsdate)
+              outdir='%s/doc/' % (pid)
+              shutil.move(outfile, outdir)
+           except:
+              os.remove(outfile)
+   sdb.close()
 
 
+def nodataprocessed(state):
+   """Return True if no data were processed"""
+   return state.get('rssrawnum', 0)==0 and state.get('scmrawnum', 0)==0 and state.get('hrsrawnum', 0)==0
+
+
+def stage_ftp(state):
+   """ftp the data"""
+   if not state['ftp'] or nodataprocessed(state): return
+   obsdate=state['obsdate']
+   propcode=state['propcode']
+   workpath=state['workpath']
+   ftppasswd=state['ftppasswd']
+   sdbhost, sdbname, sdbuser = state['sdbhost'], state['sdbname'], state['sdbuser']
+   logfile, verbose = state['logfile'], state['verbose']
+
+   beachdir='/salt/ftparea/'
+   try:
+       saltftp(propcode=propcode,obsdate=obsdate, datapath=workpath,
+           password=ftppasswd,beachdir=beachdir,sdbhost=sdbhost,
+           sdbname=sdbname,sdbuser=sdbuser,splitfiles=False, 
+           cleanup=True,clobber=True,logfile=logfile, verbose=verbose)
+   except Exception,e:
+       message="Not able to copy data to FTP area:\n%s " % e
+       raise SaltError(message)     
+   #run with the splitting of files
+   try: 
+       saltftp(propcode=propcode,obsdate=obsdate, datapath=workpath,
+           password=ftppasswd,beachdir=beachdir,sdbhost=sdbhost,
+           sdbname=sdbname,sdbuser=sdbuser,splitfiles=True, 
+           cleanup=True,clobber=True,logfile=logfile, verbose=verbose)
+   except Exception,e:
+       message="Not able to copy data to FTP area:\n%s " % e
+       raise SaltError(message)     
+   #try moving the BVIT data
+   try:
+       bvitfile= iraf.osfn('pipetools$html/readme.bvit.template')
+       bvitftp('ALL', obsdate, sdbhost=sdbhost,sdbname=sdbname,sdbuser=sdbuser, 
+               password=ftppasswd, server=state['emserver'],username=state['emuser'],sender=state['sender'], 
+               bcc=state['bcc'], emailfile=bvitfile, notify=True, clobber=True,
+               logfile=logfile, verbose=verbose)
+   except Exception, e:
+       message="ERROR: Not able to copy BVIT to FTP area:\n%s " % e
+       print SaltError(message)     
+       saltio.email(state['emserver'],state['emuser'],ftppasswd,state['sender'],'crawford@saao.ac.za','', 'BVIT Died',message)
+
+
+def stage_email(state):
+   """send notifications if emails have not already been sent"""
+   email=state['email']
+   if nodataprocessed(state): email=False
+   obsdate=state['obsdate']
+   sdbhost, sdbname, sdbuser, sdbpass = state['sdbhost'], state['sdbname'], state['sdbuser'], state['sdbpass']
+   logfile, verbose = state['logfile'], state['verbose']
 
-       #send notifications if emails have not already been sent
+   with logging(logfile,debug) as log:
        #first check to see if emails have been sent
-       sdb=saltmysql.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
        if email:
-          record=saltmysql.select(sdb, 'EmailSent', 'PipelineStatistics', 'NightInfo_Id=%i' % nightinfoid)
+          record=saltmysql.select(sdb, 'EmailSent', 'PipelineStatistics', 'NightInfo_Id=%i' % state['nightinfoid'])
           if len(record)>0:
              if record[0][0]==1:  
                email=False
                log.warning("According to the Sdb, notifications have already been sent for %s." % obsdate)
+       sdb.close()
 
        if int(obsdate)<20110901:
            email=False
            log.warning("Emails will not be sent for data taken before 20110901")
-       
-       if email:
-           try:
-               #send email
-               saltemail(propcode=propcode, obsdate=obsdate, readme=readme, server=emserver,username=emuser,
-                   password=empasswd, bcc=bcc, sdbhost=sdbhost, sdbname=sdbname,sdbuser=sdbuser,
-                   logfile=logfile, verbose=verbose)
-           except Exception,e:
-               message="Not able to send notification emails:\n%s " % e
-               raise SaltError(message)     
-
-           #update pipeline status
-           pipelinestatus(obsdate, 'Email', message=None, rawsize=None, reducedsize=None, runtime=None, emailsent=1,
-               sdbhost=sdbhost, sdbname=sdbname, sdbuser=sdbuser, password=sdbpass, logfile=logfile, verbose=verbose)
-
-
-       #Calculate the amount of time it took to process
-       processing_time = time.time() - starttime
-
-       #caculate the total amount data produced
-       rawsize=rssrawsize + scmrawsize + hrsrawsize
-       prodsize=rssprodsize + scmprodsize + hrsprodsize
-
-       #update the pipeline status
-       if runstatus: 
-           pipelinestatus(obsdate, 'Reduced', message=None, rawsize=rawsize, reducedsize=prodsize, runtime=processing_time,
-                      sdbhost=sdbhost, sdbname=sdbname, sdbuser=sdbuser, password=sdbpass, logfile=logfile, verbose=verbose)
 
-       
-
-       #format the different outputs
-       rawsize, rawunit=calcsizeunit(rawsize)
-       prodsize, produnit=calcsizeunit(prodsize)
-       if (processing_time < 3600):
-          processing_time = int(processing_time / 60 + 0.5)
-          time_unit = ' min'
-       else:
-          processing_time = float(int(processing_time / 360 + 0.5)) / 10
-          time_unit = ' hrs'
-       #output the message with this information
-       message = 'Pipeline Statistics:\n'
-       message += 'Processing time: %s %s\n' %  (str(processing_time), time_unit)
-       message += 'Number of files: %i\n' %  (rssrawnum+scmrawnum+hrsrawnum)
-       message += 'Total Raw Data: %s %s\n' % (rawsize, rawunit)
-       message += 'Total Product Data: %s %s\n' % (prodsize, produnit)
-       #message += 'Number of Proposals: \n'  % (1)
+   if email:
+       try:
+           #send email
+           readme = iraf.osfn('pipetools$html/readme.template')
+           saltemail(propcode=state['propcode'], obsdate=obsdate, readme=readme, server=state['emserver'],username=state['emuser'],
+               password=state['empasswd'], bcc=state['bcc'], sdbhost=sdbhost, sdbname=sdbname,sdbuser=sdbuser,
+               logfile=logfile, verbose=verbose)
+       except Exception,e:
+           message="Not able to send notification emails:\n%s " % e
+           raise SaltError(message)     
+
+       #update pipeline status
+       pipelinestatus(obsdate, 'Email', message=None, rawsize=None, reducedsize=None, runtime=None, emailsent=1,
+           sdbhost=sdbhost, sdbname=sdbname, sdbuser=sdbuser, password=sdbpass, logfile=logfile, verbose=verbose)
+       return {'sdbrows':{'PipelineStatistics.NightInfo_Id':[state['nightinfoid']]}}
+
+
+def stage_status(state):
+   """Update the pipeline status and report the pipeline statistics"""
+   obsdate=state['obsdate']
+   logfile, verbose = state['logfile'], state['verbose']
+
+   #Calculate the amount of time it took to process
+   processing_time = time.time() - state['starttime']
+
+   #caculate the total amount data produced
+   rawsize=state.get('rssrawsize', 0) + state.get('scmrawsize', 0) + state.get('hrsrawsize', 0)
+   prodsize=state.get('rssprodsize', 0) + state.get('scmprodsize', 0) + state.get('hrsprodsize', 0)
+
+   #update the pipeline status
+   if state['runstatus']: 
+       pipelinestatus(obsdate, 'Reduced', message=None, rawsize=rawsize, reducedsize=prodsize, runtime=processing_time,
+                  sdbhost=state['sdbhost'], sdbname=state['sdbname'], sdbuser=state['sdbuser'], password=state['sdbpass'],
+                  logfile=logfile, verbose=verbose)
+
+   #format the different outputs
+   rawsize, rawunit=calcsizeunit(rawsize)
+   prodsize, produnit=calcsizeunit(prodsize)
+   if (processing_time < 3600):
+      processing_time = int(processing_time / 60 + 0.5)
+      time_unit = ' min'
+   else:
+      processing_time = float(int(processing_time / 360 + 0.5)) / 10
+      time_unit = ' hrs'
+   #output the message with this information
+   message = 'Pipeline Statistics:\n'
+   message += 'Processing time: %s %s\n' %  (str(processing_time), time_unit)
+   message += 'Number of files: %i\n' %  (state.get('rssrawnum', 0)+state.get('scmrawnum', 0)+state.get('hrsrawnum', 0))
+   message += 'Total Raw Data: %s %s\n' % (rawsize, rawunit)
+   message += 'Total Product Data: %s %s\n' % (prodsize, produnit)
+   #message += 'Number of Proposals: \n'  % (1)
+   with logging(logfile,debug) as log:
+       if nodataprocessed(state):
+           log.message('No data  processed for  %s' % obsdate)
        log.message(message)
-   sdb.close()
 
-   #return to the original working directory
-   saltio.changedir(basedir)
+   if state['runstatus']:
+       return {'sdbrows':{'PipelineStatistics.NightInfo_Id':[state['nightinfoid']]}}
+
+
+def checksdbrows(state, sdbrows):
+   """Check that the rows recorded by a stage are still in the database
+
+      returns list of problems
+   """
+   problems=[]
+   sdb=saltdbpool.connectdb(state['sdbhost'], state['sdbname'], state['sdbuser'], state['sdbpass'])
+   for key in sdbrows:
+       table, column = key.split('.')
+       values=list(set(sdbrows[key]))
+       if not values: continue
+       logic='%s in (%s)' % (column, ','.join(['%i' % int(k) for k in values]))
+       record=saltmysql.select(sdb, 'count(*)', table, logic)
+       nrows=int(record[0][0])
+       if nrows < len(values):
+           problems.append('%i of the rows in %s are missing' % (len(values)-nrows, table))
+   sdb.close()
+   return problems
 
 
 def calcsizeunit(size):
@@ -466,6 +666,8 @@ def calcsizeunit(size):
 def runcheckforpropid(imlist, propids, log):
     pstatus=True 
     imlist.sort()
+    #read all of the headers at once
+    get_cache().update(imlist, nproc=0)
     for image in imlist:
        try:
            checkforpropid(image,propids)
@@ -481,29 +683,58 @@ def checkforpropid(image,propids):
        returns status
     """
 
-    #open up the image
-    struct=fits.open(image, mode='update')
-    if struct:
-        #get proposal code
-        propid=saltkey.get('PROPID', struct[0])
+    #get proposal code from the header cache
+    propid=get_cache().getvalue(image, 'PROPID')
 
-        #check to see if it is none
-        if saltio.checkfornone(propid) is None or propid is 'None':
-           message='\nNo value in PROPID keyword for %s' % image
-           raise SaltError(message)
- 
-        #check to see if it is an eng or cal proposal
-        if propid.count('ENG_') or propid.count('CAL_'):
-           return
- 
-        #clean up junk ones
-        if propid in ['BIAS','COMMON','JUNK','TEST','UNKNOWN']:
-           return 
+    #check to see if it is none
+    if propid is None or saltio.checkfornone(str(propid)) is None or propid=='None':
+       message='\nNo value in PROPID keyword for %s' % image
+       raise SaltError(message)
+    propid=str(propid).strip()
 
-        #check to see if it is in the sdb
-        if propid not in propids:
-           message='\n%s for PROPID keyword for %s is invalid' % (propid, image)
-           raise SaltError(message)
+    #check to see if it is an eng or cal proposal
+    if propid.count('ENG_') or propid.count('CAL_'):
+       return
+
+    #clean up junk ones
+    if propid in ['BIAS','COMMON','JUNK','TEST','UNKNOWN']:
+       return 
+
+    #check to see if it is in the sdb
+    if propid not in propids:
+       message='\n%s for PROPID keyword for %s is invalid' % (propid, image)
+       raise SaltError(message)
+
+def watchedframes(recordfile=watchfile):
+    """Find the frames that SALTWATCH processed during the night and whose
+       products have not changed since.  A frame whose raw data have been
+       changed since, for example by the keyword edits at the end of the
+       night, is processed again
+
+       returns dictionary of raw frame name: absolute path of the product
+    """
+    if not os.path.isfile(recordfile): return {}
+    fin=open(recordfile)
+    try:
+        record=json.load(fin).get('frames', {})
+    except ValueError:
+        record={}
+    finally:
+        fin.close()
+    frames={}
+    for name in record:
+        entry=record[name]
+        product=entry.get('product')
+        if entry.get('status')!='done' or not product or not os.path.isfile(product): continue
+        if os.path.getmtime(product) > entry['time']: continue
+        raw=entry.get('raw')
+        if not raw or not os.path.isfile(raw) or os.path.getmtime(raw) > entry['time']: continue
+        frames[name]=os.path.abspath(product)
+    return frames
+
+def watchedproducts(recordfile=watchfile):
+    """Return the set of products that SALTWATCH loaded into the database"""
+    return set(watchedframes(recordfile).values())
 
 def makerawdir(obsdate, instr):
     rawdir='/salt/%s/data/%s/%s/raw/' % (instr, obsdate[0:4], obsdate[4:])
@@ -534,16 +765,42 @@ def checkfordata(rawpath, prefix, obsdate, log):
 
    return lastnum
 
-def convertbin(inpath, fitsconfig, logfile, verbose):
+def convertbin(inpath, fitsconfig, logfile, verbose, convmode='standard', nproc=1):
+    """Convert the slot mode binary files.  convmode is the conversion mode
+       of saltbin2fit and nproc is the number of files converted at once
+    """
     if len(glob.glob(inpath+'/*.bin')) > 0:
-        saltbin2fit(inpath=inpath,outpath=inpath,cleanup=True,fitsconfig=fitsconfig,logfile=logfile,verbose=verbose)
+        saltbin2fit(inpath=inpath,outpath=inpath,cleanup=True,fitsconfig=fitsconfig,logfile=logfile,verbose=verbose,
+                    nproc=nproc,convmode=convmode)
         for bfile in glob.glob(inpath+'/*.bin'):
             saltio.delete(bfile)
             ffile=bfile.replace('bin', 'fits')
             slotreadtimefix(ffile, ffile, '', clobber=True, logfile=logfile, verbose=verbose)
          
 
-def preprocessdata(instrume, prefix,  obsdate, keyfile, log, logfile, verbose):
+def ingeststream(instrume, prefix, rawpath, obsdate, keyfile, logfile, verbose, copymode='auto',
+                 convmode='standard', convproc=1):
+   """Copy the raw data for one instrument into the working directory and
+      pre-process it.   For HRS, each arm is a separate stream with the
+      prefix of its files.  copymode sets how the raw data are copied (see
+      saltcopy).  convmode and convproc set how the slot mode data are
+      converted (see convertbin).
+   """
+   with logging(logfile,debug) as log:
+       message = 'Copy ' + rawpath + ' --> ' + os.getcwd() + '/' + instrume + '/raw/'
+       log.message(message)
+       if instrume=='hrs':
+           salthrspreprocess(rawpath, 'hrs/raw/', clobber=True, log=log, verbose=verbose)
+           if len(glob.glob('hrs/raw/%s*fits' % prefix))==0: return
+       else:
+           counts=saltcopy.copydir(rawpath, instrume+'/raw', mode=copymode)
+           for k in counts:
+               log.message('Copied %i files with %s' % (counts[k], k), with_header=False)
+
+       preprocessdata(instrume, prefix, obsdate, keyfile, log, logfile, verbose, convmode=convmode,
+                      convproc=convproc)
+
+def preprocessdata(instrume, prefix,  obsdate, keyfile, log, logfile, verbose, convmode='standard', convproc=1):
    """Run through all of the processing of the individual data files"""
 
    log.message('Beginning pre-processing of %s data' % instrume.upper())
@@ -556,7 +813,8 @@ def preprocessdata(instrume, prefix,  obsdate, keyfile, log, logfile, verbose):
    saltio.createdir(prodpath)
 
    # convert any slot mode binary data to FITS
-   convertbin(inpath, iraf.osfn('pysalt$data/%s/%s_fits.config' % (instrume, instrume)), logfile, verbose)
+   convertbin(inpath, iraf.osfn('pysalt$data/%s/%s_fits.config' % (instrume, instrume)), logfile, verbose,
+              convmode=convmode, nproc=convproc)
 
 
    # fix sec keywords for data of unequal binning obtained before 2006 Aug 12
@@ -564,6 +822,9 @@ def preprocessdata(instrume, prefix,  obsdate, keyfile, log, logfile, verbose):
        pinfiles = instrume+'/raw/*.fits'
        log.message('Fixing SEC keywords in older data')
        log.message('SALTFIXSEC -- infiles=' + pinfiles)
+       #saltfixsec updates the files in place, so any links to the raw data
+       #are replaced by copies first
+       saltcopy.breaklinks(glob.glob(pinfiles))
        pipetools.saltfixsec(infiles=pinfiles)
 
    #fix the key words for the data set
@@ -573,8 +834,10 @@ def preprocessdata(instrume, prefix,  obsdate, keyfile, log, logfile, verbose):
        salteditkey(images=img,outimages=img,outpref='',keyfile=keyfile,recfile=recfile,
                        clobber=True,logfile=logfile,verbose=verbose)
 
-def hrsprocess(instrume, obsdate,propcode, median, function, order, rej_lo, rej_hi, niter, interp,  logfile, verbose):
-   """Clean and process HRS data"""
+def hrsprocess(instrume, obsdate,propcode, median, function, order, rej_lo, rej_hi, niter, interp,  logfile, verbose, obsid=True):
+   """Clean and process HRS data.  If obsid is False, the data are not
+      collated for the individual PIs
+   """
    from saltobslog import saltobslog
 
    prefix = 'H'
@@ -616,7 +879,7 @@ def hrsprocess(instrume, obsdate,propcode, median, function, order, rej_lo, rej_
 
    # collate HRS data for individual PIs
    outpath = '.'
-   if len(img_list)>0:
+   if obsid and len(img_list)>0:
        saltobsid(propcode=propcode,obslog=obslog,rawpath=rawpath,prodpath=prodpath, outpath=outpath, prefix='mbgph', fprefix='bgph',clobber=True,logfile=logfile,verbose=verbose)
 
 
@@ -651,8 +914,10 @@ def advanceprocess(instrume, obsdate, propcode, median, function, order, rej_lo,
    
    return
 
-def processdata(instrume, obsdate, propcode, median, function, order, rej_lo, rej_hi, niter, interp, logfile, verbose):
-   """Clean and process the data"""
+def processdata(instrume, obsdate, propcode, median, function, order, rej_lo, rej_hi, niter, interp, logfile, verbose, obsid=True):
+   """Clean and process the data.  If obsid is False, the data are not
+      collated for the individual PIs
+   """
 
    #set up instrument specific naming
    if instrume=='rss':
@@ -670,19 +935,33 @@ def processdata(instrume, obsdate, propcode, median, function, order, rej_lo, re
         if struct[0].header['PROPID'].upper().strip() != 'JUNK':
            img_list.append(img)
         struct.close()
-   img_str=','.join(img_list)
+
+   #the science frames that SALTWATCH cleaned during the night are not
+   #cleaned again.  The calibration frames are, to create the master frames
+   watched=watchedframes()
+   cache=get_cache()
+   clean_list=[img for img in img_list if os.path.basename(img) not in watched or
+               str(cache.getvalue(img, 'CCDTYPE', '')).strip().upper()!='OBJECT']
+   img_str=','.join(clean_list)
    obslog = '%s/%s%sOBSLOG.fits' % (prodpath, prefix, obsdate)
    gaindb = iraf.osfn('pysalt$data/%s/%samps.dat' % (instrume, instrume_name))
    #gaindb = ''
    xtalkfile = iraf.osfn('pysalt$data/%s/%sxtalk.dat' % (instrume, instrume_name))
    geomfile = iraf.osfn('pysalt$data/%s/%sgeom.dat' % (instrume, instrume_name))
-   if len(img_list)>0:
+   if len(clean_list)>0:
         saltclean(images=img_str,outpath=prodpath,obslogfile=obslog,gaindb=gaindb,
                        xtalkfile=xtalkfile,geomfile=geomfile,subover=True,trim=True,
                        median=median,function=function,order=order,rej_lo=rej_lo,
                        rej_hi=rej_hi,niter=niter,masbias=True,subbias=False,interp=interp,
                        clobber=True,logfile=logfile,verbose=verbose)
 
+   #the observing log includes all of the frames
+   if len(clean_list) < len(img_list):
+        with logging(logfile,debug) as log:
+            if os.path.isfile(obslog): saltio.delete(obslog)
+            obsstruct=createobslogfits(obslog_headers(img_list, log))
+            saltio.writefits(obsstruct, obslog)
+
    rawsize = 0.
    rawnum = 0
    prodsize = 0.
@@ -699,15 +978,17 @@ def processdata(instrume, obsdate, propcode, median, function, order, rej_lo, re
 
    # collate RSS data for individual PIs
    outpath = '.'
-   if len(img_list):
+   if obsid and len(img_list):
        saltobsid(propcode=propcode,obslog=obslog,rawpath=rawpath,prodpath=prodpath, outpath=outpath,clobber=True,logfile=logfile,verbose=verbose)
      
    return  rawsize, rawnum, prodsize, prodnum
 
 
-def run_hrsadvance(obsdate, sdbhost, sdbname, sdbuser, sdbpass, logfile):
+def run_hrsadvance(obsdate, sdbhost, sdbname, sdbuser, sdbpass, logfile, nproc=0,
+                   cr_tile_size=0, cr_overlap=32, cr_skip_empty=False):
     #os.system('/usr/bin/env python  /home/sa/smc/hrs/run_hrsadvance.py  -c -m {} '.format(obsdate))
-    from hrsadvance import hrsbias, run_science, run_hrsflat, run_hrsarcs
+    from hrsadvance import hrsbias, run_science, run_hrsflat, run_hrsarcs, summary_keywords
+    from saltheadercache import HeaderCollection
 
     import logging as lg
     lg.basicConfig(level=lg.INFO)
@@ -726,20 +1007,24 @@ def run_hrsadvance(obsdate, sdbhost, sdbname, sdbuser, sdbpass, logfile):
     link = False
     nlim = 180
 
-    port = 3306
-    sdb = mysql(sdbhost,sdbname,sdbuser,sdbpass, port=port)
+    sdb = saltdbpool.connectmysql(sdbhost,sdbname,sdbuser,sdbpass)
+
+    # read the headers of the raw frames once for all of the stages
+    if not os.path.isdir(rawpath): return
+    image_list = HeaderCollection(rawpath, keywords=summary_keywords, nproc=0)
 
     # run the bias frames
-    hrsbias(rawpath, outpath, clobber=True, sdb=sdb, link=link)
+    hrsbias(rawpath, outpath, clobber=True, sdb=sdb, link=link, image_list=image_list)
 
     # run the flat frames
-    run_hrsflat(obsdate, rawpath, outpath, sdb=sdb, nlim=nlim, link=link)
+    run_hrsflat(obsdate, rawpath, outpath, sdb=sdb, nlim=nlim, link=link, image_list=image_list)
 
     # run the arcs
-    run_hrsarcs(obsdate,  rawpath, outpath, nlim=nlim, sdb=sdb, link=link)
+    run_hrsarcs(obsdate,  rawpath, outpath, nlim=nlim, sdb=sdb, link=link, image_list=image_list)
     
     # run the science frames
-    run_science(obsdate, rawpath=rawpath, outpath=outpath, sdb=sdb, symdir=symdir, mfs=mfs)
+    run_science(obsdate, rawpath=rawpath, outpath=outpath, sdb=sdb, symdir=symdir, mfs=mfs, image_list=image_list,
+                nproc=nproc, cr_tile_size=cr_tile_size, cr_overlap=cr_overlap, cr_skip_empty=cr_skip_empty)
 
  
 # -----------------------------------------------------------
@@ -0,0 +1,450 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTSCHEDULER runs the stages of the pipeline as a dependency graph
+
+Each stage declares the products it reads (inputs) and writes (outputs).
+Products are either paths/glob patterns relative to the working directory
+or simple labels such as 'propid'.  A stage depends on every stage that
+produces one of its inputs, and it is started as soon as all of those
+stages have completed.  Stages that list the same resource (for example
+'sdb') are never run at the same time.
+
+Stage functions are called as func(state, *args) and return a dictionary
+of results that is merged into the state for later stages.  When more
+than one process is requested, each stage runs in its own process so the
+results must be simple values.  These processes are not daemons, so a
+stage can start a pool of processes of its own.
+
+After every stage, a manifest is written to the working directory.  For
+each stage, it records the status, timing and results, the files that
+match the outputs of the stage with their checksums, and any rows in the
+science database that the stage touched.  A stage reports the rows by
+returning them in its results as 'sdbrows', a dictionary of
+'Table.Column': list of values.  When an interrupted night is resumed, the
+manifest is validated and only the stages that completed and whose
+products are unchanged are skipped.  All other stages, and every stage
+that depends on them, are run again.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+import os, glob, time, json, hashlib
+import multiprocessing
+
+from salterror import SaltError
+
+
+class Stage:
+   """A stage of the pipeline
+
+      Parameters
+      ----------
+      name: string
+           name of the stage
+      func: function
+           function to run the stage as func(state, *args).  It must be
+           defined at the top level of a module
+      args: tuple
+           additional arguments for func
+      inputs: list
+           products that are read by the stage
+      outputs: list
+           products that are written by the stage
+      resources: list
+           resources that can only be used by one stage at a time
+   """
+
+   def __init__(self, name, func, args=(), inputs=[], outputs=[], resources=[]):
+       self.name = name
+       self.func = func
+       self.args = tuple(args)
+       self.inputs = list(inputs)
+       self.outputs = list(outputs)
+       self.resources = list(resources)
+
+
+def isfileproduct(product):
+   """Return True if the product is a path or glob pattern rather than
+      a label
+   """
+   return ':' not in product and ('/' in product or '*' in product)
+
+
+def filechecksum(path, blocksize=2**20):
+   """Calculate the md5 checksum of a file
+
+      returns string
+   """
+   md5 = hashlib.md5()
+   fin = open(path, 'rb')
+   try:
+       block = fin.read(blocksize)
+       while block:
+           md5.update(block)
+           block = fin.read(blocksize)
+   finally:
+       fin.close()
+   return md5.hexdigest()
+
+
+def productfiles(outputs):
+   """Find the files that match the outputs of a stage and calculate
+      their sizes and checksums
+
+      returns dictionary of path: {'size', 'md5'}
+   """
+   files = {}
+   for product in outputs:
+       if not isfileproduct(product): continue
+       for path in glob.glob(product):
+           if not os.path.isfile(path): continue
+           files[path] = {'size':os.path.getsize(path), 'md5':filechecksum(path)}
+   return files
+
+
+def runstage(func, state, args, outputs=[]):
+   """Run a single stage and return its results along with the files that
+      it produced
+   """
+   results = func(state, *args)
+   if results is None: results = {}
+   return results, productfiles(outputs)
+
+
+class StageResult:
+   """Result of a stage run in the current process.  It has the same
+      interface as the results returned by the process pool
+   """
+   def __init__(self, func, state, args, outputs=[]):
+       self.error = None
+       try:
+           self.value = runstage(func, state, args, outputs)
+       except Exception, e:
+           self.error = e
+
+   def ready(self):
+       return True
+
+   def get(self):
+       if self.error is not None: raise self.error
+       return self.value
+
+
+def stageprocess(conn, func, state, args, outputs):
+   """Run a stage in a separate process and send the results or the error
+      back through conn
+   """
+   try:
+       conn.send((runstage(func, state, args, outputs), None))
+   except Exception, e:
+       conn.send((None, '%s: %s' % (e.__class__.__name__, e)))
+   conn.close()
+
+
+class StageProcess:
+   """Result of a stage run in its own process.  It has the same interface
+      as StageResult
+   """
+   def __init__(self, func, state, args, outputs=[]):
+       self.conn, child = multiprocessing.Pipe(False)
+       self.process = multiprocessing.Process(target=stageprocess, args=(child, func, state, args, outputs))
+       self.process.daemon = False
+       self.process.start()
+       child.close()
+       self.finished = False
+       self.value = None
+       self.error = None
+
+   def ready(self):
+       if self.finished: return True
+       #the results are read before the process is joined so that a
+       #large result cannot block the process from exiting
+       if not self.conn.poll():
+           if self.process.is_alive() or self.conn.poll(): return False
+           self.error = SaltError('SALTSCHEDULER -- process exited with code %s' % self.process.exitcode)
+       else:
+           try:
+               self.value, error = self.conn.recv()
+               if error is not None: self.error = SaltError(error)
+           except EOFError:
+               self.error = SaltError('SALTSCHEDULER -- process exited with code %s' % self.process.exitcode)
+       self.conn.close()
+       self.process.join()
+       self.finished = True
+       return True
+
+   def get(self):
+       if self.error is not None: raise self.error
+       return self.value
+
+   def join(self):
+       """Wait for the process to finish"""
+       while not self.ready(): time.sleep(0.1)
+
+
+class StageScheduler:
+   """Run a list of stages in order of their dependencies
+
+      Parameters
+      ----------
+      stages: list
+           list of Stage objects.  Stages are started in this order when
+           more than one stage is ready to run
+      recordfile: string
+           manifest file to record the status of the stages
+   """
+
+   def __init__(self, stages, recordfile=None):
+       self.stages = list(stages)
+       self.recordfile = recordfile
+       self.record = {}
+
+       names = [s.name for s in self.stages]
+       for name in names:
+           if names.count(name) > 1:
+               raise SaltError('SALTSCHEDULER -- stage %s is defined more than once' % name)
+
+   def dependencies(self):
+       """Determine the stages that each stage depends on
+
+          returns dictionary of stage name: set of stage names
+       """
+       producers = {}
+       for stage in self.stages:
+           for product in stage.outputs:
+               producers.setdefault(product, set()).add(stage.name)
+
+       deps = {}
+       for stage in self.stages:
+           deps[stage.name] = set()
+           for product in stage.inputs:
+               deps[stage.name] |= producers.get(product, set())
+           deps[stage.name].discard(stage.name)
+       return deps
+
+   def readrecord(self):
+       """Read the record of the stages from a previous run"""
+       if self.recordfile is None or not os.path.isfile(self.recordfile): return {}
+       fin = open(self.recordfile)
+       try:
+           record = json.load(fin)
+       except ValueError, e:
+           raise SaltError('SALTSCHEDULER -- Could not read %s because %s' % (self.recordfile, e))
+       finally:
+           fin.close()
+       return record.get('stages', {})
+
+   def writerecord(self):
+       """Write out the record of the stages"""
+       if self.recordfile is None: return
+       tmpfile = self.recordfile + '.tmp'
+       fout = open(tmpfile, 'w')
+       json.dump({'stages': self.record}, fout, indent=1, sort_keys=True)
+       fout.close()
+       os.rename(tmpfile, self.recordfile)
+
+   def completed(self):
+       """Return the names of the stages that have completed"""
+       return set([k for k in self.record if self.record[k]['status'] == 'done'])
+
+   def markdone(self, stage, starttime, runtime, results={}, sdbrows={}):
+       """Record a stage that was completed outside of the scheduler, so
+          that it is skipped when the stages are resumed
+       """
+       self.record = self.readrecord()
+       self.record[stage.name] = {'status':'done', 'start':starttime, 'runtime':runtime,
+                                  'results':dict(results), 'files':productfiles(stage.outputs),
+                                  'sdbrows':dict(sdbrows)}
+       self.writerecord()
+
+   def validate(self, record, state, checkrows=None):
+       """Check the stages that completed in a previous run against the
+          current contents of the working directory and the database.  As
+          several stages may write the same file, a file is compared to the
+          checksum from the last stage that recorded it.
+
+          Parameters
+          ----------
+          record: dict
+               record of the stages from the manifest
+          state: dict
+               values shared by the stages
+          checkrows: function
+               function called as checkrows(state, sdbrows) that returns a
+               list of problems with the rows recorded by a stage
+
+          returns dictionary of stage name: list of problems
+       """
+       done = [k for k in record if record[k].get('status') == 'done']
+       done.sort(key=lambda k: record[k]['start'] + record[k]['runtime'])
+
+       #the last recorded version of each file
+       latest = {}
+       for name in done:
+           for path, info in record[name].get('files', {}).items():
+               latest[path] = info
+
+       problems = {}
+       checked = {}
+       for name in done:
+           problems[name] = []
+           for path in record[name].get('files', {}):
+               if path not in checked:
+                   info = latest[path]
+                   if not os.path.isfile(path):
+                       checked[path] = '%s is missing' % path
+                   elif os.path.getsize(path) != info['size'] or filechecksum(path) != info['md5']:
+                       checked[path] = '%s has changed' % path
+                   else:
+                       checked[path] = None
+               if checked[path]: problems[name].append(checked[path])
+           sdbrows = record[name].get('sdbrows', {})
+           if sdbrows and checkrows is not None:
+               problems[name].extend(checkrows(state, sdbrows))
+       return problems
+
+   def run(self, state, nproc=1, log=None, resume=False, checkrows=None):
+       """Run the stages
+
+          Parameters
+          ----------
+          state: dict
+               values shared by the stages.  It is updated with the results
+               of each stage
+          nproc: int
+               maximum number of stages to run at the same time.  If 1, the
+               stages are run in the current process.  Otherwise each stage
+               is run in a new process
+          log: saltsafelog.logging
+               log for messages
+          resume: boolean
+               skip the stages that completed in a previous run and whose
+               products are unchanged
+          checkrows: function
+               function to check the database rows recorded by a stage
+               (see validate)
+
+          returns state
+       """
+       deps = self.dependencies()
+       names = set([s.name for s in self.stages])
+
+       self.record = {}
+       if resume:
+           record = self.readrecord()
+           for name in record.keys():
+               if name not in names: del record[name]
+           problems = self.validate(record, state, checkrows)
+
+           #a stage is only skipped if it is valid and all of the stages
+           #it depends on are also skipped
+           valid = set([k for k in problems if not problems[k]])
+           while True:
+               keep = set([k for k in valid if deps[k] <= valid])
+               if keep == valid: break
+               valid = keep
+
+           #restore the results of the stages that were already completed
+           for stage in self.stages:
+               name = stage.name
+               if name in valid:
+                   self.record[name] = record[name]
+                   state.update(record[name].get('results', {}))
+                   if log: log.message('SALTSCHEDULER -- Skipping completed stage %s' % name, with_header=False)
+               elif name in problems:
+                   message = 'SALTSCHEDULER -- Rerunning stage %s because ' % name
+                   if problems[name]:
+                       message += '; '.join(problems[name])
+                   else:
+                       message += 'a stage it depends on will be rerun'
+                   if log: log.warning(message)
+
+       done = self.completed()
+       pending = [s for s in self.stages if s.name not in done]
+       running = {}
+       failed = []
+
+       if nproc < 1: nproc = multiprocessing.cpu_count()
+
+       try:
+           while pending or running:
+               #start all of the stages that are ready
+               if not failed:
+                   busy = set()
+                   for name in running: busy |= set(running[name][0].resources)
+                   for stage in list(pending):
+                       if len(running) >= nproc: break
+                       if not deps[stage.name] <= done: continue
+                       if busy & set(stage.resources): continue
+                       pending.remove(stage)
+                       busy |= set(stage.resources)
+                       if log: log.message('SALTSCHEDULER -- Starting stage %s' % stage.name, with_header=False)
+                       starttime = time.time()
+                       if nproc == 1:
+                           result = StageResult(stage.func, state, stage.args, stage.outputs)
+                       else:
+                           result = StageProcess(stage.func, dict(state), stage.args, stage.outputs)
+                       running[stage.name] = (stage, result, starttime)
+
+               if not running:
+                   if failed or not pending: break
+                   message = 'SALTSCHEDULER -- Unable to run stages %s because of missing or circular dependencies' % \
+                             ', '.join([s.name for s in pending])
+                   raise SaltError(message)
+
+               #collect the stages that have finished
+               finished = [name for name in running if running[name][1].ready()]
+               if not finished:
+                   time.sleep(0.1)
+                   continue
+
+               for name in finished:
+                   stage, result, starttime = running.pop(name)
+                   runtime = time.time() - starttime
+                   try:
+                       results, files = result.get()
+                   except Exception, e:
+                       failed.append(name)
+                       self.record[name] = {'status':'failed', 'start':starttime, 'runtime':runtime,
+                                            'error':str(e)}
+                       if log: log.error('SALTSCHEDULER -- Stage %s failed after %.1f s because %s' %
+                                         (name, runtime, e))
+                   else:
+                       sdbrows = results.pop('sdbrows', {})
+                       state.update(results)
+                       done.add(name)
+                       self.record[name] = {'status':'done', 'start':starttime, 'runtime':runtime,
+                                            'results':results, 'files':files, 'sdbrows':sdbrows}
+                       if log: log.message('SALTSCHEDULER -- Stage %s completed in %.1f s' % (name, runtime),
+                                           with_header=False)
+                   self.writerecord()
+       finally:
+           for name in running:
+               if isinstance(running[name][1], StageProcess): running[name][1].join()
+
+       if failed:
+           message = 'SALTSCHEDULER -- The following stages failed: %s.  ' % ', '.join(failed)
+           message += 'Fix the problem and resume the pipeline to continue from these stages.'
+           raise SaltError(message)
+
+       return state
+
+   def summary(self):
+       """Return a summary of the time taken by each stage"""
+       message = 'Stage timings:\n'
+       for stage in self.stages:
+           if stage.name not in self.record: continue
+           entry = self.record[stage.name]
+           message += '%-15s %-7s %8.1f s\n' % (stage.name, entry['status'], entry['runtime'])
+       return message
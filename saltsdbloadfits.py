@@ -35,9 +35,19 @@
 # Author                 Version      Date         Comment
 # -----------------------------------------------------------------------
 # S M Crawford (SAAO)    0.3          10 Dec 2008
+# S M Crawford (SAAO)    0.4          18 Oct 2026  Load the images in bulk
 
 # saltsdbloadfits adds or updates a fitsdata record in the science database
 #
+# The headers of all of the images are read in parallel without reading the
+# pixel data and are kept in the header cache of the working directory.  The
+# FileData_Id of all of the images is found with one query.  The FileData
+# record of each image is written by saltmysql, which looks up the ids that
+# FileData refers to.  The FitsHeader tables are filled in the same way as
+# saltmysql.updateFitsHeaders does, from the keywords of the primary header
+# with the name of each column, but for all of the images together with
+# one executemany for each table in a single transaction.
+#
 # Limitations
 # --Has to be in the directory to work properly
 
@@ -49,12 +59,20 @@ import os, time, glob, string
 from pyraf import iraf
 import saltsafeio as saltio
 import saltsafemysql as saltmysql
+import saltdbpool
+import saltdq
+from sdb_mysql import mysql
+from saltheadercache import get_cache
 from saltsafelog import logging
 from salterror import SaltError
 
 
 debug=True
 
+#FitsHeader tables written for every image and for each instrument
+headertables=['FitsHeaderImage']
+instrumetables={'RSS':['FitsHeaderRss'], 'SALTICAM':['FitsHeaderSalticam'], 'HRS':['FitsHeaderHrs']}
+
 # -----------------------------------------------------------
 # core routine
 
@@ -69,54 +87,108 @@ def saltsdbloadfits(images, sdbhost, sdbname, sdbuser, password, logfile, verbos
        #open up the infiles
        infiles = saltio.argunpack('Input',images)
 
-       sdb=saltmysql.connectdb(sdbhost,sdbname,sdbuser,password)
-
+       sdb=saltdbpool.connectdb(sdbhost,sdbname,sdbuser,password)
 
-       for infile in infiles:
-            sdbloadfits(infile, sdb, log, verbose)
+       sdbloadfitslist(infiles, sdb, log, verbose)
 
-def sdbloadfits(infile, sdb, logfile, verbose):
+def sdbloadfits(infile, sdb, log, verbose):
     """Add a fits file to the science database
     """
-    #determine the base file name
-    FileName = findrawfilename(infile)
+    return sdbloadfitslist([infile], sdb, log, verbose, nproc=1)
 
-    #determine the reduced file name
-    if FileName!=infile:
-            PipelineFileName=infile
-    else:
-            PipelineFileName=''
+def sdbloadfitslist(infiles, sdb, log, verbose, nproc=0):
+    """Add a list of fits files to the science database
 
-    #open the image and extract the header
-    infits=saltio.openfits(infile)
+       nproc is the number of processes used to read the headers.  If it
+       is less than one, one process is used for each cpu
 
-    #Extract the primary header
-    try:
-        ext=0
-        ImageHeader = infits[ext].header
-    except:
-        message='SALTSDBLOADFITS -- ERROR:  Can not access header for %s' % infile
-        raise SaltError(message)
+       returns dictionary of FileName: FileData_Id
+    """
+    if not infiles: return {}
 
+    #read the headers of all of the images
+    cache=get_cache()
+    cache.update(infiles, nproc=nproc)
 
-    #get the FileData_Id if it already exists
-    FileData_Id = checksdbforfits(FileName, sdb, logfile, verbose)
+    #get the FileData_Id of the images that are already in the database
+    names=[findrawfilename(infile) for infile in infiles]
+    fileids=saltdq.findfileids(sdb, names)
 
-    #create a new entry or update
-    if FileData_Id == -1:
-        #add to database and get its new id number
-        FileData_Id=saltmysql.createnewFileData(sdb,ImageHeader,FileName, PipelineFileName)
-    else:
-        #update the FileData information
-        saltmysql.updateFileData(sdb, ImageHeader, FileData_Id, FileName, PipelineFileName)
+    #create a new entry or update the FileData information
+    images=[]
+    for infile, FileName in zip(infiles, names):
+        #determine the reduced file name
+        if FileName!=infile:
+            PipelineFileName=infile
+        else:
+            PipelineFileName=''
 
-    #Update all of the fits header tables
-    saltmysql.updateFitsHeaders(sdb, infits, FileData_Id)
+        ImageHeader=cache.getheader(infile)
+        if FileName in fileids:
+            message='SALTSDBLOADFITS: Updating %s in database' % FileName
+            saltmysql.updateFileData(sdb, ImageHeader, fileids[FileName], FileName, PipelineFileName)
+        else:
+            message='SALTSDBLOADFITS: Adding %s to database' % FileName
+            fileids[FileName]=saltmysql.createnewFileData(sdb,ImageHeader,FileName, PipelineFileName)
+        if verbose:
+            log.message(message, with_header=False)
+        images.append((fileids[FileName], ImageHeader))
 
+    #Update all of the fits header tables
+    updatefitsheaders(sdb, images)
 
-    saltio.closefits(infits)
+    return dict([(n, fileids[n]) for n in names])
 
-    return 
+def fitsheadertables(header):
+    """Return the FitsHeader tables to write for an image"""
+    try:
+        instrume=str(header['INSTRUME']).strip().upper()
+    except KeyError:
+        instrume=''
+    return headertables + instrumetables.get(instrume, [])
+
+def fitsheaderrow(columns, header):
+    """Return the row of a FitsHeader table for an image.  Each column is
+       filled from the keyword of the same name in upper case, with '_'
+       replaced by '-' for keywords such as DATE-OBS.  Columns without a
+       keyword keep their current value
+
+       returns dictionary of column: value
+    """
+    row={}
+    for column in columns:
+        for key in [column.upper(), column.upper().replace('_', '-')]:
+            if key in header:
+                value=header[key]
+                if isinstance(value, basestring): value=value.strip()
+                row[column]=value
+                break
+    return row
+
+def updatefitsheaders(sdb, images):
+    """Write the FitsHeader tables for a list of images in one transaction
+
+       images is a list of (FileData_Id, primary header)
+    """
+    if not images: return
+    db=mysql(None, None, None, None, db=saltdq.connection(sdb))
+    with db.transaction():
+        cursor=db.db.cursor()
+        try:
+            rows={}
+            columns={}
+            for FileData_Id, header in images:
+                for table in fitsheadertables(header):
+                    if table not in columns:
+                        cursor.execute('SHOW COLUMNS FROM %s' % table)
+                        columns[table]=[r[0] for r in cursor.fetchall() if not r[0].endswith('_Id')]
+                    row=fitsheaderrow(columns[table], header)
+                    row['FileData_Id']=FileData_Id
+                    rows.setdefault(table, []).append(row)
+            for table in sorted(rows):
+                saltdq.writerows(cursor, table, rows[table])
+        finally:
+            cursor.close()
 
 def checksdbforfits(inname, sdb, log,verbose):
     """
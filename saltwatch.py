@@ -0,0 +1,324 @@
+################################# LICENSE ##################################
+# Copyright (c) 2009, South African Astronomical Observatory (SAAO)        #
+# All rights reserved.                                                     #
+#                                                                          #
+############################################################################
+
+
+#!/usr/bin/env python
+
+"""
+SALTWATCH processes the data during the night.  It watches the raw data
+directories and as each new frame is written, it copies the frame to the
+working directory, applies the keyword edits, cleans and mosaics the frame
+and loads it into the science database.
+
+RSS and SALTICAM frames are only processed once they are listed in the
+disk.file record.  HRS frames are processed once they have not been
+modified for one polling interval.  Slot mode binary files are left for
+SALTPIPE.
+
+The frames that have been processed are recorded in the working
+directory so that SALTWATCH can be restarted.  When no new frames have
+arrived for timeout seconds, the record of the keyword edits is written
+and the copying of the raw data is marked as complete in the SALTPIPE
+manifest so that it is skipped when SALTPIPE is run with resume=yes.
+SALTPIPE also reads the record of the frames, so that it does not clean
+the science frames or load the products into the database again.
+
+Author                 Version      Date
+-----------------------------------------------
+S M Crawford (SAAO)    0.1          18 Oct 2026
+
+"""
+
+from __future__ import with_statement
+
+import os, time, glob, json
+from astropy.io import fits
+
+from pyraf import iraf
+from pyraf.iraf import pysalt
+
+import saltsafekey as saltkey
+import saltsafemysql as saltmysql
+import saltdbpool
+import saltsafeio as saltio
+import saltsafestring as saltstring
+import saltcopy
+
+from saltsafelog import logging, history
+
+from salteditkey import salteditkey
+from salthrspreprocess import hrsprepare
+from saltsdbloadfits import sdbloadfits
+from saltadvance import clean, updatedq
+from saltmosaic import saltmosaic
+from saltscheduler import StageScheduler
+from saltpipe import makerawdir, ingeststage, stagefile, watchfile
+
+from salterror import SaltError
+
+debug=True
+
+#instrument, file prefix and raw data directory of each stream
+streams=[('rss', 'P', 'rss'), ('scam', 'S', 'scam'), ('hrs', 'H', 'hbdet'), ('hrs', 'R', 'hrdet')]
+
+
+# -----------------------------------------------------------
+# core routine
+
+def saltwatch(obsdate, sdbhost, sdbname, sdbuser, sdbpass, median, function, order, rej_lo,
+              rej_hi, niter, interp='linear', interval=60, timeout=3600, clobber=True,
+              logfile='saltwatch.log', verbose=True):
+
+   basedir=os.getcwd()
+
+   # check the observation date is sensible
+   if ('/' in obsdate or '20' not in obsdate or len(obsdate) != 8):
+       raise SaltError('Observation date does not look sensible - YYYYMMDD\n')
+
+   # create the working directory, unless this is a restart
+   obsdir='%s' % obsdate
+   if pipelinestarted(obsdir+'/'+stagefile):
+       raise SaltError('SALTPIPE has already been run in ' + os.getcwd() + '/' + obsdate)
+   if not os.path.exists(obsdir): saltio.createdir(obsdir)
+   saltio.changedir(obsdir)
+   workpath = saltio.abspath('.')
+
+   for instrume in ['rss', 'scam', 'hrs']:
+       if not os.path.exists(instrume): saltio.createdir(instrume)
+       if not os.path.exists(instrume+'/raw'): saltio.createdir(instrume+'/raw')
+       if not os.path.exists(instrume+'/product'): saltio.createdir(instrume+'/product')
+
+   logfile = saltio.logname(workpath+logfile)
+   keyfile = '../newheadfiles/list_newhead_' + obsdate
+   params = dict(median=median, function=function, order=order, rej_lo=rej_lo,
+                 rej_hi=rej_hi, niter=niter, interp=interp, clobber=clobber)
+
+   with logging(logfile,debug) as log:
+
+       record = readrecord(watchfile)
+       calibrations = {}
+       for instrume, instrume_name in [('rss', 'RSS'), ('scam', 'SALTICAM')]:
+           gaindb = iraf.osfn('pysalt$data/%s/%samps.dat' % (instrume, instrume_name))
+           xtalkfile = iraf.osfn('pysalt$data/%s/%sxtalk.dat' % (instrume, instrume_name))
+           geomfile = iraf.osfn('pysalt$data/%s/%sgeom.dat' % (instrume, instrume_name))
+           calibrations[instrume] = (saltio.readgaindb(gaindb), saltio.readxtalkcoeff(xtalkfile), geomfile)
+
+       sdb=saltdbpool.connectdb(sdbhost, sdbname, sdbuser, sdbpass)
+
+       #watch for new frames until there have been none for timeout seconds
+       starttime = time.time()
+       lastframe = time.time()
+       while True:
+           nframes = 0
+           for instrume, prefix, instr in streams:
+               try:
+                   rawpath = makerawdir(obsdate, instr)
+               except SaltError:
+                   continue
+
+               for rawfile in newframes(instrume, prefix, rawpath, record, interval):
+                   name = os.path.basename(rawfile)
+                   try:
+                       img, product = processframe(instrume, rawfile, workpath, keyfile, sdb, calibrations,
+                                                   params, log, logfile, verbose)
+                       record[name] = {'status':'done', 'raw':img, 'product':product, 'time':time.time()}
+                   except Exception, e:
+                       log.warning('Unable to process %s because %s' % (rawfile, e))
+                       record[name] = {'status':'failed', 'error':str(e), 'time':time.time()}
+                   writerecord(watchfile, record)
+                   nframes += 1
+
+           if nframes:
+               lastframe = time.time()
+           elif time.time() - lastframe > timeout:
+               break
+           time.sleep(interval)
+
+       sdb.close()
+
+       #finish the copying of the raw data
+       for instrume, prefix, instr in streams:
+           finishstream(instrume, prefix, obsdate, keyfile, record, starttime, log, logfile, verbose)
+
+   #return to the original working directory
+   saltio.changedir(basedir)
+
+
+def pipelinestarted(recordfile):
+   """Check if SALTPIPE has been run in the working directory.  The
+      manifest is also written by SALTWATCH itself when a stream is
+      finished, so only the stages other than the ingest stages count
+
+      returns boolean
+   """
+   if not os.path.isfile(recordfile): return False
+   record = StageScheduler([], recordfile=recordfile).readrecord()
+   return len([k for k in record if not k.startswith('ingest_')]) > 0
+
+
+def readrecord(recordfile):
+   """Read the record of the frames that have already been processed
+
+      returns dictionary of frame name: entry
+   """
+   if not os.path.isfile(recordfile): return {}
+   fin = open(recordfile)
+   try:
+       record = json.load(fin)
+   except ValueError, e:
+       raise SaltError('SALTWATCH -- Could not read %s because %s' % (recordfile, e))
+   finally:
+       fin.close()
+   return record.get('frames', {})
+
+
+def writerecord(recordfile, record):
+   """Write out the record of the frames that have been processed"""
+   tmpfile = recordfile + '.tmp'
+   fout = open(tmpfile, 'w')
+   json.dump({'frames': record}, fout, indent=1, sort_keys=True)
+   fout.close()
+   os.rename(tmpfile, recordfile)
+
+
+def lastfilenumber(rawpath):
+   """Read the number of the next file to be written from the disk.file
+      record in the raw data directory
+
+      returns int
+   """
+   lastnum=1
+   if not os.path.isfile(rawpath+'disk.file'): return lastnum
+   content = saltio.openascii(rawpath+'disk.file','r')
+   for line in content:
+       lastnum = saltstring.filenumber(line)
+   saltio.closeascii(content)
+   return lastnum
+
+
+def newframes(instrume, prefix, rawpath, record, interval):
+   """Find the frames in the raw data directory that have been completely
+      written but not yet processed
+
+      returns list of paths
+   """
+   if instrume=='hrs':
+       infiles = glob.glob(rawpath+prefix+'*.fit')
+       infiles = [f for f in infiles if time.time()-os.path.getmtime(f) > interval]
+   else:
+       lastnum = lastfilenumber(rawpath)
+       infiles = glob.glob(rawpath+prefix+'*.fits')
+       infiles = [f for f in infiles if saltstring.filenumber(os.path.basename(f), -9, -5) < lastnum]
+   infiles = [f for f in infiles if os.path.basename(f) not in record]
+   infiles.sort()
+   return infiles
+
+
+def processframe(instrume, rawfile, workpath, keyfile, sdb, calibrations, params, log, logfile, verbose):
+   """Copy a single frame to the working directory, edit its keywords, clean
+      and mosaic it and load it into the science database
+
+      returns name of the copy of the raw frame and name of the file that
+      was loaded into the database
+   """
+   #copy the frame
+   if instrume=='hrs':
+       if os.path.getsize(rawfile) < 10000000:
+           log.message('Image {} is too small and not usable'.format(rawfile))
+           return None, None
+       img = workpath+'hrs/raw/'+os.path.basename(rawfile)+'s'
+       hdu = saltio.openfits(rawfile)
+       hdu = hrsprepare(hdu)
+       saltio.writefits(hdu, img, clobber=True)
+       hdu.close()
+   else:
+       img = workpath+instrume+'/raw/'+os.path.basename(rawfile)
+       saltcopy.copyfile(rawfile, img)
+   log.message('Copied %s to %s' % (rawfile, img), with_header=False, with_stdout=verbose)
+
+   #apply the keyword edits
+   if os.path.isfile(keyfile):
+       salteditkey(images=img,outimages=img,outpref='',keyfile=keyfile,recfile=None,
+                   clobber=True,logfile=logfile,verbose=verbose)
+
+   #clean the RSS and SALTICAM science and calibration frames
+   struct = fits.open(img)
+   propid = saltkey.get('PROPID', struct[0]).upper().strip()
+   if instrume=='hrs' or propid=='JUNK' or propid.count('CAL_GAIN'):
+       struct.close()
+       sdbloadfits(img, sdb, log, verbose)
+       return img, img
+
+   dblist, xdict, geomfile = calibrations[instrume]
+   struct = clean(struct, createvar=True, badpixelstruct=None, mult=True,
+                  dblist=dblist, xdict=xdict, subover=True, trim=True, subbias=False,
+                  bstruct=None, median=params['median'], function=params['function'],
+                  order=params['order'], rej_lo=params['rej_lo'], rej_hi=params['rej_hi'],
+                  niter=params['niter'], plotover=False, log=log, verbose=verbose)
+
+   # housekeeping keywords
+   fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
+   saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
+   saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
+   saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
+   saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
+
+   # write FITS file
+   bimg = workpath+instrume+'/product/bxgp'+os.path.basename(img)
+   saltio.writefits(struct, bimg, clobber=params['clobber'])
+
+   #measure the data quality of each amplifier before the mosaic
+   updatedq(os.path.basename(img), struct, sdb)
+   detmode = saltkey.get('DETMODE', struct[0])
+   saltio.closefits(struct)
+
+   #mosaic the frame in the same way as SALTCLEAN
+   product = bimg
+   if not saltkey.fastmode(detmode):
+       product = workpath+instrume+'/product/mbxgp'+os.path.basename(img)
+       saltmosaic(images=bimg, outimages=product, outpref='', geomfile=geomfile,
+                  interp=params['interp'], fill=True, cleanup=True, clobber=params['clobber'],
+                  logfile=logfile, verbose=verbose)
+       saltio.delete(bimg)
+
+   #load the frame into the database
+   sdbloadfits(product, sdb, log, verbose)
+
+   return img, product
+
+
+def finishstream(instrume, prefix, obsdate, keyfile, record, starttime, log, logfile, verbose):
+   """Write the record of the keyword edits for a stream and mark the
+      copying of its raw data as complete in the SALTPIPE manifest
+   """
+   infiles = glob.glob('%s/raw/%s*.fits' % (instrume, prefix))
+   if not infiles: return
+
+   #slot mode data are still converted by SALTPIPE
+   if glob.glob('%s/raw/%s*.bin' % (instrume, prefix)): return
+
+   #frames that failed are processed again by SALTPIPE
+   for name in record:
+       if name.startswith(prefix) and record[name]['status']!='done': return
+
+   #apply the keyword edits again so that late changes are included
+   recfile = '%s/product/%s%sKEYLOG.fits' % (instrume, prefix, obsdate)
+   if os.path.isfile(keyfile):
+       img=','.join(infiles)
+       salteditkey(images=img,outimages=img,outpref='',keyfile=keyfile,recfile=recfile,
+                   clobber=True,logfile=logfile,verbose=verbose)
+
+   stage = ingeststage(instrume, prefix, None)
+   scheduler = StageScheduler([stage], recordfile=stagefile)
+   scheduler.markdone(stage, starttime, time.time()-starttime)
+   log.message('SALTWATCH -- Marked %s as complete' % stage.name, with_header=False)
+
+
+# -----------------------------------------------------------
+# main code
+
+parfile = iraf.osfn("pipetools$saltwatch.par")
+t = iraf.IrafTaskFactory(taskname="saltwatch",value=parfile,function=saltwatch, pkgname='pipetools')
@@ -1,4 +1,6 @@
 import MySQLdb
+import MySQLdb.cursors
+from contextlib import contextmanager
 
 class mysql:
    """mysql is an interface to the sql library and specifically simplifies 
@@ -14,11 +16,17 @@ class mysql:
            user for database
       passwd: string
            password of user for mysql database
+      db: connection or None
+           existing connection to the database, for example from saltdbpool.
+           If None, a new connection is opened
 
    """
    
-   def __init__(self, host,dbname,user,passwd, port=None):
-        self.db = MySQLdb.connect(host=host,db=dbname,user=user,passwd=passwd, port=port)
+   def __init__(self, host,dbname,user,passwd, port=None, db=None):
+        if db is not None:
+            self.db = db
+        else:
+            self.db = MySQLdb.connect(host=host,db=dbname,user=user,passwd=passwd, port=port)
 
    @classmethod
    def fromuri(cls, uri):
@@ -100,7 +108,7 @@ class mysql:
        #execute the command
        cursor = self.db.cursor()
        cursor.execute(exec_command)
-       cursor.execute("COMMIT")
+       if self.depth() == 0: cursor.execute("COMMIT")
 
 
    def insert(self, insertion, table):
@@ -126,7 +134,7 @@ class mysql:
        cursor = self.db.cursor()
        try:
            cursor.execute(exec_command)
-           cursor.execute("COMMIT")
+           if self.depth() == 0: cursor.execute("COMMIT")
        except MySQLdb.IntegrityError,e:
            if str(e).count('Duplicate entry'): return
            raise MySQLdb.IntegrityError(e)
@@ -135,3 +143,124 @@ class mysql:
            raise Exception(str(e) + exec_command)
 
 
+   def depth(self, change=0):
+       """Change the number of open transactions by change and return it.
+          The number is kept on the connection rather than on this object,
+          because the connections from saltdbpool are shared by all of the
+          objects in a process
+       """
+       depth = getattr(self.db, 'transaction_depth', 0) + change
+       if change: self.db.transaction_depth = depth
+       return depth
+
+   @contextmanager
+   def transaction(self):
+       """Run a group of statements in a single transaction.  The statements
+          are committed together when the block finishes and rolled back if
+          there is an error.  Transactions can be nested, in which case only
+          the outer one commits.  insert and update do not commit when they
+          are run inside a transaction
+
+          Example
+          -------
+          with sdb.transaction():
+              sdb.executemany('INSERT INTO T (a, b) VALUES (%s, %s)', rows)
+              sdb.execute('UPDATE T SET a=%s WHERE b=%s', (1, 2))
+       """
+       self.depth(1)
+       try:
+           yield self
+       except:
+           if self.depth(-1) == 0: self.db.rollback()
+           raise
+       if self.depth(-1) == 0: self.db.commit()
+
+   def query(self, command, params=None):
+       """Run a query with bound parameters and return all of the rows
+
+       Parameters
+       ----------
+       command: string
+           SQL statement with %s for each parameter
+       params: tuple, list or dict
+           values of the parameters
+
+       Returns
+       -------
+       record: tuple
+           rows returned by the query
+       """
+       cursor = self.db.cursor()
+       try:
+           cursor.execute(command, params)
+           return cursor.fetchall()
+       finally:
+           cursor.close()
+
+   def stream(self, command, params=None, size=1000):
+       """Run a query with a server-side cursor and return the rows one at a
+          time, so large results do not have to be held in memory.  No other
+          statements can be run on the connection until all of the rows have
+          been read
+
+       Parameters
+       ----------
+       command: string
+           SQL statement with %s for each parameter
+       params: tuple, list or dict
+           values of the parameters
+       size: int
+           number of rows to fetch from the server at a time
+       """
+       cursor = self.db.cursor(MySQLdb.cursors.SSCursor)
+       try:
+           cursor.execute(command, params)
+           while True:
+               rows = cursor.fetchmany(size)
+               if not rows: break
+               for row in rows:
+                   yield row
+       finally:
+           cursor.close()
+
+   def execute(self, command, params=None):
+       """Run a statement with bound parameters.  It is committed unless it is
+          part of a transaction
+
+       Returns
+       -------
+       nrows: int
+           number of rows affected
+       """
+       with self.transaction():
+           cursor = self.db.cursor()
+           try:
+               return cursor.execute(command, params)
+           finally:
+               cursor.close()
+
+   def executemany(self, command, params):
+       """Run a statement for each set of parameters.  For an INSERT, all of
+          the rows are sent to the server in a single statement.  It is
+          committed unless it is part of a transaction
+
+       Parameters
+       ----------
+       command: string
+           SQL statement with %s for each parameter
+       params: list
+           list of the values of the parameters for each row
+
+       Returns
+       -------
+       nrows: int
+           number of rows affected
+       """
+       params = list(params)
+       if not params: return 0
+       with self.transaction():
+           cursor = self.db.cursor()
+           try:
+               return cursor.executemany(command, params)
+           finally:
+               cursor.close()
@@ -206,15 +206,219 @@ def softwareversion(detsvw):
       raise SaltError(message)
     return detsvw
 
-def vid2fits(inhead, inbin,outfile, config):
+def hasframeinfo(instrume, detswv):
+    """Return True if the binary file records the dead time and frame counter
+       for each frame
+    """
+    return (detswv>=7.01 and instrume=='SALTICAM') or (detswv>=4.37 and instrume=='RSS')
+
+def readbinheader(bindata, instrume, detswv):
+   """Read the header at the start of a binary file.  On return the file
+      is positioned at the start of the first frame
+
+      returns nframes, fwidth, fheight, namps, gain, rdnoise
+   """
+   #some constants that are needed for reading in the binary data
+   sizeofinteger=struct.calcsize('i')
+   sizeofunsignshort=struct.calcsize('H')
+   sizeofdouble=struct.calcsize('d')
+
+   #read in the number of exposures, geometry of image (width and height) and number of amps
+   nframes= saltio.readbinary(bindata,sizeofinteger,"=i")
+   if detswv<=4.78 and instrume=='SALTICAM':
+      fwidth= saltio.readbinary(bindata,sizeofinteger,"=i")
+      fheight= saltio.readbinary(bindata,sizeofinteger, "=i")
+   elif hasframeinfo(instrume, detswv):
+      fwidth= saltio.readbinary(bindata,sizeofunsignshort,"=H")
+      fheight= saltio.readbinary(bindata,sizeofunsignshort, "=H")
+      pbcols=saltio.readbinary(bindata,sizeofunsignshort, "=H")
+      pbrows=saltio.readbinary(bindata,sizeofunsignshort,"=H")
+   else:
+      message='VID2FITS--Detector Software version %s is not supported' % detswv
+      raise SaltError(message)
+   namps=saltio.readbinary(bindata,sizeofinteger,"=i")
+
+   #read in the gain
+   gain = numpy.zeros(namps,dtype=float)
+   for i in range(namps):
+        gain[i]=saltio.readbinary(bindata,sizeofdouble,"=d")
+
+   #read in the rdnoise
+   rdnoise = numpy.zeros(namps, dtype=float)
+   for i in range(namps):
+       rdnoise[i]=saltio.readbinary(bindata,sizeofdouble,"=d")
+
+   return nframes, fwidth, fheight, namps, gain, rdnoise
+
+def framedtype(fwidth, fheight, instrume, detswv):
+   """Create the numpy record type describing a single frame in the binary
+      file:  the frame header followed by the unsigned short pixel values
+
+      returns numpy.dtype
+   """
+   fields=[('time', '=f8'), ('exptime', '=f8')]
+   if hasframeinfo(instrume, detswv):
+       fields.append(('deadtime', '=i4'))
+       fields.append(('framecnt', '=i4'))
+   fields.append(('data', '=u2', (fheight, fwidth)))
+   return numpy.dtype(fields)
+
+def readheadinfo(inhead):
+   """Read the instrument and detector software version from the header
+      definition file
+
+      returns instrume, detswv
+   """
+   saltio.fileexists(inhead)
+   infits=fits.open(inhead)
+   inheader = infits['Primary'].header
+   instrume=inheader['INSTRUME']
+   detswv=softwareversion(inheader['DETSWV'])
+   infits.close()
+   return instrume, detswv
+
+def readbinindex(bindata, instrume, detswv):
+   """Read the header of each frame in an open binary file, seeking past
+      the pixel data.  Only complete frames are included in the index.
+
+      returns fwidth, fheight, namps, gain, rdnoise, index
+
+      where index is a numpy record array with the frame number, the byte
+      offset of the frame in the file, and the time, exptime, deadtime
+      and framecnt of each frame.   The deadtime and framecnt are -1 if they
+      are not recorded in the file.
+   """
+   nframes, fwidth, fheight, namps, gain, rdnoise = readbinheader(bindata, instrume, detswv)
+
+   #the size of each frame and of the header at the start of each frame
+   dtype = framedtype(fwidth, fheight, instrume, detswv)
+   headdtype = numpy.dtype([(k, dtype.fields[k][0]) for k in dtype.names if k!='data'])
+   skip = dtype.itemsize - headdtype.itemsize
+
+   index = numpy.zeros(nframes, dtype=[('frame', 'i4'), ('offset', 'i8'), ('time', 'f8'),
+                       ('exptime', 'f8'), ('deadtime', 'i4'), ('framecnt', 'i4')])
+   index['deadtime'] = -1
+   index['framecnt'] = -1
+
+   #step through the frames
+   offset = bindata.tell()
+   bindata.seek(0, os.SEEK_END)
+   filesize = bindata.tell()
+   bindata.seek(offset)
+   for i in range(nframes):
+       if offset + dtype.itemsize > filesize:
+           index = index[:i]
+           break
+       head = numpy.frombuffer(bindata.read(headdtype.itemsize), dtype=headdtype)[0]
+       index['frame'][i] = i
+       index['offset'][i] = offset
+       for k in headdtype.names:
+           index[k][i] = head[k]
+       bindata.seek(skip, os.SEEK_CUR)
+       offset += dtype.itemsize
+
+   return fwidth, fheight, namps, gain, rdnoise, index.view(numpy.recarray)
+
+def binindex(inhead, inbin):
+   """Create an index of the frames in a binary file without reading
+      the pixel data
+
+      returns fwidth, fheight, namps, index (see readbinindex)
+   """
+   instrume, detswv = readheadinfo(inhead)
+
+   saltio.fileexists(inbin)
+   bindata = saltio.openbinary(inbin,'rb')
+   try:
+       fwidth, fheight, namps, gain, rdnoise, index = readbinindex(bindata, instrume, detswv)
+   finally:
+       bindata.close()
+
+   return fwidth, fheight, namps, index
+
+def utseconds(ut):
+   """Convert a UT string in HH:MM:SS.sss to seconds since midnight
+
+      returns float
+   """
+   try:
+       hh, mm, ss = ut.split(':')
+       return 3600.0*int(hh) + 60.0*int(mm) + float(ss)
+   except:
+       message = 'ERROR: VID2FITS -- Cannot convert %s to a time' % ut
+       raise SaltError(message)
+
+def parserange(value, convert=int):
+   """Parse a range given as a string 'first,last', for example from a
+      parameter file or the command line.  A blank string means no range.
+
+      returns (first, last) or None
+   """
+   if value is None or not str(value).strip(): return None
+   try:
+       first, last = str(value).split(',')
+       return convert(first.strip()), convert(last.strip())
+   except:
+       message = 'ERROR: VID2FITS -- Cannot convert %s to a range first,last' % value
+       raise SaltError(message)
+
+def selectframes(times, framerange=None, step=1, utrange=None):
+   """Select the frames to be converted
+
+      times: array of frame start times in seconds since 1970
+      framerange: (first, last) frame numbers to keep, counting from 0
+      step: keep every step-th frame of those selected
+      utrange: (start, end) UT interval in HH:MM:SS to keep.  If start is
+               after end, the interval is assumed to cross midnight.
+
+      returns array of frame numbers
+   """
+   nframes = len(times)
+   frames = numpy.arange(nframes)
+   mask = numpy.ones(nframes, dtype=bool)
+
+   if framerange is not None:
+       first, last = framerange
+       mask *= (frames >= first) * (frames <= last)
+
+   if utrange is not None:
+       ut1, ut2 = utseconds(utrange[0]), utseconds(utrange[1])
+       tod = numpy.mod(numpy.asarray(times, dtype=float), 86400.0)
+       if ut1 <= ut2:
+           mask *= (tod >= ut1) * (tod <= ut2)
+       else:
+           mask *= (tod >= ut1) + (tod <= ut2)
+
+   if step < 1:
+       message = 'ERROR: VID2FITS -- step must be at least 1'
+       raise SaltError(message)
+
+   return frames[mask][::step]
+
+def vid2fits(inhead, inbin,outfile, config, batch=False, cube=False, framerange=None, step=1, utrange=None):
    """
     Convert bin files made during the video process to
     regular fits files
 
-    Format python vid2fits.py inhead inbin outfits config
+    Format python vid2fits.py inhead inbin outfits config logfile [first,last [step [HH:MM:SS,HH:MM:SS]]]
+
+    If batch is True, the binary file is memory mapped and all of the
+    extensions are written out in a single pass (see vid2fits_batch)
+
+    If cube is True, each amplifier is written as a single data cube
+    with a table of the frame times (see vid2fits_cube)
+
+    Only a subset of the frames can be converted by giving a range of
+    frame numbers (first, last), a step to keep every Nth frame, or
+    a UT interval (start, end) in HH:MM:SS (see selectframes).  The
+    frames that are not needed are skipped and never read.
 
     Returns
    """
+   if cube: return vid2fits_cube(inhead, inbin, outfile, config, framerange=framerange,
+                                 step=step, utrange=utrange)
+   if batch: return vid2fits_batch(inhead, inbin, outfile, config, framerange=framerange,
+                                   step=step, utrange=utrange)
 
    #Check that the input files exists
    saltio.fileexists(inhead)
@@ -251,39 +455,13 @@ def vid2fits(inhead, inbin,outfile, config):
    #open the binary file
    bindata = saltio.openbinary(inbin,'rb')
 
-   #read in header information from binary file
-
-   #some constants that are needed for reading in the binary data
-   sizeofinteger=struct.calcsize('i')
-   sizeofunsignshort=struct.calcsize('H')
-   sizeofdouble=struct.calcsize('d')
-   sizeoffloat =struct.calcsize('f')
-   
-
-   #read in the number of exposures, geometry of image (width and height) and number of amps
-   nframes= saltio.readbinary(bindata,sizeofinteger,"=i")
-   if detswv<=4.78 and instrume=='SALTICAM':
-      fwidth= saltio.readbinary(bindata,sizeofinteger,"=i")
-      fheight= saltio.readbinary(bindata,sizeofinteger, "=i")
-   elif (detswv>=7.01 and instrume=='SALTICAM') or (detswv>=4.37 and instrume=='RSS'):
-      fwidth= saltio.readbinary(bindata,sizeofunsignshort,"=H")
-      fheight= saltio.readbinary(bindata,sizeofunsignshort, "=H")
-      pbcols=saltio.readbinary(bindata,sizeofunsignshort, "=H")
-      pbrows=saltio.readbinary(bindata,sizeofunsignshort,"=H")
-   else:
-      message='VID2FITS--Detector Software version %s is not supported' % detswv
-      raise SaltError(message)
+   #read in header information from binary file and index the frames
+   fwidth, fheight, namps, gain, rdnoise, index = readbinindex(bindata, instrume, detswv)
    nelements=fwidth*fheight
-   namps=saltio.readbinary(bindata,sizeofinteger,"=i")
-   #read in the gain
-   gain = numpy.zeros(namps,dtype=float)
-   for i in range(namps):
-        gain[i]=saltio.readbinary(bindata,sizeofdouble,"=d")
+   headsize=framedtype(fwidth, fheight, instrume, detswv).itemsize - 2*nelements
 
-   #read in the rdnoise
-   rdnoise = numpy.zeros(namps, dtype=float)
-   for i in range(namps):
-       rdnoise[i]=saltio.readbinary(bindata,sizeofdouble,"=d")
+   #select the frames to convert
+   index = index[selectframes(index['time'], framerange=framerange, step=step, utrange=utrange)]
 
    #set the scale parameters
    bzero=32768
@@ -291,28 +469,26 @@ def vid2fits(inhead, inbin,outfile, config):
    otime=0
 
    #start the loop to read in the data
-   for i in range(nframes):
+   for frame in index:
        #read in the start of the data,time
-       starttime= saltio.readbinary(bindata,sizeofdouble,"=d")
+       starttime= float(frame['time'])
        date_obs, time_obs= ascii_time(starttime)
 
        #read in the exposure time
-       exptime= saltio.readbinary(bindata,sizeofdouble,"=d")
+       exptime= float(frame['exptime'])
 
-       #read in the dead time  in milliseconds
-       if (detswv>=7.01 and instrume=='SALTICAM') or (detswv>=4.37 and instrume=='RSS'):
-           deadtime= saltio.readbinary(bindata,sizeofinteger,"=i")
+       #read in the dead time  in milliseconds and the frame counter
+       if hasframeinfo(instrume, detswv):
+           deadtime= int(frame['deadtime'])
+           framecnt= int(frame['framecnt'])
        else:
            deadtime=None
-       #read in the dead time 
-       if (detswv>=7.01 and instrume=='SALTICAM') or (detswv>=4.37 and instrume=='RSS'):
-           framecnt= saltio.readbinary(bindata,sizeofinteger,"=i")
-       else:
            framecnt=None
        otime=starttime
 
        #read in the data
        shape =  (fheight,fwidth)
+       bindata.seek(int(frame['offset'])+headsize)
        imdata = numpy.fromfile(bindata,dtype=numpy.ushort,count=nelements)
        imdata = imdata.reshape(shape)
 
@@ -354,6 +530,237 @@ def vid2fits(inhead, inbin,outfile, config):
 
    return 
 
+def mapframes(inbin, instrume, detswv):
+   """Memory map the frames in a binary file as an array of records
+      with the type given by framedtype
+
+      returns fwidth, fheight, namps, gain, rdnoise, frames
+   """
+   #read in header information from binary file
+   bindata = saltio.openbinary(inbin,'rb')
+   nframes, fwidth, fheight, namps, gain, rdnoise = readbinheader(bindata, instrume, detswv)
+   offset = bindata.tell()
+   bindata.close()
+
+   #memory map the frames
+   dtype = framedtype(fwidth, fheight, instrume, detswv)
+   nbytes = os.path.getsize(inbin) - offset
+   if nbytes < nframes * dtype.itemsize:
+       message = 'ERROR: VID2FITS -- %s contains %i complete frames but %i were expected' % \
+                 (inbin, nbytes // dtype.itemsize, nframes)
+       raise SaltError(message)
+   frames = numpy.memmap(inbin, dtype=dtype, mode='r', offset=offset, shape=(nframes,))
+
+   return fwidth, fheight, namps, gain, rdnoise, frames
+
+def vid2fits_batch(inhead, inbin, outfile, config, framerange=None, step=1, utrange=None):
+   """
+    Convert bin files made during the video process to regular fits
+    files in a single pass.  The binary file is memory mapped as an
+    array of frames, each amplifier is cut out of the frames as a view
+    of that array, and the full list of extensions is written to disk
+    in one write.  The unsigned pixel values are stored with BZERO=32768
+    as in vid2fits.
+
+    Format python vid2fits.py inhead inbin outfits config
+
+    Returns
+   """
+
+   #Check that the input files exists
+   saltio.fileexists(inhead)
+   saltio.fileexists(inbin)
+   saltio.fileexists(config)
+
+   #if output file exists, then delete
+   if os.path.isfile(outfile): saltio.delete(outfile)
+
+   #read in and process the config file
+   condict=fitsconfig(config)
+
+   #read in the header information
+   infits=fits.open(inhead)
+   inheader = infits['Primary'].header
+   instrume=inheader['INSTRUME']
+   detswv=softwareversion(inheader['DETSWV'])
+
+   #memory map the frames in the binary file
+   fwidth, fheight, namps, gain, rdnoise, frames = mapframes(inbin, instrume, detswv)
+   hasinfo = hasframeinfo(instrume, detswv)
+
+   #create the primary extension
+   hdu = fits.PrimaryHDU()
+   hdu.header=inheader
+   hduList = fits.HDUList(hdu)
+
+   #set the scale parameters
+   bzero=32768
+   bscale=1
+
+   #the sections are the same for every frame
+   if namps > 0: awidth=fwidth//namps
+   sections = [create_header_values(condict,hdu,j,fheight) for j in range(namps)]
+
+   #select the frames to convert
+   for i in selectframes(frames['time'], framerange=framerange, step=step, utrange=utrange):
+       date_obs, time_obs= ascii_time(frames['time'][i])
+       exptime = float(frames['exptime'][i])
+       if hasinfo:
+           deadtime = int(frames['deadtime'][i])
+           framecnt = int(frames['framecnt'][i])
+       else:
+           deadtime = None
+           framecnt = None
+
+       for j in range(namps):
+           #cut each image by the number of amplifiers
+           y1=j*awidth
+           y2=y1+awidth
+           hdue = fits.ImageHDU(frames['data'][i,:,y1:y2], uint=True)
+
+           #fill in the header data
+           datasec,detsec,ccdsec,ampsec,biassec = sections[j]
+           hdue = write_ext_header(hdue,outfile,hdu,time_obs,date_obs,bscale,bzero, \
+                      exptime,gain[j],rdnoise[j],datasec,detsec,ccdsec,ampsec, \
+                      biassec, deadtime=deadtime, framecnt=framecnt )
+           hduList.append(hdue)
+
+   #write all of the extensions out at once
+   try:
+       hduList.writeto(outfile, output_verify='ignore')
+   except Exception, e:
+       message = 'ERROR: VID2FITS -- Fail to convert %s due to %s' % (outfile, e)
+       raise SaltError(message)
+   finally:
+       hduList.close()
+       del frames
+
+   return
+
+
+def vid2fits_cube(inhead, inbin, outfile, config, framerange=None, step=1, utrange=None,
+                  chunksize=2**26):
+   """
+    Convert bin files made during the video process to fits files where
+    each amplifier is stored as a single data cube (frame x row x column)
+    with the extension name SCI and the amplifier number as EXTVER.  The
+    time, UTC-OBS, exposure time, dead time and frame counter for each
+    frame are given in a binary table in the FRAMES extension.
+
+    The cubes are streamed to disk from the memory mapped binary file in
+    blocks of roughly chunksize bytes, so each cube is a single contiguous
+    block in the output file that can be memory mapped (astropy requires
+    do_not_scale_image_data=True to do this).  The unsigned pixel values
+    are stored with BZERO=32768 as in vid2fits.
+
+    Returns
+   """
+
+   #Check that the input files exists
+   saltio.fileexists(inhead)
+   saltio.fileexists(inbin)
+   saltio.fileexists(config)
+
+   #if output file exists, then delete
+   if os.path.isfile(outfile): saltio.delete(outfile)
+
+   #read in and process the config file
+   condict=fitsconfig(config)
+
+   #read in the header information
+   infits=fits.open(inhead)
+   inheader = infits['Primary'].header
+   instrume=inheader['INSTRUME']
+   detswv=softwareversion(inheader['DETSWV'])
+
+   #memory map the frames in the binary file
+   fwidth, fheight, namps, gain, rdnoise, frames = mapframes(inbin, instrume, detswv)
+   hasinfo = hasframeinfo(instrume, detswv)
+
+   #select the frames to convert
+   sel = selectframes(frames['time'], framerange=framerange, step=step, utrange=utrange)
+   nsel = len(sel)
+   if nsel == 0:
+       message = 'ERROR: VID2FITS -- No frames selected from %s' % inbin
+       raise SaltError(message)
+
+   #create the primary extension
+   hdu = fits.PrimaryHDU()
+   hdu.header=inheader
+   try:
+       fits.HDUList(hdu).writeto(outfile, output_verify='ignore')
+   except:
+       message  = 'ERROR -- VID2FIT: Could not create new fits file'
+       raise SaltError(message)
+
+   #set the scale parameters
+   bzero=32768
+   bscale=1
+
+   #the times of the frames
+   times = numpy.array(frames['time'][sel], dtype=float)
+   exptimes = numpy.array(frames['exptime'][sel], dtype=float)
+   utc = [ascii_time(t)[1] for t in times]
+   date_obs = ascii_time(times[0])[0]
+
+   #write out each amplifier as a cube
+   if namps > 0: awidth=fwidth//namps
+   nchunk = max(1, chunksize // (2 * fheight * awidth))
+   for j in range(namps):
+       y1=j*awidth
+       y2=y1+awidth
+
+       #set the header values using the first frame
+       hdue = fits.ImageHDU()
+       datasec,detsec,ccdsec,ampsec,biassec=  \
+                  create_header_values(condict,hdu,j,fheight)
+       hdue = write_ext_header(hdue,outfile,hdu,utc[0],date_obs,bscale,bzero, \
+                  exptimes[0],gain[j],rdnoise[j],datasec,detsec,ccdsec,ampsec, \
+                  biassec)
+
+       header = fits.Header([('XTENSION', 'IMAGE', 'Image extension'),
+                             ('BITPIX', 16, 'array data type'),
+                             ('NAXIS', 3, 'number of array dimensions'),
+                             ('NAXIS1', awidth), ('NAXIS2', fheight), ('NAXIS3', nsel),
+                             ('PCOUNT', 0, 'number of parameters'),
+                             ('GCOUNT', 1, 'number of groups'),
+                             ('BSCALE', bscale), ('BZERO', bzero),
+                             ('EXTNAME', 'SCI', 'Extension name'),
+                             ('EXTVER', j+1, 'Amplifier number')])
+       for card in hdue.header.cards:
+           if card.keyword not in header: header.append(card)
+
+       #stream the frames into the cube
+       try:
+           shdu = fits.StreamingHDU(outfile, header)
+           for k in range(0, nsel, nchunk):
+               data = frames['data'][sel[k:k+nchunk],:,y1:y2]
+               shdu.write((data ^ numpy.uint16(bzero)).view(numpy.int16))
+           shdu.close()
+       except Exception, e:
+           message = 'ERROR: VID2FITS -- Fail to convert %s due to %s' % (outfile, e)
+           raise SaltError(message)
+
+   #write out the table of frame information
+   if hasinfo:
+       deadtime = numpy.array(frames['deadtime'][sel], dtype=numpy.int32)
+       framecnt = numpy.array(frames['framecnt'][sel], dtype=numpy.int32)
+   else:
+       deadtime = -1 * numpy.ones(nsel, dtype=numpy.int32)
+       framecnt = -1 * numpy.ones(nsel, dtype=numpy.int32)
+   cols = [fits.Column(name='FRAME', format='J', array=sel),
+           fits.Column(name='TIME', format='D', unit='s', array=times),
+           fits.Column(name='UTC-OBS', format='12A', array=utc),
+           fits.Column(name='EXPTIME', format='D', unit='s', array=exptimes),
+           fits.Column(name='DEADTIME', format='J', unit='ms', array=deadtime),
+           fits.Column(name='FRAMECNT', format='J', array=framecnt)]
+   tbhdu = fits.BinTableHDU.from_columns(cols)
+   tbhdu.name = 'FRAMES'
+   fits.append(outfile, tbhdu.data, tbhdu.header)
+   del frames
+
+   return
+
 
 if __name__ == "__main__":
     if (len(sys.argv)>1):
@@ -362,6 +769,9 @@ if __name__ == "__main__":
         myout    = sys.argv[3]
         myconfig = sys.argv[4]
         logfile  = sys.argv[5]
-        vid2fits(myhead,mybin,myout,myconfig)
+        myrange  = parserange(sys.argv[6]) if len(sys.argv)>6 else None
+        mystep   = int(sys.argv[7]) if len(sys.argv)>7 else 1
+        myut     = parserange(sys.argv[8], str) if len(sys.argv)>8 else None
+        vid2fits(myhead,mybin,myout,myconfig,framerange=myrange,step=mystep,utrange=myut)
     else:
         print vid2fits.__doc__